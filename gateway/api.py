@@ -1,10 +1,10 @@
+import asyncio
 import datetime
 import json
 import random
 import string
 from typing import List
 
-from redis import asyncio as aioredis
 from fastapi import FastAPI, Request, Depends, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi_cache import FastAPICache
@@ -16,12 +16,25 @@ from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.sql import or_, and_
 from fastapi.responses import HTMLResponse, JSONResponse
-from config.database import get_db, init_db
-from config.main import Settings, send_email, send_tg
+from config.database import get_db, init_db, pool_stats, pool_watchdog, engines
+from config.main import Settings, IMAGES_DIR, IMAGES_URL, REDIS_URL
 from models.auth import User
 from routes.offers import router as offers_router
+from services import events, notifications, otp, passwords
+from services.appliances import catalogue
+from services.clusters import init_cluster_cache
+from services.geocoding import init_geocoder, close_geocoder
+from services.geocoding_queue import geocoding_worker
+from services.images import ImmutableStaticFiles, shutdown_executor
+from services.metrics import InstrumentedRedis, metrics_middleware, instrument_engine, start_exporter, stop_exporter
+from services.query_budget import query_budget, watch_engine
+from services.replicas import init_replicas, get_read_db, mark_write, replica_monitor, replica_stats
+from services.response_cache import cache_stats
+from services.search_index import search_index_worker
+from services.users import init_user_cache, cache_user, get_profile, invalidate_user, profile_of
+from services.image_store import image_gc_worker
 from schemas.auth import SignUp, NewPassword, SignIn, EditData, SimpleResponse, TokenResponse, ProfileResponse, \
-    Authorise, ResetPassword
+    Authorise, ResetPassword, Roles
 from fastapi import Response, Cookie
 
 app = FastAPI(
@@ -39,8 +52,14 @@ app.add_middleware(
 
 add_pagination(app)
 
+app.middleware("http")(metrics_middleware)
+
+background_tasks = []
+
 app.include_router(offers_router)
 
+app.mount(IMAGES_URL, ImmutableStaticFiles(directory=IMAGES_DIR, check_dir=False), name='images')
+
 
 @AuthJWT.load_config
 def get_config():
@@ -73,7 +92,10 @@ async def authenticate_user(username: str, password: str, session: AsyncSession)
         )
     )
     user = result.first()
-    if user and user[0].verify_password(password):
+    if user and await user[0].verify_password(password):
+        if session.is_modified(user[0]):
+            # The hash was upgraded to the current cost factor
+            await session.commit()
         return user[0]
     return None
 
@@ -115,33 +137,96 @@ async def register_user(user_data: SignUp, session: AsyncSession):
 
 @app.on_event("startup")
 async def startup_event():
+    for engine in engines.values():
+        instrument_engine(engine)
+        watch_engine(engine)
+    start_exporter()
     await init_db()
     global redis_pool
-    redis = aioredis.from_url("redis://127.0.0.1:6379",
-                              encoding="utf8", decode_responses=True)
+    redis = InstrumentedRedis.from_url(REDIS_URL,
+                                       encoding="utf8", decode_responses=True)
     redis_pool = redis
     FastAPICache.init(RedisBackend(redis), prefix="fastapi-cache")
+    init_geocoder(redis)
+    init_cluster_cache(redis)
+    init_user_cache(redis)
+    events.init_events(redis)
+    notifications.init_notifications(redis)
+    otp.init_otp(redis)
+    init_replicas(redis)
+    await catalogue.load()
+    background_tasks.append(asyncio.create_task(events.listen()))
+    background_tasks.append(asyncio.create_task(pool_watchdog()))
+    background_tasks.append(asyncio.create_task(replica_monitor()))
+    background_tasks.append(asyncio.create_task(search_index_worker()))
+    background_tasks.append(asyncio.create_task(image_gc_worker()))
+    background_tasks.append(asyncio.create_task(geocoding_worker()))
+    background_tasks.append(asyncio.create_task(notifications.notification_worker()))
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
     global redis_pool
     await redis_pool.close()
+    await close_geocoder()
+    await notifications.close_notifications()
+    for task in background_tasks:
+        task.cancel()
+    shutdown_executor()
+    passwords.shutdown_executor()
+    stop_exporter()
+
+
+async def require_admin(Authorize: AuthJWT = Depends(), session: AsyncSession = Depends(get_read_db)):
+    """Guards the /internal routes: they describe the deployment, so only admins may read them."""
+    Authorize.jwt_required()
+    user_profile = await get_profile(session, Authorize.get_jwt_subject())
+    if not user_profile or user_profile['role'] != Roles.admin:
+        raise HTTPException(status_code=403, detail="user_not_allowed")
+
+
+@app.get("/internal/cache", include_in_schema=False, dependencies=[Depends(require_admin)])
+async def internal_cache_stats():
+    return await cache_stats()
+
+
+@app.get("/internal/db-pool", include_in_schema=False, dependencies=[Depends(require_admin)])
+async def internal_pool_stats():
+    return pool_stats()
+
+
+@app.get("/internal/replicas", include_in_schema=False, dependencies=[Depends(require_admin)])
+async def internal_replica_stats():
+    return replica_stats()
+
+
+@app.get("/internal/notifications", include_in_schema=False, dependencies=[Depends(require_admin)])
+async def internal_notification_stats():
+    return await notifications.notification_stats()
+
+
+@app.get("/internal/notifications/{notification_id}", include_in_schema=False,
+         dependencies=[Depends(require_admin)])
+async def internal_notification_result(notification_id: str):
+    result = await notifications.get_result(notification_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail='notification_not_found')
+    return result
 
 
 @app.get("/v1/send-otp", tags=['Account'], response_model=SimpleResponse)
-async def send_otp(tg_id: str, session: AsyncSession = Depends(get_db)):
+@query_budget(1)
+async def send_otp(tg_id: str, request: Request, session: AsyncSession = Depends(get_db)):
+    await otp.throttle('login', tg_id, request.client.host)
+    code = await otp.issue(tg_id)
     user = await session.execute(
         select(User).where((User.tg_id == tg_id))
     )
     user = user.first()
-    global redis_pool
     if user:
-        otp = random.randint(10000, 99999)
-        await redis_pool.set(f"otp:{tg_id}", otp, ex=600)
-        msg_body = f'''Ваш код подтверждения: {otp}'''
+        msg_body = f'''Ваш код подтверждения: {code}'''
         try:
-            send_tg(tg_id, msg_body)
+            await notifications.enqueue_telegram(tg_id, msg_body)
             return {'result': True}
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
@@ -149,11 +234,13 @@ async def send_otp(tg_id: str, session: AsyncSession = Depends(get_db)):
 
 
 @app.post("/v1/auth", tags=['Account'], response_model=TokenResponse)
+@query_budget(1)
 async def auth(data: Authorise, Authorize: AuthJWT = Depends(), session: AsyncSession = Depends(get_db)):
     user = await auth_user(data.tg_id, session)
     if user is None:
         raise HTTPException(
             status_code=401, detail="Incorrect code")
+    await cache_user(user)
     access_token = Authorize.create_access_token(subject=user.id)
     refresh_token = Authorize.create_refresh_token(subject=user.id)
     response_dict = {
@@ -172,11 +259,13 @@ async def auth(data: Authorise, Authorize: AuthJWT = Depends(), session: AsyncSe
 
 
 @app.post("/v1/signin", tags=['Account'], response_model=TokenResponse)
+@query_budget(2)
 async def signin(data: SignIn, Authorize: AuthJWT = Depends(), session: AsyncSession = Depends(get_db)):
     user = await authenticate_user(data.username, data.password, session)
     if user is None:
         raise HTTPException(
             status_code=401, detail="Incorrect username or password")
+    await cache_user(user)
     access_token = Authorize.create_access_token(subject=user.id)
     refresh_token = Authorize.create_refresh_token(subject=user.id)
     return {
@@ -211,6 +300,7 @@ async def logout():
 
 
 @app.post('/v1/signup', tags=['Account'], response_model=SimpleResponse)
+@query_budget(2)
 async def signup(data: SignUp, Authorize: AuthJWT = Depends(), session: AsyncSession = Depends(get_db)):
     user = await register_user(data, session)
     if user is None:
@@ -221,28 +311,18 @@ async def signup(data: SignUp, Authorize: AuthJWT = Depends(), session: AsyncSes
 
 
 @app.get('/v1/profile', tags=['Account'], response_model=ProfileResponse)
-async def profile(Authorize: AuthJWT = Depends(), session: AsyncSession = Depends(get_db)):
+@query_budget(1)
+async def profile(Authorize: AuthJWT = Depends(), session: AsyncSession = Depends(get_read_db)):
     Authorize.jwt_required()
     current_user = Authorize.get_jwt_subject()
-    user = await session.execute(
-        select(User).where((User.id == current_user))
-    )
-    user = user.fetchone()
-    if user:
-        return {'profile': {
-            'id': user[0].id,
-            'role': user[0].role,
-            'phone': user[0].phone,
-            'username': user[0].tg_username,
-            'tg_id': user[0].tg_id,
-            'name': user[0].name,
-            'email': user[0].email,
-            'status': user[0].status,
-        }}
+    user_profile = await get_profile(session, current_user)
+    if user_profile:
+        return {'profile': user_profile}
     raise HTTPException(status_code=404, detail='user_not_found')
 
 
 @app.put('/v1/edit-data', tags=['Account'], response_model=ProfileResponse)
+@query_budget(2)
 async def edit_data(data: EditData, Authorize: AuthJWT = Depends(), session: AsyncSession = Depends(get_db)):
     Authorize.jwt_required()
     current_user = Authorize.get_jwt_subject()
@@ -256,20 +336,14 @@ async def edit_data(data: EditData, Authorize: AuthJWT = Depends(), session: Asy
         user[0].phone = data.phone
         user[0].tg_username = data.username
         await session.commit()
-        return {'profile': {
-            'id': user[0].id,
-            'role': user[0].role,
-            'phone': user[0].phone,
-            'username': user[0].tg_username,
-            'tg_id': user[0].tg_id,
-            'name': user[0].name,
-            'email': user[0].email,
-            'status': user[0].status,
-        }}
+        await mark_write(user[0].id)
+        await invalidate_user(user[0].id)
+        return {'profile': profile_of(user[0])}
     raise HTTPException(status_code=404, detail='user_not_found')
 
 
 @app.put('/v1/set-password', tags=['Account'], response_model=SimpleResponse)
+@query_budget(2)
 async def set_password(data: NewPassword, Authorize: AuthJWT = Depends(), session: AsyncSession = Depends(get_db)):
     Authorize.jwt_required()
     current_user = Authorize.get_jwt_subject()
@@ -279,26 +353,27 @@ async def set_password(data: NewPassword, Authorize: AuthJWT = Depends(), sessio
         )
         user = user.fetchone()
         if user:
-            user[0].get_password_hash(data.new_password)
+            await user[0].get_password_hash(data.new_password)
             await session.commit()
+            await invalidate_user(user[0].id)
             return {'result': True}
         raise HTTPException(status_code=404, detail='user_not_found')
     raise HTTPException(status_code=400, detail='different_values')
 
 
 @app.get("/v1/send-reset-otp", tags=['Account'], response_model=SimpleResponse)
-async def send_reset_otp(username: str, session: AsyncSession = Depends(get_db)):
+@query_budget(1)
+async def send_reset_otp(username: str, request: Request, session: AsyncSession = Depends(get_db)):
+    await otp.throttle('reset', username, request.client.host)
+    code = await otp.issue(username)
     user = await session.execute(
         select(User).where((User.tg_username == username))
     )
     user = user.first()
-    global redis_pool
     if user:
-        otp = random.randint(10000, 99999)
-        await redis_pool.set(f"otp:{username}", otp, ex=600)
-        msg_body = f'''Ваш код подтверждения: {otp}'''
+        msg_body = f'''Ваш код подтверждения: {code}'''
         try:
-            send_tg(user[0].tg_id, msg_body)
+            await notifications.enqueue_telegram(user[0].tg_id, msg_body)
             return {'result': True}
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
@@ -306,18 +381,23 @@ async def send_reset_otp(username: str, session: AsyncSession = Depends(get_db))
 
 
 @app.post("/v1/reset-password", tags=['Account'], response_model=SimpleResponse)
-async def reset_password(data: ResetPassword, session: AsyncSession = Depends(get_db)):
+@query_budget(2)
+async def reset_password(data: ResetPassword, request: Request, session: AsyncSession = Depends(get_db)):
+    await otp.throttle('verify', data.username, request.client.host)
+    if data.new_password != data.confirm_password:
+        # Checked first so a typo does not use up the code
+        raise HTTPException(status_code=400, detail='different_values')
+    if not await otp.verify(data.username, data.code):
+        raise HTTPException(status_code=404, detail='user_not_found')
     result = await session.execute(
         select(User).where(
             (User.tg_username == data.username)
         )
     )
     user = result.first()
-    global redis_pool
-    if user and str(data.code) == str(await redis_pool.get(f'otp:{data.username}')):
-        if data.new_password == data.confirm_password:
-            user[0].get_password_hash(data.new_password)
-            await session.commit()
-            return {'result': True}
-        raise HTTPException(status_code=400, detail='different_values')
+    if user:
+        await user[0].get_password_hash(data.new_password)
+        await session.commit()
+        await invalidate_user(user[0].id)
+        return {'result': True}
     raise HTTPException(status_code=404, detail='user_not_found')
@@ -1,18 +1,137 @@
+import asyncio
+import time
+
+from fastapi import Request
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeout
 from sqlalchemy.ext.declarative import declarative_base
 from typing import AsyncGenerator
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlmodel import SQLModel, create_engine
-from config.main import DB_HOST, DB_PORT, DB_USER, DB_NAME, DB_PASS
+from config.main import DB_HOST, DB_PORT, DB_USER, DB_NAME, DB_PASS, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, \
+    DB_POOL_RECYCLE, DB_POOL_PRE_PING, DB_STATEMENT_CACHE_SIZE, DB_IDLE_IN_TRANSACTION_WARNING, \
+    DB_IDLE_IN_TRANSACTION_TIMEOUT
 
 # SQLALCHEMY_DATABASE_URL = config("DATABASE_URL")
 
 DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 Base = declarative_base()
 
-engine = create_async_engine(DATABASE_URL)
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """The default async queue pool plus counters for the internal pool endpoint. Checkout waits are timed
+    around _do_get, which is where a request blocks when every connection is taken."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = {'checkouts': 0, 'wait_total': 0.0, 'wait_max': 0.0, 'timeouts': 0, 'connects': 0,
+                      'invalidations': 0}
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeout:
+            self.stats['timeouts'] += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            self.stats['checkouts'] += 1
+            self.stats['wait_total'] += waited
+            self.stats['wait_max'] = max(self.stats['wait_max'], waited)
+
+    def _create_connection(self):
+        self.stats['connects'] += 1
+        record = super()._create_connection()
+        # Pool listeners only get the connection record, so it carries what they need to know about its pool
+        record.info.update(stats=self.stats, pool_name=self.logging_name)
+        return record
+
+    def stats_snapshot(self):
+        stats = dict(self.stats)
+        stats['wait_avg'] = stats['wait_total'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        return {
+            'size': self.size(),
+            'checked_out': self.checkedout(),
+            'checked_in': self.checkedin(),
+            'overflow': max(self.overflow(), 0),
+            'max_overflow': self._max_overflow,
+            **stats,
+        }
+
+
+# Connection records currently handed out by any instrumented pool, for the idle-in-transaction watchdog
+checked_out = {}
+
+
+def track_checkout(dbapi_connection, connection_record, connection_proxy):
+    now = time.monotonic()
+    connection_record.info.update(last_activity=now, executing=False, route=None, idle_reported=False)
+    checked_out[id(connection_record)] = connection_record
+
+
+def track_checkin(dbapi_connection, connection_record):
+    checked_out.pop(id(connection_record), None)
+
+
+def count_invalidation(dbapi_connection, connection_record, exception):
+    if 'stats' in connection_record.info:
+        connection_record.info['stats']['invalidations'] += 1
+
+
+def track_activity(connection, *args):
+    connection.info.update(executing=False, last_activity=time.monotonic())
+
+
+def make_engine(url, name):
+    connect_args = {}
+    if DB_STATEMENT_CACHE_SIZE == 0:
+        connect_args['statement_cache_size'] = 0
+    if DB_IDLE_IN_TRANSACTION_TIMEOUT:
+        connect_args['server_settings'] = {
+            'idle_in_transaction_session_timeout': str(DB_IDLE_IN_TRANSACTION_TIMEOUT * 1000)
+        }
+    engine = create_async_engine(
+        f"{url}?prepared_statement_cache_size={DB_STATEMENT_CACHE_SIZE}",
+        poolclass=InstrumentedPool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        pool_logging_name=name,
+        connect_args=connect_args,
+    )
+
+    @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+    def start_activity(connection, *args):
+        connection.info.update(executing=True, last_activity=time.monotonic())
+
+    @event.listens_for(engine.sync_engine, 'handle_error')
+    def stop_activity(exception_context):
+        if exception_context.connection is not None:
+            track_activity(exception_context.connection)
+
+    event.listen(engine.sync_engine, 'after_cursor_execute', track_activity)
+    # Listeners are copied to the new pool when the engine recreates it, and find their pool via the record
+    event.listen(engine.sync_engine.pool, 'checkout', track_checkout)
+    event.listen(engine.sync_engine.pool, 'checkin', track_checkin)
+    event.listen(engine.sync_engine.pool, 'invalidate', count_invalidation)
+    return engine
+
+
+engine = make_engine(DATABASE_URL, 'primary')
 async_session_maker = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+engines = {'primary': engine}
+
+
+@event.listens_for(Session, 'after_begin')
+def remember_route(session, transaction, connection):
+    connection.info['route'] = session.info.get('route')
+
 
 async def init_db():
     async with engine.begin() as conn:
@@ -20,6 +139,28 @@ async def init_db():
         await conn.run_sync(SQLModel.metadata.create_all)
 
 
-async def get_db() -> AsyncGenerator[AsyncSession, None]:
+async def get_db(request: Request) -> AsyncGenerator[AsyncSession, None]:
     async with async_session_maker() as session:
+        session.info['route'] = f"{request.method} {request.url.path}"
         yield session
+
+
+def pool_stats():
+    return {name: engine.sync_engine.pool.stats_snapshot() for name, engine in engines.items()}
+
+
+async def pool_watchdog():
+    """Logs connections that a request keeps checked out without running anything: an open transaction
+    waiting on Telegram, Redis or slow Python code holds a pool slot the whole time."""
+    while True:
+        await asyncio.sleep(max(DB_IDLE_IN_TRANSACTION_WARNING / 2, 1))
+        now = time.monotonic()
+        for record in list(checked_out.values()):
+            info = record.info
+            if info.get('executing') or info.get('idle_reported'):
+                continue
+            idle = now - info.get('last_activity', now)
+            if idle >= DB_IDLE_IN_TRANSACTION_WARNING:
+                info['idle_reported'] = True
+                print(f"Connection from the {info.get('pool_name')} pool idle in transaction for {idle:.1f}s, "
+                      f"held by {info.get('route') or 'a background task'}")
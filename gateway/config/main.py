@@ -1,12 +1,6 @@
 import os
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
 from typing import List
 
-from dadata import Dadata
-
-import requests
 from dotenv import load_dotenv
 from pydantic import BaseModel
 
@@ -18,20 +12,117 @@ DB_NAME = os.environ.get("DB_NAME")
 DB_USER = os.environ.get("DB_USER")
 DB_PASS = os.environ.get("DB_PASS")
 
+# Connections are split between the uvicorn workers so that all of them together stay within
+# DB_MAX_CONNECTIONS; DB_POOL_SIZE and DB_MAX_OVERFLOW override the per-worker share.
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", 1))
+DB_MAX_CONNECTIONS = int(os.environ.get("DB_MAX_CONNECTIONS", 80))
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", max(DB_MAX_CONNECTIONS // WEB_CONCURRENCY * 3 // 4, 1)))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", max(DB_MAX_CONNECTIONS // WEB_CONCURRENCY - DB_POOL_SIZE, 0)))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 30 * 60))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+# Set to 0 behind PgBouncer in transaction mode
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", 500))
+# Connections held by a request without running a statement for this long are logged
+DB_IDLE_IN_TRANSACTION_WARNING = float(os.environ.get("DB_IDLE_IN_TRANSACTION_WARNING", 5))
+# Server-side idle_in_transaction_session_timeout in seconds, 0 leaves the server setting alone
+DB_IDLE_IN_TRANSACTION_TIMEOUT = int(os.environ.get("DB_IDLE_IN_TRANSACTION_TIMEOUT", 0))
+
+# Comma separated host[:port] list of streaming replicas, reached with the primary's credentials
+DB_REPLICA_HOSTS = [host.strip() for host in os.environ.get("DB_REPLICA_HOSTS", "").split(",") if host.strip()]
+DB_REPLICA_MAX_LAG = float(os.environ.get("DB_REPLICA_MAX_LAG", 2))
+DB_REPLICA_CHECK_INTERVAL = float(os.environ.get("DB_REPLICA_CHECK_INTERVAL", 2))
+READ_YOUR_WRITES_WINDOW = int(os.environ.get("READ_YOUR_WRITES_WINDOW", 10))
+
 SECRET_AUTH = os.environ.get("SECRET_AUTH")
 
 SMTP_SERVER = os.environ.get("SMTP_SERVER")
 SMTP_PORT = int(os.environ.get("SMTP_PORT"))
-SMTP_SSL = os.environ.get("SMTP_SSL")
+# Implicit TLS (usually port 465); otherwise the connection is upgraded with STARTTLS
+SMTP_SSL = os.environ.get("SMTP_SSL", "false").lower() in ("1", "true", "yes")
 SMTP_LOGIN = os.environ.get("SMTP_LOGIN")
 SMTP_PASS = os.environ.get("SMTP_PASS")
 
 DADATA_KEY = os.environ.get("DADATA_KEY")
 
+REDIS_URL = os.environ.get("REDIS_URL", "redis://127.0.0.1:6379")
+
+GEOCODER_BACKEND = os.environ.get("GEOCODER_BACKEND", "dadata")
+GEOCODER_STUB_FILE = os.environ.get("GEOCODER_STUB_FILE")
+GEOCODER_TIMEOUT = float(os.environ.get("GEOCODER_TIMEOUT", 3))
+GEOCODER_CACHE_SIZE = int(os.environ.get("GEOCODER_CACHE_SIZE", 10000))
+GEOCODER_CACHE_TTL = int(os.environ.get("GEOCODER_CACHE_TTL", 30 * 24 * 60 * 60))
+GEOCODER_FAILURE_THRESHOLD = int(os.environ.get("GEOCODER_FAILURE_THRESHOLD", 5))
+GEOCODER_RECOVERY_TIME = float(os.environ.get("GEOCODER_RECOVERY_TIME", 30))
+GEOCODING_BATCH = int(os.environ.get("GEOCODING_BATCH", 100))
+GEOCODING_CONCURRENCY = int(os.environ.get("GEOCODING_CONCURRENCY", 8))
+GEOCODING_POLL_INTERVAL = float(os.environ.get("GEOCODING_POLL_INTERVAL", 5))
+GEOCODING_MAX_ATTEMPTS = int(os.environ.get("GEOCODING_MAX_ATTEMPTS", 8))
+GEOCODING_BACKOFF_BASE = float(os.environ.get("GEOCODING_BACKOFF_BASE", 30))
+GEOCODING_BACKOFF_MAX = float(os.environ.get("GEOCODING_BACKOFF_MAX", 6 * 60 * 60))
+# How long a claimed batch stays reserved for the worker that took it; rows of a crashed worker are picked up
+# again after this
+GEOCODING_LEASE = float(os.environ.get("GEOCODING_LEASE", 5 * 60))
+
+CLUSTER_GRID = int(os.environ.get("CLUSTER_GRID", 8))
+CLUSTER_MAX_ZOOM = int(os.environ.get("CLUSTER_MAX_ZOOM", 16))
+CLUSTER_POINTS_THRESHOLD = int(os.environ.get("CLUSTER_POINTS_THRESHOLD", 50))
+CLUSTER_MAX_TILES = int(os.environ.get("CLUSTER_MAX_TILES", 64))
+CLUSTER_CACHE_TTL = int(os.environ.get("CLUSTER_CACHE_TTL", 10 * 60))
+
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", 5 * 60))
+
+USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", 60 * 60))
+USER_CACHE_LOCAL_TTL = int(os.environ.get("USER_CACHE_LOCAL_TTL", 60))
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 10000))
+
+SEARCH_ENGINE = os.environ.get("SEARCH_ENGINE", "sql")
+SEARCH_INDEX_RECONCILE_INTERVAL = int(os.environ.get("SEARCH_INDEX_RECONCILE_INTERVAL", 15 * 60))
+
 MANAGER_EMAIL = os.environ.get("MANAGER_EMAIL")
 
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
 
+NOTIFY_BATCH = int(os.environ.get("NOTIFY_BATCH", 50))
+NOTIFY_MAX_ATTEMPTS = int(os.environ.get("NOTIFY_MAX_ATTEMPTS", 6))
+NOTIFY_BACKOFF_BASE = float(os.environ.get("NOTIFY_BACKOFF_BASE", 2))
+NOTIFY_BACKOFF_MAX = float(os.environ.get("NOTIFY_BACKOFF_MAX", 5 * 60))
+NOTIFY_CLAIM_IDLE = int(os.environ.get("NOTIFY_CLAIM_IDLE", 60))
+NOTIFY_RESULT_TTL = int(os.environ.get("NOTIFY_RESULT_TTL", 24 * 60 * 60))
+# Telegram allows about 30 messages per second overall and one per second to the same chat
+TELEGRAM_GLOBAL_RATE = int(os.environ.get("TELEGRAM_GLOBAL_RATE", 30))
+TELEGRAM_CHAT_INTERVAL = float(os.environ.get("TELEGRAM_CHAT_INTERVAL", 1))
+
+IMAGES_DIR = os.environ.get("IMAGES_DIR", "images")
+IMAGES_URL = os.environ.get("IMAGES_URL", "/images")
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", os.cpu_count() or 1))
+UPLOADS_DIR = os.environ.get("UPLOADS_DIR", "uploads")
+MAX_IMAGE_SIZE = int(os.environ.get("MAX_IMAGE_SIZE", 15 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+IMAGE_GC_INTERVAL = int(os.environ.get("IMAGE_GC_INTERVAL", 10 * 60))
+IMAGE_GC_GRACE = int(os.environ.get("IMAGE_GC_GRACE", 24 * 60 * 60))
+IMAGE_GC_BATCH = int(os.environ.get("IMAGE_GC_BATCH", 500))
+# Resumable uploads left untouched this long are abandoned and removed by the image collector
+UPLOAD_EXPIRY = int(os.environ.get("UPLOAD_EXPIRY", 24 * 60 * 60))
+
+OTP_TTL = int(os.environ.get("OTP_TTL", 10 * 60))
+OTP_COOLDOWN = int(os.environ.get("OTP_COOLDOWN", 60))
+OTP_MAX_ATTEMPTS = int(os.environ.get("OTP_MAX_ATTEMPTS", 5))
+OTP_SUBJECT_PER_HOUR = int(os.environ.get("OTP_SUBJECT_PER_HOUR", 5))
+OTP_IP_PER_HOUR = int(os.environ.get("OTP_IP_PER_HOUR", 30))
+
+# Prometheus metrics are served on this port, away from the public API; 0 turns the exporter off. With several
+# uvicorn workers also set PROMETHEUS_MULTIPROC_DIR to an empty directory so the workers' samples are merged.
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9400))
+
+# What a handler going over its SQL statement budget does: "log" prints a warning with the statement
+# fingerprints, "raise" fails the request (set it when running tests) and "off" skips the counting.
+QUERY_BUDGET_MODE = os.environ.get("QUERY_BUDGET_MODE", "log")
+
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+PASSWORD_WORKERS = int(os.environ.get("PASSWORD_WORKERS", 2))
+PASSWORD_QUEUE_LIMIT = int(os.environ.get("PASSWORD_QUEUE_LIMIT", 32))
+
 
 class Settings(BaseModel):
     authjwt_secret_key: str = SECRET_AUTH
@@ -39,49 +130,3 @@ class Settings(BaseModel):
     authjwt_access_token_expires: int = 60 * 60 * 12  # default 15 minutes
     authjwt_refresh_token_expires: int = 31000000  # default 30 days
 
-
-def send_email(recipient_email, subject, message):
-    msg = MIMEMultipart()
-    msg['From'] = SMTP_LOGIN
-    msg['To'] = recipient_email
-    msg['Subject'] = subject
-    msg.attach(MIMEText(message, 'plain'))
-
-    with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as smtp:
-        smtp.starttls()
-        smtp.login(SMTP_LOGIN, SMTP_PASS)
-        smtp.send_message(msg)
-
-
-def send_tg(telegram_id, message):
-    url = f'https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage'
-    params = {
-        'chat_id': telegram_id,
-        'text': message,
-    }
-    try:
-        response = requests.post(url, params=params)
-        response.raise_for_status()
-        print(f"Сообщение успешно отправлено в Telegram для пользователя с ID {telegram_id}")
-        return 0
-    except requests.exceptions.RequestException as e:
-        print(f"Ошибка при отправке сообщения в Telegram: {e}")
-        return 0
-
-
-def get_address_data(address):
-    dadata = Dadata(DADATA_KEY)
-    try:
-        data = dadata.suggest("address", address)
-        return {
-            'lat': float(data[0]['data']['geo_lat']),
-            'lon': float(data[0]['data']['geo_lon']),
-            'country': data[0]['data']['country'],
-        }
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        return {
-            'lat': None,
-            'lon': None,
-            'country': None,
-        }
@@ -0,0 +1,32 @@
+"""offer sort indexes
+
+Revision ID: 4e1f7a9c2b63
+Revises: c596c416d75c
+Create Date: 2026-10-18 10:12:41.118204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4e1f7a9c2b63'
+down_revision: Union[str, None] = 'c596c416d75c'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Keyset pagination orders by (sort key, id); each index matches one sort so a page is an index range scan.
+    op.create_index('ix_offer_price_id', 'offer', ['price', 'id'])
+    op.create_index('ix_offer_area_id', 'offer', ['area', 'id'])
+    op.create_index('ix_offer_price_per_meter_id', 'offer', [sa.text('(price / area)'), 'id'],
+                    postgresql_where=sa.text('area > 0'))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_offer_price_per_meter_id', table_name='offer')
+    op.drop_index('ix_offer_area_id', table_name='offer')
+    op.drop_index('ix_offer_price_id', table_name='offer')
@@ -0,0 +1,48 @@
+"""image blobs
+
+Revision ID: 7c2d9e5a1f04
+Revises: 4e1f7a9c2b63
+Create Date: 2026-10-18 11:40:03.512871
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7c2d9e5a1f04'
+down_revision: Union[str, None] = '4e1f7a9c2b63'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('image_blob',
+    sa.Column('name', sa.String(length=128), nullable=False),
+    sa.Column('mime', sa.String(length=32), nullable=True),
+    sa.Column('size', sa.Integer(), nullable=True),
+    sa.Column('refs', sa.Integer(), nullable=False, server_default='0'),
+    sa.Column('released_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.create_index('ix_image_blob_released', 'image_blob', ['released_at'], postgresql_where=sa.text('refs = 0'))
+    # Images uploaded before the content-addressed store keep their names; count their references so the
+    # collector treats them like any other blob once the offers using them are gone.
+    op.execute("""
+        INSERT INTO image_blob (name, refs)
+        SELECT regexp_replace(path, '^.*/', ''), count(*)
+        FROM (
+            SELECT img1 AS path FROM offer
+            UNION ALL SELECT img2 FROM offer
+            UNION ALL SELECT img3 FROM offer
+        ) images
+        WHERE path IS NOT NULL
+        GROUP BY 1
+    """)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_image_blob_released', table_name='image_blob')
+    op.drop_table('image_blob')
@@ -0,0 +1,36 @@
+"""offer geocoding queue
+
+Revision ID: a83f0b6d5e27
+Revises: 7c2d9e5a1f04
+Create Date: 2026-10-18 13:05:27.904113
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a83f0b6d5e27'
+down_revision: Union[str, None] = '7c2d9e5a1f04'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('offer', sa.Column('geo_status', sa.String(length=16), nullable=False,
+                                     server_default='pending'))
+    op.add_column('offer', sa.Column('geo_attempts', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('offer', sa.Column('geo_next_attempt_at', sa.DateTime(), nullable=True))
+    op.execute("UPDATE offer SET geo_status = 'resolved' WHERE lat IS NOT NULL AND lon IS NOT NULL")
+    # The queue only ever scans pending rows, which are a tiny fraction of the table
+    op.create_index('ix_offer_geo_pending', 'offer', ['geo_next_attempt_at', 'id'],
+                    postgresql_where=sa.text("geo_status = 'pending'"))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_offer_geo_pending', table_name='offer')
+    op.drop_column('offer', 'geo_next_attempt_at')
+    op.drop_column('offer', 'geo_attempts')
+    op.drop_column('offer', 'geo_status')
@@ -0,0 +1,28 @@
+"""offer location index
+
+Revision ID: b91e4c7d3a58
+Revises: a83f0b6d5e27
+Create Date: 2026-10-18 14:21:50.337046
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b91e4c7d3a58'
+down_revision: Union[str, None] = 'a83f0b6d5e27'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Core Postgres GiST over point(lon, lat), so viewport queries ("point <@ box") are an index scan without
+    # requiring the PostGIS extension. The expression must stay identical to routes.offers.location().
+    op.create_index('ix_offer_location', 'offer', [sa.text('point(lon, lat)')], postgresql_using='gist')
+
+
+def downgrade() -> None:
+    op.drop_index('ix_offer_location', table_name='offer')
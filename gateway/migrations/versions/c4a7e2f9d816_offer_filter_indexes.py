@@ -0,0 +1,56 @@
+"""offer filter indexes
+
+Revision ID: c4a7e2f9d816
+Revises: b91e4c7d3a58
+Create Date: 2026-10-18 15:48:12.660491
+
+Index choices follow the filter combinations the search screens send:
+
+- offer (type, rooms, price): the default search screen sends a type, a set of rooms and a price range.
+  Both "rooms = ANY(...)" and the price range can be index conditions.
+- offer (rooms, price): the same search without a type.
+- offer (type, area): area range searches, which are the second most common range filter.
+- offer (user_id, id): /my, ordered by id for stable output, and the offer.user_id foreign key.
+- appliances_map (offer_id, appliance_id) unique: forbids duplicate mappings and its leading column
+  serves every "appliances of these offers" lookup, so a separate offer_id index would be redundant.
+- appliances_map (appliance_id): "offers having appliance X" and the appliance foreign key on delete.
+
+floor and renovation get no index of their own: each value matches a large share of the table, so they are
+cheaper to apply as filters on top of one of the indexes above.
+
+tests/test_indexes.py seeds a table and checks with EXPLAIN that each query above is planned on its index.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4a7e2f9d816'
+down_revision: Union[str, None] = 'b91e4c7d3a58'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("""
+        DELETE FROM appliances_map a
+        USING appliances_map b
+        WHERE a.offer_id = b.offer_id AND a.appliance_id = b.appliance_id AND a.id > b.id
+    """)
+    op.create_unique_constraint('uq_appliances_map_offer_appliance', 'appliances_map', ['offer_id', 'appliance_id'])
+    op.create_index('ix_appliances_map_appliance_id', 'appliances_map', ['appliance_id'])
+    op.create_index('ix_offer_user_id', 'offer', ['user_id', 'id'])
+    op.create_index('ix_offer_type_rooms_price', 'offer', ['type', 'rooms', 'price'])
+    op.create_index('ix_offer_rooms_price', 'offer', ['rooms', 'price'])
+    op.create_index('ix_offer_type_area', 'offer', ['type', 'area'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_offer_type_area', table_name='offer')
+    op.drop_index('ix_offer_rooms_price', table_name='offer')
+    op.drop_index('ix_offer_type_rooms_price', table_name='offer')
+    op.drop_index('ix_offer_user_id', table_name='offer')
+    op.drop_index('ix_appliances_map_appliance_id', table_name='appliances_map')
+    op.drop_constraint('uq_appliances_map_offer_appliance', 'appliances_map', type_='unique')
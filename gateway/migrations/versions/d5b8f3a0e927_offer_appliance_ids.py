@@ -0,0 +1,39 @@
+"""offer appliance ids
+
+Revision ID: d5b8f3a0e927
+Revises: c4a7e2f9d816
+Create Date: 2026-10-18 16:32:08.221945
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd5b8f3a0e927'
+down_revision: Union[str, None] = 'c4a7e2f9d816'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('offer', sa.Column('appliance_ids', postgresql.ARRAY(sa.Integer()), nullable=False,
+                                     server_default='{}'))
+    op.execute("""
+        UPDATE offer SET appliance_ids = mapped.ids
+        FROM (
+            SELECT offer_id, array_agg(appliance_id ORDER BY appliance_id) AS ids
+            FROM appliances_map
+            GROUP BY offer_id
+        ) mapped
+        WHERE mapped.offer_id = offer.id
+    """)
+    op.create_index('ix_offer_appliance_ids', 'offer', ['appliance_ids'], postgresql_using='gin')
+
+
+def downgrade() -> None:
+    op.drop_index('ix_offer_appliance_ids', table_name='offer')
+    op.drop_column('offer', 'appliance_ids')
@@ -0,0 +1,58 @@
+"""offer text search
+
+Revision ID: e6c1a4d8b392
+Revises: d5b8f3a0e927
+Create Date: 2026-10-18 18:04:36.785130
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e6c1a4d8b392'
+down_revision: Union[str, None] = 'd5b8f3a0e927'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SEARCH_VECTOR = """
+    setweight(to_tsvector('russian', coalesce({row}title, '')), 'A') ||
+    setweight(to_tsvector('english', coalesce({row}title, '')), 'A') ||
+    setweight(to_tsvector('russian', coalesce({row}description, '')), 'B') ||
+    setweight(to_tsvector('english', coalesce({row}description, '')), 'B') ||
+    setweight(to_tsvector('simple', coalesce({row}address, '')), 'C')
+"""
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.add_column('offer', sa.Column('search_vector', postgresql.TSVECTOR(), nullable=True))
+    # Recomputed per row, and only when one of the searchable columns is written
+    op.execute(f"""
+        CREATE FUNCTION offer_search_vector_update() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector := {SEARCH_VECTOR.format(row='NEW.')};
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER offer_search_vector
+        BEFORE INSERT OR UPDATE OF title, description, address ON offer
+        FOR EACH ROW EXECUTE FUNCTION offer_search_vector_update()
+    """)
+    op.execute(f"UPDATE offer SET search_vector = {SEARCH_VECTOR.format(row='')}")
+    op.create_index('ix_offer_search_vector', 'offer', ['search_vector'], postgresql_using='gin')
+    op.create_index('ix_offer_address_trgm', 'offer', ['address'], postgresql_using='gin',
+                    postgresql_ops={'address': 'gin_trgm_ops'})
+
+
+def downgrade() -> None:
+    op.drop_index('ix_offer_address_trgm', table_name='offer')
+    op.drop_index('ix_offer_search_vector', table_name='offer')
+    op.execute("DROP TRIGGER offer_search_vector ON offer")
+    op.execute("DROP FUNCTION offer_search_vector_update()")
+    op.drop_column('offer', 'search_vector')
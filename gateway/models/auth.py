@@ -3,11 +3,8 @@ from datetime import datetime
 from sqlalchemy import Boolean, Enum, Text, DateTime
 from sqlalchemy import Table, Column, Integer, String, ForeignKey, REAL
 from sqlalchemy.orm import relationship
-from passlib.context import CryptContext
-
 from config.database import Base
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from services.passwords import hash_password, verify_password
 
 
 class User(Base):
@@ -22,9 +19,14 @@ class User(Base):
     password: str = Column(String(256), nullable=True)
     status: int = Column(Integer, default=0)
 
-    def get_password_hash(self, password):
-        self.password = pwd_context.hash(password)
-        return pwd_context.hash(password)
+    async def get_password_hash(self, password):
+        self.password = await hash_password(password)
+        return self.password
 
-    def verify_password(self, plain_password):
-        return pwd_context.verify(plain_password, self.password)
+    async def verify_password(self, plain_password):
+        """Checks the password and, when it matches a hash of an outdated cost, replaces the stored hash;
+        the caller commits the session to keep it."""
+        valid, new_hash = await verify_password(plain_password, self.password)
+        if valid and new_hash:
+            self.password = new_hash
+        return valid
@@ -1,8 +1,9 @@
 from datetime import datetime
 
 from sqlalchemy import Boolean, Enum, Text, DateTime
-from sqlalchemy import Table, Column, Integer, String, ForeignKey, REAL
-from sqlalchemy.orm import relationship
+from sqlalchemy import Table, Column, Integer, String, ForeignKey, REAL, UniqueConstraint
+from sqlalchemy.dialects.postgresql import ARRAY, TSVECTOR
+from sqlalchemy.orm import relationship, deferred
 from passlib.context import CryptContext
 
 from config.database import Base
@@ -22,6 +23,9 @@ class Offer(Base):
     country: str = Column(String(64), nullable=True)
     lon: float = Column(REAL, nullable=True)
     lat: float = Column(REAL, nullable=True)
+    geo_status: str = Column(String(16), nullable=False, default='pending')
+    geo_attempts: int = Column(Integer, nullable=False, default=0)
+    geo_next_attempt_at: datetime = Column(DateTime, nullable=True)
     title: str = Column(String(512), nullable=False)
     description: str = Column(String(2048), nullable=False)
     type: str = Column(String(16), nullable=False)
@@ -30,6 +34,21 @@ class Offer(Base):
     area: float = Column(REAL, nullable=False)
     floor: int = Column(Integer, nullable=False)
     renovation: str = Column(String(64), nullable=False)
+    # Denormalized copy of the offer's appliances_map rows, kept in sync by the offer endpoints
+    appliance_ids: list = Column(ARRAY(Integer), nullable=False, default=list, server_default='{}')
+    # Maintained by the offer_search_vector trigger, never written by the application
+    search_vector = deferred(Column(TSVECTOR, nullable=True))
+
+
+class ImageBlob(Base):
+    """Content-addressed image file (named by the sha256 of its bytes) with the number of offer image slots
+    pointing at it. Blobs whose refs dropped to zero are removed by the image garbage collector."""
+    __tablename__ = "image_blob"
+    name: str = Column(String(128), primary_key=True)
+    mime: str = Column(String(32), nullable=True)
+    size: int = Column(Integer, nullable=True)
+    refs: int = Column(Integer, nullable=False, default=0)
+    released_at: datetime = Column(DateTime, nullable=True)
 
 
 class Appliance(Base):
@@ -40,7 +59,7 @@ class Appliance(Base):
 
 class AppliancesMap(Base):
     __tablename__ = "appliances_map"
+    __table_args__ = (UniqueConstraint('offer_id', 'appliance_id', name='uq_appliances_map_offer_appliance'),)
     id: int = Column(Integer, primary_key=True)
     appliance_id: int = Column(ForeignKey('appliance.id'), nullable=False)
     offer_id: int = Column(ForeignKey('offer.id'), nullable=False)
-
@@ -1,22 +1,35 @@
 import datetime
 import os
-import uuid
-from typing import List
+from typing import List, Optional
 
 from fastapi_jwt_auth import AuthJWT
-from sqlalchemy import select, delete, text, and_
+from sqlalchemy import select, delete, update, text, and_, or_, func
 from sqlalchemy.ext.asyncio import AsyncSession
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Header, Response
 import base64
 import aiofiles
 from models.offers import Offer, Appliance, AppliancesMap
 from models.auth import User
-from config.database import get_db
+from config.database import get_db, async_session_maker
+
+from schemas.offers import OfferSchema, OfferCreate, OfferEdit, OfferList, ApplianceSchema, Filters, Map, Sorting, \
+    ImageUploaded, UploadStatus, GeoStatus, ClusterList, Facets
+from services import geocoding_queue, search_index
+from services.appliances import catalogue, invalidate_catalogue
+from services.clusters import clusters_for, filters_key, invalidate_location
+from services.facets import facet_response, sql_facets
+from services.images import image_url, image_variants
+from services.image_store import blob_name, register_blobs, registered_blobs, acquire_images, release_images, \
+    swap_images
+from services.pagination import paginate, split_page
+from services.query_budget import query_budget
+from services.replicas import get_read_db, mark_write
+from services.response_cache import cached_response, invalidate_offer, invalidate_tags, search_tags, offer_tag, \
+    type_tag, ALL_OFFERS_TAG
+from services.search import text_search_condition, text_rank
+from services.uploads import save_image_stream, resolve_image, create_upload, get_upload, append_upload
+from services.users import get_owners
 
-from schemas.offers import OfferSchema, OfferCreate, OfferEdit, OfferList, ApplianceSchema, Filters, Map
-
-from config.main import get_address_data
-from sqlalchemy.orm import selectinload
 
 router = APIRouter(
     prefix="/v1/offer",
@@ -32,6 +45,116 @@ async def image_to_base64(image_path):
         return base64_string
 
 
+async def serialize_offer(offer: Offer, owner: dict, inline_images: bool = False):
+    offer_schema_data = {
+        "id": offer.id,
+        "user_id": offer.user_id,
+        "img1": offer.img1,
+        "img2": offer.img2,
+        "img3": offer.img3,
+        "address": offer.address,
+        "country": offer.country,
+        "lon": offer.lon,
+        "lat": offer.lat,
+        "geo_status": offer.geo_status,
+        "title": offer.title,
+        "description": offer.description,
+        "type": offer.type,
+        "rooms": offer.rooms,
+        "price": offer.price,
+        "area": offer.area,
+        "floor": offer.floor,
+        "renovation": offer.renovation,
+        "appliances": catalogue.resolve(offer.appliance_ids),
+        "owner": owner,
+        # One entry per slot, None where the slot is empty, so images[i] always belongs to img{i + 1}
+        "images": [image_variants(path) for path in (offer.img1, offer.img2, offer.img3)]
+    }
+    for key in ('img1', 'img2', 'img3'):
+        if not offer_schema_data[key]:
+            continue
+        if inline_images:
+            # Compatibility mode for clients that still expect base64 payloads instead of image URLs
+            offer_schema_data[key] = await image_to_base64(offer_schema_data[key])
+        else:
+            offer_schema_data[key] = image_url(offer_schema_data[key])
+    return offer_schema_data
+
+
+async def serialize_offers(session: AsyncSession, offers, inline_images: bool = False):
+    """Owners come from the profile cache, resolved once for the whole page."""
+    owners = await get_owners(session, {offer.user_id for offer in offers})
+    return [await serialize_offer(offer, owners.get(offer.user_id), inline_images) for offer in offers]
+
+
+async def get_offer(session: AsyncSession, offer_id: int):
+    result = await session.execute(
+        select(Offer).where(Offer.id == offer_id).execution_options(
+            populate_existing=True)
+    )
+    return result.scalar()
+
+
+async def get_offers(session: AsyncSession, offer_ids):
+    """Primary-key fetch for ids coming from the in-memory search index, returned in the same order."""
+    if not offer_ids:
+        return []
+    offers = (await session.execute(
+        select(Offer).where(Offer.id.in_(offer_ids))
+    )).scalars().all()
+    by_id = {offer.id: offer for offer in offers}
+    return [by_id[offer_id] for offer_id in offer_ids if offer_id in by_id]
+
+
+def filter_predicates(filters: Filters):
+    """Filter conditions grouped by the field they restrict, so facets can leave out their own field."""
+    predicates = {field: [] for field in ('type', 'price', 'rooms', 'area', 'floor', 'appliance', 'renovation')}
+    if filters.type:
+        predicates['type'].append(Offer.type == filters.type)
+    if filters.price_from is not None:
+        predicates['price'].append(Offer.price >= filters.price_from)
+    if filters.price_to is not None:
+        predicates['price'].append(Offer.price <= filters.price_to)
+    if filters.rooms:
+        predicates['rooms'].append(Offer.rooms.in_(filters.rooms))
+    if filters.area_from is not None:
+        predicates['area'].append(Offer.area >= filters.area_from)
+    if filters.area_to is not None:
+        predicates['area'].append(Offer.area <= filters.area_to)
+    if filters.floor_from is not None:
+        predicates['floor'].append(Offer.floor >= filters.floor_from)
+    if filters.floor_to is not None:
+        predicates['floor'].append(Offer.floor <= filters.floor_to)
+    if filters.appliance:
+        # "Has all of these appliances" is a single containment check on the GIN-indexed array
+        predicates['appliance'].append(Offer.appliance_ids.contains(sorted(set(filters.appliance))))
+    if filters.renovation:
+        predicates['renovation'].append(Offer.renovation.in_(filters.renovation))
+    return predicates
+
+
+def filter_conditions_for(filters: Filters):
+    return [condition for conditions in filter_predicates(filters).values() for condition in conditions]
+
+
+def location():
+    return func.point(Offer.lon, Offer.lat)
+
+
+def viewport_condition(map: Map):
+    """Matches offers inside the map viewport using the GiST index on point(lon, lat). A viewport crossing the
+    antimeridian (min lon east of max lon) is split into two boxes."""
+    lon_min, lon_max = map.coordinates_min.lon, map.coordinates_max.lon
+    lat_min, lat_max = map.coordinates_min.lat, map.coordinates_max.lat
+
+    def box(west, east):
+        return location().op('<@')(func.box(func.point(west, lat_min), func.point(east, lat_max)))
+
+    if lon_min > lon_max:
+        return or_(box(lon_min, 180), box(-180, lon_max))
+    return box(lon_min, lon_max)
+
+
 @router.post("/appliance", tags=['Appliance'], response_model=ApplianceSchema)
 async def create_appliance(name: str, session: AsyncSession = Depends(get_db)):
     # Check if the appliance with the given name already exists
@@ -42,6 +165,7 @@ async def create_appliance(name: str, session: AsyncSession = Depends(get_db)):
     new_appliance = Appliance(name=name)
     session.add(new_appliance)
     await session.commit()
+    await invalidate_catalogue()
     return new_appliance
 
 
@@ -52,36 +176,111 @@ async def delete_appliance(appliance_id: int, session: AsyncSession = Depends(ge
     if not appliance:
         raise HTTPException(status_code=404, detail="Appliance not found")
 
-    # Delete the appliance from the database
+    # Detach it from offers, then delete the appliance from the database
+    offers = (await session.execute(
+        update(Offer).where(Offer.appliance_ids.contains([appliance_id]))
+        .values(appliance_ids=func.array_remove(Offer.appliance_ids, appliance_id))
+        .returning(Offer.id, Offer.lat, Offer.lon)
+    )).all()
+    await session.execute(delete(AppliancesMap).where(AppliancesMap.appliance_id == appliance_id))
     await session.delete(appliance)
     await session.commit()
+    await invalidate_catalogue()
+    await invalidate_tags(ALL_OFFERS_TAG)
+    # The cluster tiles of those offers were cached under filters that may include the appliance
+    for lat, lon in {(offer.lat, offer.lon) for offer in offers}:
+        await invalidate_location(lat, lon)
+    await search_index.offers_changed(*[offer.id for offer in offers])
 
     return appliance
 
 
 @router.get("/appliances", tags=['Appliance'], response_model=List[ApplianceSchema])
-async def get_all_appliances(session: AsyncSession = Depends(get_db)):
-    appliances = await session.execute(select(Appliance))
-    return appliances.scalars().all()
+async def get_all_appliances(response: Response, if_none_match: Optional[str] = Header(None)):
+    etag = f'"{catalogue.version}"'
+    headers = {'ETag': etag, 'Cache-Control': 'public, no-cache'}
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return catalogue.all()
 
 
-@router.post("/", tags=['Offer'], response_model=OfferSchema)
-async def create_offer(data: OfferCreate, Authorize: AuthJWT = Depends(), session: AsyncSession = Depends(get_db)):
-    Authorize.jwt_required()
-    current_user = Authorize.get_jwt_subject()
+def uploaded_image(image_path):
+    return {'image': os.path.basename(image_path), 'url': image_url(image_path)}
+
+
+async def resolve_images(session: AsyncSession, values, current=(None, None, None)):
+    """Turns img1..img3 of a request into stored image paths; empty slots keep the current image. Names have
+    to be originals registered by an upload, never derivatives or other files that happen to be on disk."""
     image_paths = []
-    for idx, img_base64 in enumerate([data.img1, data.img2, data.img3]):
-        if img_base64:
-            img_data = base64.b64decode(img_base64.split(",")[1])
-            ext = img_base64.split(",")[0].split("/")[-1].split(";")[0]
-            filename = f"image_{uuid.uuid4().hex}.{ext}"
-            image_path = os.path.join("images", filename)
-            with open(image_path, "wb") as f:
-                f.write(img_data)
+    inline = []
+    named = set()
+    for value, current_path in zip(values, current):
+        if value and current_path and os.path.basename(value) == blob_name(current_path):
+            # Sent back unchanged, which includes names from before the content-addressed store
+            image_paths.append(current_path)
+        elif value:
+            image_path, uploaded_inline = await resolve_image(value)
+            if uploaded_inline:
+                inline.append(image_path)
+            else:
+                named.add(blob_name(image_path))
             image_paths.append(image_path)
         else:
-            image_paths.append(None)
-    address_data = get_address_data(data.address)
+            image_paths.append(current_path)
+    if inline:
+        # Committed on their own like any other upload, so if the request fails later the collector still
+        # finds the files
+        async with async_session_maker() as upload_session:
+            await register_blobs(upload_session, inline)
+            await upload_session.commit()
+    if named and named - await registered_blobs(session, named):
+        raise HTTPException(status_code=400, detail="image_not_found")
+    return image_paths
+
+
+@router.put("/image", tags=['Image'], response_model=ImageUploaded)
+async def upload_image(request: Request, Authorize: AuthJWT = Depends(), session: AsyncSession = Depends(get_db)):
+    """Single-request upload: the raw image bytes are the request body and are written to disk as they arrive.
+    The returned image name is what img1..img3 of an offer should be set to."""
+    Authorize.jwt_required()
+    image_path = await save_image_stream(request.stream(), request.headers.get('content-length'))
+    await register_blobs(session, [image_path])
+    await session.commit()
+    return uploaded_image(image_path)
+
+
+@router.post("/uploads", tags=['Image'], response_model=UploadStatus)
+async def start_upload(upload_length: int = Header(...), Authorize: AuthJWT = Depends()):
+    Authorize.jwt_required()
+    return await create_upload(upload_length, Authorize.get_jwt_subject())
+
+
+@router.get("/uploads/{upload_id}", tags=['Image'], response_model=UploadStatus)
+async def upload_status(upload_id: str, Authorize: AuthJWT = Depends()):
+    Authorize.jwt_required()
+    return await get_upload(upload_id, Authorize.get_jwt_subject())
+
+
+@router.patch("/uploads/{upload_id}", tags=['Image'], response_model=UploadStatus)
+async def upload_chunk(upload_id: str, request: Request, upload_offset: int = Header(...),
+                       Authorize: AuthJWT = Depends(), session: AsyncSession = Depends(get_db)):
+    Authorize.jwt_required()
+    upload = await append_upload(upload_id, Authorize.get_jwt_subject(), upload_offset, request.stream())
+    if upload.get('image'):
+        await register_blobs(session, [upload['image']])
+        await session.commit()
+        upload.update(uploaded_image(upload['image']))
+    return upload
+
+
+@router.post("/", tags=['Offer'], response_model=OfferSchema)
+@query_budget(7)
+async def create_offer(data: OfferCreate, inline_images: bool = False, Authorize: AuthJWT = Depends(),
+                       session: AsyncSession = Depends(get_db)):
+    Authorize.jwt_required()
+    current_user = Authorize.get_jwt_subject()
+    image_paths = await resolve_images(session, [data.img1, data.img2, data.img3])
     offer_data = data.dict()
     offer_data.update({
         "img1": image_paths[0],
@@ -89,265 +288,187 @@ async def create_offer(data: OfferCreate, Authorize: AuthJWT = Depends(), sessio
         "img3": image_paths[2]
     })
     offer_data.pop('appliances')
-    offer = Offer(**offer_data, user_id=current_user, lat=address_data['lat'], lon=address_data['lon'],
-                  country=address_data['country'])
+    appliance_ids = list(dict.fromkeys(data.appliances))
+    # Coordinates are filled in by the geocoding queue; until then the offer is listed but not on the map
+    offer = Offer(**offer_data, user_id=current_user, geo_status=GeoStatus.pending, appliance_ids=appliance_ids)
     session.add(offer)
+    await session.flush()
+    session.add_all([AppliancesMap(appliance_id=appliance, offer_id=offer.id) for appliance in appliance_ids])
+    await acquire_images(session, image_paths)
     await session.commit()
-    for appliance in data.appliances:
-        appliance_mapping = AppliancesMap(appliance_id=appliance, offer_id=offer.id)
-        session.add(appliance_mapping)
-    await session.commit()
-    offer.appliances = [await session.get(Appliance, i[0].appliance_id) for i in
-                        (await session.execute(select(AppliancesMap).where(AppliancesMap.offer_id == offer.id))).all()]
-    offer.owner = await session.get(User, offer.user_id)
-    if offer.img1:
-        offer.img1 = await image_to_base64(offer.img1)
-    if offer.img2:
-        offer.img2 = await image_to_base64(offer.img2)
-    if offer.img3:
-        offer.img3 = await image_to_base64(offer.img3)
-    return offer
+    await mark_write(current_user)
+    await invalidate_offer(offer.id, offer.type)
+    await search_index.offers_changed(offer.id)
+    geocoding_queue.wake()
+    return (await serialize_offers(session, [await get_offer(session, offer.id)], inline_images))[0]
 
 
 @router.put("/{offer_id}", tags=['Offer'], response_model=OfferSchema)
-def update_offer(offer_id: int, data: OfferEdit, Authorize: AuthJWT = Depends(),
-                 session: AsyncSession = Depends(get_db)):
+@query_budget(11)
+async def update_offer(offer_id: int, data: OfferEdit, inline_images: bool = False, Authorize: AuthJWT = Depends(),
+                       session: AsyncSession = Depends(get_db)):
     Authorize.jwt_required()
     current_user = Authorize.get_jwt_subject()
+    offer = await session.get(Offer, offer_id)
+    if not offer:
+        raise HTTPException(status_code=404, detail="Offer not found")
+    if offer.user_id != current_user:
+        raise HTTPException(status_code=403)
+    old_images = [offer.img1, offer.img2, offer.img3]
+    old_location = offer.lat, offer.lon
+    old_type = offer.type
+    offer.img1, offer.img2, offer.img3 = await resolve_images(session, [data.img1, data.img2, data.img3], old_images)
+    address_changed = data.address != offer.address
+    if address_changed:
+        offer.lat = offer.lon = offer.country = None
+        offer.geo_status, offer.geo_attempts, offer.geo_next_attempt_at = GeoStatus.pending, 0, None
+    for key, value in data.dict(exclude={'img1', 'img2', 'img3', 'appliances'}).items():
+        setattr(offer, key, value)
+    offer.appliance_ids = list(dict.fromkeys(data.appliances))
+    await session.execute(delete(AppliancesMap).where(AppliancesMap.offer_id == offer_id))
+    session.add_all([AppliancesMap(appliance_id=appliance, offer_id=offer_id) for appliance in offer.appliance_ids])
+    await swap_images(session, old_images, [offer.img1, offer.img2, offer.img3])
+    await session.commit()
+    await mark_write(current_user)
+    await invalidate_location(*old_location)
+    await invalidate_offer(offer_id, old_type, offer.type)
+    await search_index.offers_changed(offer_id)
+    if address_changed:
+        geocoding_queue.wake()
+    return (await serialize_offers(session, [await get_offer(session, offer_id)], inline_images))[0]
 
 
 @router.delete("/{offer_id}", tags=['Offer'], response_model=OfferSchema)
+@query_budget(6)
 async def delete_offer(offer_id: int, Authorize: AuthJWT = Depends(), session: AsyncSession = Depends(get_db)):
     Authorize.jwt_required()
     current_user = Authorize.get_jwt_subject()
-    offer = await session.get(Offer, offer_id)
+    offer = await get_offer(session, offer_id)
+    if not offer:
+        raise HTTPException(status_code=404, detail="Offer not found")
     if offer.user_id != current_user:
         raise HTTPException(status_code=403)
+    offer_data = (await serialize_offers(session, [offer]))[0]
+    await session.execute(delete(AppliancesMap).where(AppliancesMap.offer_id == offer_id))
+    await release_images(session, [offer.img1, offer.img2, offer.img3])
     await session.delete(offer)
     await session.commit()
-    return offer
+    await mark_write(current_user)
+    await invalidate_location(offer.lat, offer.lon)
+    await invalidate_offer(offer_id, offer.type)
+    await search_index.offers_changed(offer_id)
+    return offer_data
 
 
 @router.get("/one/{offer_id}", tags=['Offer'], response_model=OfferSchema)
-async def offer(offer_id: int, Authorize: AuthJWT = Depends(), session: AsyncSession = Depends(get_db)):
+@query_budget(2)
+async def offer(offer_id: int, inline_images: bool = False, Authorize: AuthJWT = Depends(),
+                session: AsyncSession = Depends(get_read_db)):
     Authorize.jwt_required()
-    offer = await session.get(Offer, offer_id)
-    if not offer:
-        raise HTTPException(status_code=404, detail="Offer not found")
-    offer.appliances = [await session.get(Appliance, i[0].appliance_id) for i in
-                        (await session.execute(select(AppliancesMap).where(AppliancesMap.offer_id == offer.id))).all()]
-    offer.owner = await session.get(User, offer.user_id)
-    if offer.img1:
-        offer.img1 = await image_to_base64(offer.img1)
-    if offer.img2:
-        offer.img2 = await image_to_base64(offer.img2)
-    if offer.img3:
-        offer.img3 = await image_to_base64(offer.img3)
-    return offer
+
+    async def build():
+        offer = await get_offer(session, offer_id)
+        if not offer:
+            raise HTTPException(status_code=404, detail="Offer not found")
+        return (await serialize_offers(session, [offer], inline_images))[0]
+
+    return await cached_response('one', {'offer_id': offer_id, 'inline_images': inline_images},
+                                 [ALL_OFFERS_TAG, offer_tag(offer_id)], build)
 
 
 @router.get("/all", tags=['Offer'], response_model=OfferList)
-async def all_offers(filters: Filters, Authorize: AuthJWT = Depends(), session: AsyncSession = Depends(get_db)):
+@query_budget(2)
+async def all_offers(filters: Filters, q: Optional[str] = Query(None, min_length=2, max_length=200),
+                     sort: Sorting = Sorting.newest, cursor: Optional[str] = None, limit: int = Query(20, ge=1, le=100),
+                     inline_images: bool = False, Authorize: AuthJWT = Depends(),
+                     session: AsyncSession = Depends(get_read_db)):
+    """q searches title, description and address; combine it with sort=relevance to rank the matches."""
     Authorize.jwt_required()
-    filter_conditions = []
-    if filters.type:
-        filter_conditions.append(Offer.type == filters.type)
-    if filters.price_from is not None:
-        filter_conditions.append(Offer.price >= filters.price_from)
-    if filters.price_to is not None:
-        filter_conditions.append(Offer.price <= filters.price_to)
-    if filters.rooms:
-        filter_conditions.append(Offer.rooms.in_(filters.rooms))
-    if filters.area_from is not None:
-        filter_conditions.append(Offer.area >= filters.area_from)
-    if filters.area_to is not None:
-        filter_conditions.append(Offer.area <= filters.area_to)
-    if filters.floor_from is not None:
-        filter_conditions.append(Offer.floor >= filters.floor_from)
-    if filters.floor_to is not None:
-        filter_conditions.append(Offer.floor <= filters.floor_to)
-    if filters.appliance:
-        for appliance in filters.appliance:
-            filter_conditions.append(Appliance.id == appliance)
-    if filters.renovation:
-        filter_conditions.append(Offer.renovation.in_(filters.renovation))
-    offers = (await session.execute(select(Offer).where(and_(*filter_conditions)))).all()
-    offers_data = []
-    for offer_row in offers:
-        appliances = [
-            await session.get(Appliance, i[0].appliance_id)
-            for i in
-            (await session.execute(select(AppliancesMap).where(AppliancesMap.offer_id == offer_row[0].id))).all()
-        ]
-
-        appliances_data = [{
-            'id': appliance.id,
-            'name': appliance.name
-        } for appliance in appliances]
-
-        owner = await session.get(User, offer_row[0].user_id)
-
-        offer_schema_data = {
-            "id": offer_row[0].id,
-            "img1": offer_row[0].img1,
-            "img2": offer_row[0].img2,
-            "img3": offer_row[0].img3,
-            "address": offer_row[0].address,
-            "title": offer_row[0].title,
-            "description": offer_row[0].description,
-            "type": offer_row[0].type,
-            "rooms": offer_row[0].rooms,
-            "price": offer_row[0].price,
-            "area": offer_row[0].area,
-            "floor": offer_row[0].floor,
-            "renovation": offer_row[0].renovation,
-            "appliances": appliances_data,
-            "owner": {
-                'name': owner.name,
-                'tg_username': owner.tg_username,
-                'phone': owner.phone,
-                'email': owner.email,
-            }
+
+    async def build():
+        if search_index.enabled() and not q and sort != Sorting.relevance:
+            offer_ids, next_cursor = search_index.index.search(filters, sort, cursor, limit)
+            offers = await get_offers(session, offer_ids)
+        else:
+            conditions = filter_conditions_for(filters)
+            if q:
+                conditions.append(text_search_condition(q))
+            query = select(Offer).where(and_(*conditions))
+            rows = (await session.execute(paginate(query, sort, cursor, limit, text_rank(q) if q else None))).all()
+            offers, next_cursor = split_page(rows, sort, limit)
+        return {
+            'offers': await serialize_offers(session, offers, inline_images),
+            'next_cursor': next_cursor
         }
-        if offer_schema_data['img1']:
-            offer_schema_data['img1'] = await image_to_base64(offer_schema_data['img1'])
-        if offer_schema_data['img2']:
-            offer_schema_data['img2'] = await image_to_base64(offer_schema_data['img2'])
-        if offer_schema_data['img3']:
-            offer_schema_data['img3'] = await image_to_base64(offer_schema_data['img3'])
-
-        offers_data.append(offer_schema_data)
-    return {
-        'offers': offers_data
-    }
+
+    params = {'filters': filters, 'q': q, 'sort': sort, 'cursor': cursor, 'limit': limit,
+              'inline_images': inline_images}
+    return await cached_response('all', params, search_tags(filters), build)
+
+
+@router.get("/facets", tags=['Offer'], response_model=Facets)
+@query_budget(1)
+async def offer_facets(filters: Filters, price_step: float = Query(1_000_000, ge=10_000),
+                       area_step: float = Query(10, ge=1), Authorize: AuthJWT = Depends(),
+                       session: AsyncSession = Depends(get_read_db)):
+    """Counts for the search sidebar: offers per type, room count and renovation, and price and area
+    histograms. Every facet is counted under all the filters except its own. The steps have a floor, since
+    a tiny step turns the histograms into one bucket per offer."""
+    Authorize.jwt_required()
+
+    async def build():
+        if search_index.enabled():
+            total, values, buckets = search_index.index.facets(filters, price_step, area_step)
+            return facet_response(total, values, buckets, price_step, area_step)
+        return await sql_facets(session, filter_predicates(filters), price_step, area_step)
+
+    params = {'filters': filters, 'price_step': price_step, 'area_step': area_step}
+    # Type counts span every type, so any offer change has to evict the cached facets
+    return await cached_response('facets', params, [ALL_OFFERS_TAG, type_tag()], build)
 
 
-@router.get("/my", tags=['Offer'], response_model=OfferSchema)
-async def my_offers(Authorize: AuthJWT = Depends(), session: AsyncSession = Depends(get_db)):
+@router.get("/my", tags=['Offer'], response_model=OfferList)
+@query_budget(2)
+async def my_offers(inline_images: bool = False, Authorize: AuthJWT = Depends(),
+                    session: AsyncSession = Depends(get_read_db)):
     Authorize.jwt_required()
     current_user = Authorize.get_jwt_subject()
-    offers = (await session.execute(select(Offer).where(Offer.user_id == current_user))).all()
-    offers_data = []
-    for offer_row in offers:
-        appliances = [
-            await session.get(Appliance, i[0].appliance_id)
-            for i in
-            (await session.execute(select(AppliancesMap).where(AppliancesMap.offer_id == offer_row[0].id))).all()
-        ]
-
-        appliances_data = [{
-            'id': appliance.id,
-            'name': appliance.name
-        } for appliance in appliances]
-
-        owner = await session.get(User, offer_row[0].user_id)
-
-        offer_schema_data = {
-            "id": offer_row[0].id,
-            "img1": offer_row[0].img1,
-            "img2": offer_row[0].img2,
-            "img3": offer_row[0].img3,
-            "address": offer_row[0].address,
-            "title": offer_row[0].title,
-            "description": offer_row[0].description,
-            "type": offer_row[0].type,
-            "rooms": offer_row[0].rooms,
-            "price": offer_row[0].price,
-            "area": offer_row[0].area,
-            "floor": offer_row[0].floor,
-            "renovation": offer_row[0].renovation,
-            "appliances": appliances_data,
-            "owner": {
-                'name': owner.name,
-                'tg_username': owner.tg_username,
-                'phone': owner.phone,
-                'email': owner.email,
-            }
-        }
-        if offer_schema_data['img1']:
-            offer_schema_data['img1'] = await image_to_base64(offer_schema_data['img1'])
-        if offer_schema_data['img2']:
-            offer_schema_data['img2'] = await image_to_base64(offer_schema_data['img2'])
-        if offer_schema_data['img3']:
-            offer_schema_data['img3'] = await image_to_base64(offer_schema_data['img3'])
-
-        offers_data.append(offer_schema_data)
+    offers = (await session.execute(
+        select(Offer).where(Offer.user_id == current_user)
+    )).scalars().all()
     return {
-        'offers': offers_data
+        'offers': await serialize_offers(session, offers, inline_images)
     }
 
 
-@router.get("/map", tags=['Offer'], response_model=OfferSchema)
-async def my_offers(map: Map, filters: Filters, Authorize: AuthJWT = Depends(), session: AsyncSession = Depends(get_db)):
+@router.get("/map", tags=['Offer'], response_model=OfferList)
+@query_budget(2)
+async def map_offers(map: Map, filters: Filters, inline_images: bool = False, Authorize: AuthJWT = Depends(),
+                     session: AsyncSession = Depends(get_read_db)):
     Authorize.jwt_required()
-    filter_conditions = []
-    if filters.type:
-        filter_conditions.append(Offer.type == filters.type)
-    if filters.price_from is not None:
-        filter_conditions.append(Offer.price >= filters.price_from)
-    if filters.price_to is not None:
-        filter_conditions.append(Offer.price <= filters.price_to)
-    if filters.rooms:
-        filter_conditions.append(Offer.rooms.in_(filters.rooms))
-    if filters.area_from is not None:
-        filter_conditions.append(Offer.area >= filters.area_from)
-    if filters.area_to is not None:
-        filter_conditions.append(Offer.area <= filters.area_to)
-    if filters.floor_from is not None:
-        filter_conditions.append(Offer.floor >= filters.floor_from)
-    if filters.floor_to is not None:
-        filter_conditions.append(Offer.floor <= filters.floor_to)
-    if filters.appliance:
-        for appliance in filters.appliance:
-            filter_conditions.append(Appliance.id == appliance)
-    if filters.renovation:
-        filter_conditions.append(Offer.renovation.in_(filters.renovation))
-    offers = (await session.execute(select(Offer).where(and_(*filter_conditions)))).all()
-    offers_data = []
-    for offer_row in offers:
-        appliances = [
-            await session.get(Appliance, i[0].appliance_id)
-            for i in
-            (await session.execute(select(AppliancesMap).where(AppliancesMap.offer_id == offer_row[0].id))).all()
-        ]
-
-        appliances_data = [{
-            'id': appliance.id,
-            'name': appliance.name
-        } for appliance in appliances]
-
-        owner = await session.get(User, offer_row[0].user_id)
-
-        offer_schema_data = {
-            "id": offer_row[0].id,
-            "img1": offer_row[0].img1,
-            "img2": offer_row[0].img2,
-            "img3": offer_row[0].img3,
-            "address": offer_row[0].address,
-            "title": offer_row[0].title,
-            "description": offer_row[0].description,
-            "type": offer_row[0].type,
-            "rooms": offer_row[0].rooms,
-            "price": offer_row[0].price,
-            "area": offer_row[0].area,
-            "floor": offer_row[0].floor,
-            "renovation": offer_row[0].renovation,
-            "appliances": appliances_data,
-            "owner": {
-                'name': owner.name,
-                'tg_username': owner.tg_username,
-                'phone': owner.phone,
-                'email': owner.email,
-            }
+
+    async def build():
+        if search_index.enabled():
+            offers = await get_offers(session, search_index.index.viewport(filters, map))
+        else:
+            offers = (await session.execute(
+                select(Offer).where(Offer.geo_status == GeoStatus.resolved, viewport_condition(map),
+                                    *filter_conditions_for(filters))
+            )).scalars().all()
+        return {
+            'offers': await serialize_offers(session, offers, inline_images)
         }
-        if offer_schema_data['img1']:
-            offer_schema_data['img1'] = await image_to_base64(offer_schema_data['img1'])
-        if offer_schema_data['img2']:
-            offer_schema_data['img2'] = await image_to_base64(offer_schema_data['img2'])
-        if offer_schema_data['img3']:
-            offer_schema_data['img3'] = await image_to_base64(offer_schema_data['img3'])
-
-        offers_data.append(offer_schema_data)
-    return {
-        'offers': offers_data
-    }
+
+    params = {'map': map, 'filters': filters, 'inline_images': inline_images}
+    return await cached_response('map', params, search_tags(filters), build)
+
+
+@router.get("/map/clusters", tags=['Offer'], response_model=ClusterList)
+@query_budget(2)
+async def map_clusters(map: Map, filters: Filters, zoom: int = Query(..., ge=0, le=22), Authorize: AuthJWT = Depends(),
+                       session: AsyncSession = Depends(get_read_db)):
+    """Aggregated offers for a viewport: one entry per occupied grid cell with its count, centroid and price
+    range. Tiles holding few offers, and every tile from CLUSTER_MAX_ZOOM on, return individual points."""
+    Authorize.jwt_required()
+    conditions = [Offer.geo_status == GeoStatus.resolved, *filter_conditions_for(filters)]
+    return await clusters_for(session, map, zoom, conditions, filters_key(filters))
@@ -30,6 +30,21 @@ class Renovation(str, Enum):
     designer = 'Designer renovation'
 
 
+class GeoStatus(str, Enum):
+    pending = 'pending'
+    resolved = 'resolved'
+    failed = 'failed'
+
+
+class Sorting(str, Enum):
+    newest = 'newest'
+    price_asc = 'price_asc'
+    price_desc = 'price_desc'
+    area = 'area'
+    price_per_meter = 'price_per_meter'
+    relevance = 'relevance'
+
+
 class ApplianceSchema(BaseModel):
     id: int
     name: str
@@ -43,6 +58,31 @@ class Owner(BaseModel):
     email: Optional[str] = None
 
 
+class ImageVariant(BaseModel):
+    src: str
+    webp: Optional[str] = None
+    avif: Optional[str] = None
+
+
+class OfferImage(BaseModel):
+    thumb: ImageVariant
+    card: ImageVariant
+    full: ImageVariant
+
+
+class ImageUploaded(BaseModel):
+    image: str
+    url: str
+
+
+class UploadStatus(BaseModel):
+    upload_id: str
+    offset: int
+    length: int
+    image: Optional[str] = None
+    url: Optional[str] = None
+
+
 class OfferCreate(BaseModel):
     img1: str
     img2: Optional[str] = None
@@ -84,6 +124,7 @@ class OfferSchema(BaseModel):
     country: Optional[str] = None
     lon: Optional[float] = None
     lat: Optional[float] = None
+    geo_status: Optional[GeoStatus] = None
     title: str
     description: str
     type: Types
@@ -94,10 +135,12 @@ class OfferSchema(BaseModel):
     renovation: Renovation
     appliances: List[ApplianceSchema]
     owner: Owner
+    images: List[Optional[OfferImage]] = []
 
 
 class OfferList(BaseModel):
     offers: List[OfferSchema]
+    next_cursor: Optional[str] = None
 
 
 class Filters(BaseModel):
@@ -121,3 +164,44 @@ class Coordinates(BaseModel):
 class Map(BaseModel):
     coordinates_min: Coordinates
     coordinates_max: Coordinates
+
+
+class Cluster(BaseModel):
+    count: int
+    lat: float
+    lon: float
+    price_min: float
+    price_max: float
+
+
+class MapPoint(BaseModel):
+    id: int
+    lat: float
+    lon: float
+    price: float
+
+
+class ClusterList(BaseModel):
+    zoom: int
+    clusters: List[Cluster]
+    points: List[MapPoint]
+
+
+class FacetCount(BaseModel):
+    value: str
+    count: int
+
+
+class HistogramBucket(BaseModel):
+    start: float
+    end: float
+    count: int
+
+
+class Facets(BaseModel):
+    total: int
+    type: List[FacetCount]
+    rooms: List[FacetCount]
+    renovation: List[FacetCount]
+    price: List[HistogramBucket]
+    area: List[HistogramBucket]
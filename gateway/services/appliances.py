@@ -0,0 +1,50 @@
+import hashlib
+import json
+
+from sqlalchemy import select
+
+from config.database import async_session_maker
+from models.offers import Appliance
+from services import events
+
+CHANGED_EVENT = 'appliances.changed'
+
+
+class ApplianceCatalogue:
+    """In-memory copy of the appliance table. It is tiny and changes rarely, so every worker keeps it
+    loaded and offers resolve appliance names from it instead of joining the table."""
+
+    def __init__(self):
+        self.items = {}
+        self.version = None
+
+    async def load(self):
+        async with async_session_maker() as session:
+            appliances = (await session.execute(select(Appliance).order_by(Appliance.id))).scalars().all()
+        items = {appliance.id: appliance.name for appliance in appliances}
+        # Derived from the content so every worker reports the same version for the same data
+        self.version = hashlib.sha1(json.dumps(sorted(items.items())).encode()).hexdigest()[:16]
+        self.items = items
+
+    def all(self):
+        return [{'id': appliance_id, 'name': name} for appliance_id, name in self.items.items()]
+
+    def resolve(self, appliance_ids):
+        return [{'id': appliance_id, 'name': self.items[appliance_id]} for appliance_id in appliance_ids
+                if appliance_id in self.items]
+
+
+catalogue = ApplianceCatalogue()
+
+
+async def reload_catalogue(payload=None):
+    await catalogue.load()
+
+
+async def invalidate_catalogue():
+    """Called after the appliance table changed: reloads this worker right away and tells the others."""
+    await catalogue.load()
+    await events.publish(CHANGED_EVENT, {'version': catalogue.version})
+
+
+events.subscribe(CHANGED_EVENT, reload_catalogue)
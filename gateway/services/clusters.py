@@ -0,0 +1,146 @@
+import hashlib
+import json
+import math
+
+from sqlalchemy import select, func, or_
+
+from config.main import CLUSTER_GRID, CLUSTER_MAX_ZOOM, CLUSTER_POINTS_THRESHOLD, CLUSTER_MAX_TILES, \
+    CLUSTER_CACHE_TTL
+from models.offers import Offer
+from services.replicas import repeat_after_lag
+
+redis = None
+
+
+def init_cluster_cache(redis_pool):
+    global redis
+    redis = redis_pool
+
+
+# Tiles split the world into 2^zoom x 2^zoom cells of equal degrees; each tile is aggregated on a
+# CLUSTER_GRID x CLUSTER_GRID grid and cached on its own, so panning the map only computes the new tiles.
+def tile_size(zoom):
+    return 360 / 2 ** zoom, 180 / 2 ** zoom
+
+
+def tile_of(lat, lon, zoom):
+    width, height = tile_size(zoom)
+    last = 2 ** zoom - 1
+    return min(int((lon + 180) // width), last), min(int((lat + 90) // height), last)
+
+
+def tiles_for(map, zoom):
+    """Tiles covering the viewport. Zoom is lowered until the viewport fits in CLUSTER_MAX_TILES tiles."""
+    while True:
+        x_min, y_min = tile_of(map.coordinates_min.lat, map.coordinates_min.lon, zoom)
+        x_max, y_max = tile_of(map.coordinates_max.lat, map.coordinates_max.lon, zoom)
+        xs = list(range(x_min, x_max + 1)) if x_min <= x_max else \
+            list(range(x_min, 2 ** zoom)) + list(range(0, x_max + 1))
+        ys = range(min(y_min, y_max), max(y_min, y_max) + 1)
+        if len(xs) * len(ys) <= CLUSTER_MAX_TILES or zoom == 0:
+            return zoom, [(x, y) for x in xs for y in ys]
+        zoom -= 1
+
+
+def tile_box(x, y, zoom):
+    width, height = tile_size(zoom)
+    west, south = x * width - 180, y * height - 90
+    return func.box(func.point(west, south), func.point(west + width, south + height))
+
+
+def filters_key(filters):
+    data = filters.dict()
+    for key, value in data.items():
+        if isinstance(value, list):
+            data[key] = sorted(value)
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def tile_cache_key(zoom, x, y, key):
+    return f"clusters:{zoom}:{x}:{y}:{key}"
+
+
+def tile_index_key(zoom, x, y):
+    return f"clusters:tile:{zoom}:{x}:{y}"
+
+
+async def compute_tiles(session, zoom, tiles, conditions):
+    location = func.point(Offer.lon, Offer.lat)
+    in_tiles = or_(*[location.op('<@')(tile_box(x, y, zoom)) for x, y in tiles])
+    width, height = tile_size(zoom)
+    cell_x = func.floor((Offer.lon + 180) / (width / CLUSTER_GRID)).label('cell_x')
+    cell_y = func.floor((Offer.lat + 90) / (height / CLUSTER_GRID)).label('cell_y')
+    rows = (await session.execute(
+        select(cell_x, cell_y, func.count(Offer.id), func.min(Offer.id), func.avg(Offer.lat), func.avg(Offer.lon),
+               func.min(Offer.price), func.max(Offer.price))
+        .where(in_tiles, *conditions).group_by(cell_x, cell_y)
+    )).all()
+    results = {tile: {'count': 0, 'clusters': [], 'points': []} for tile in tiles}
+    for cx, cy, count, first_id, lat, lon, price_min, price_max in rows:
+        tile = results.get((int(cx) // CLUSTER_GRID, int(cy) // CLUSTER_GRID))
+        if tile is None:
+            # Offers exactly on the shared edge of two tiles are counted once, by the tile east/north of it
+            continue
+        tile['count'] += count
+        if count == 1:
+            tile['points'].append({'id': first_id, 'lat': lat, 'lon': lon, 'price': price_min})
+        else:
+            tile['clusters'].append({'count': count, 'lat': lat, 'lon': lon, 'price_min': price_min,
+                                     'price_max': price_max})
+    point_tiles = {tile for tile, result in results.items()
+                   if result['clusters'] and (zoom >= CLUSTER_MAX_ZOOM or result['count'] <= CLUSTER_POINTS_THRESHOLD)}
+    if point_tiles:
+        rows = (await session.execute(
+            select(Offer.id, Offer.lat, Offer.lon, Offer.price)
+            .where(or_(*[location.op('<@')(tile_box(x, y, zoom)) for x, y in point_tiles]), *conditions)
+        )).all()
+        for tile in point_tiles:
+            results[tile]['clusters'], results[tile]['points'] = [], []
+        for offer_id, lat, lon, price in rows:
+            tile = tile_of(lat, lon, zoom)
+            if tile in point_tiles:
+                results[tile]['points'].append({'id': offer_id, 'lat': lat, 'lon': lon, 'price': price})
+    return results
+
+
+async def clusters_for(session, map, zoom, conditions, key):
+    zoom, tiles = tiles_for(map, min(zoom, CLUSTER_MAX_ZOOM))
+    results = {}
+    if redis is not None:
+        cached = await redis.mget([tile_cache_key(zoom, x, y, key) for x, y in tiles])
+        results = {tile: json.loads(value) for tile, value in zip(tiles, cached) if value}
+    missing = [tile for tile in tiles if tile not in results]
+    if missing:
+        computed = await compute_tiles(session, zoom, missing, conditions)
+        results.update(computed)
+        if redis is not None:
+            async with redis.pipeline(transaction=False) as pipe:
+                for (x, y), result in computed.items():
+                    pipe.set(tile_cache_key(zoom, x, y, key), json.dumps(result), ex=CLUSTER_CACHE_TTL)
+                    pipe.sadd(tile_index_key(zoom, x, y), tile_cache_key(zoom, x, y, key))
+                    pipe.expire(tile_index_key(zoom, x, y), CLUSTER_CACHE_TTL)
+                await pipe.execute()
+    return {
+        'zoom': zoom,
+        'clusters': [cluster for tile in tiles for cluster in results[tile]['clusters']],
+        'points': [point for tile in tiles for point in results[tile]['points']],
+    }
+
+
+async def invalidate_location(lat, lon):
+    """Drops the cached aggregates of every tile containing the location, at every zoom level, for all
+    filter combinations. Called whenever an offer with coordinates appears, changes or disappears."""
+    if redis is None or lat is None or lon is None or math.isnan(lat) or math.isnan(lon):
+        return
+    await evict_location(lat, lon)
+    repeat_after_lag(evict_location, lat, lon)
+
+
+async def evict_location(lat, lon):
+    index_keys = [tile_index_key(zoom, *tile_of(lat, lon, zoom)) for zoom in range(CLUSTER_MAX_ZOOM + 1)]
+    async with redis.pipeline(transaction=False) as pipe:
+        for index_key in index_keys:
+            pipe.smembers(index_key)
+        members = await pipe.execute()
+    keys = [key for group in members for key in group]
+    await redis.delete(*keys, *index_keys)
@@ -0,0 +1,49 @@
+import asyncio
+import json
+
+# Cross-worker notifications: every uvicorn worker subscribes to one Redis pub/sub channel and dispatches
+# the events it receives to the handlers registered for them, including events it published itself.
+CHANNEL = 'gateway:events'
+
+redis = None
+handlers = {}
+
+
+def init_events(redis_pool):
+    global redis
+    redis = redis_pool
+
+
+def subscribe(event, handler):
+    handlers.setdefault(event, []).append(handler)
+
+
+async def publish(event, payload=None):
+    if redis is None:
+        return
+    await redis.publish(CHANNEL, json.dumps({'event': event, 'payload': payload}))
+
+
+async def dispatch(event, payload):
+    for handler in handlers.get(event, []):
+        try:
+            await handler(payload)
+        except Exception as e:
+            print(f"Event handler for {event} failed: {e!r}")
+
+
+async def listen():
+    while True:
+        try:
+            async with redis.pubsub() as pubsub:
+                await pubsub.subscribe(CHANNEL)
+                async for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    data = json.loads(message['data'])
+                    await dispatch(data['event'], data.get('payload'))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Event listener disconnected: {e!r}")
+            await asyncio.sleep(1)
@@ -0,0 +1,77 @@
+from sqlalchemy import select, func, and_, true, tuple_, literal_column
+
+from models.offers import Offer
+from schemas.offers import Types, Rooms, Renovation
+
+# Facets follow the usual e-commerce rule: the counts of a facet apply every filter except the facet's own,
+# so selecting "2 rooms" still shows how many offers the other room counts would give.
+VALUE_FACETS = {
+    'type': (Offer.type, Types),
+    'rooms': (Offer.rooms, Rooms),
+    'renovation': (Offer.renovation, Renovation),
+}
+HISTOGRAM_FACETS = ('price', 'area')
+FACETS = (*VALUE_FACETS, *HISTOGRAM_FACETS)
+
+
+def value_counts(enum, counts):
+    return [{'value': item.value, 'count': counts.get(item.value, 0)} for item in enum]
+
+
+def histogram(counts, step):
+    return [{'start': bucket * step, 'end': (bucket + 1) * step, 'count': count}
+            for bucket, count in sorted(counts.items())]
+
+
+def facet_response(total, values, buckets, price_step, area_step):
+    response = {'total': total}
+    for facet, (_, enum) in VALUE_FACETS.items():
+        response[facet] = value_counts(enum, values[facet])
+    response['price'] = histogram(buckets['price'], price_step)
+    response['area'] = histogram(buckets['area'], area_step)
+    return response
+
+
+async def sql_facets(session, predicates, price_step, area_step):
+    """All facets in one statement: GROUPING SETS produce one group per facet value plus the grand total,
+    and each facet count uses a FILTER with every predicate except the facet's own."""
+    base = [condition for field, conditions in predicates.items() if field not in FACETS for condition in conditions]
+
+    def excluding(facet):
+        return and_(true(), *[condition for field, conditions in predicates.items()
+                              if field in FACETS and field != facet for condition in conditions])
+
+    # Steps are inlined so the bucket expressions in SELECT and GROUP BY are textually identical
+    dimensions = {
+        'type': Offer.type,
+        'rooms': Offer.rooms,
+        'renovation': Offer.renovation,
+        'price': func.floor(Offer.price / literal_column(repr(float(price_step)))),
+        'area': func.floor(Offer.area / literal_column(repr(float(area_step)))),
+    }
+    columns = []
+    for facet, dimension in dimensions.items():
+        columns += [dimension.label(facet), func.grouping(dimension).label(f'{facet}_grouping'),
+                    func.count().filter(excluding(facet)).label(f'{facet}_count')]
+    columns.append(func.count().filter(excluding(None)).label('total'))
+    rows = (await session.execute(
+        select(*columns).where(*base)
+        .group_by(func.grouping_sets(*[tuple_(dimension) for dimension in dimensions.values()], tuple_()))
+    )).all()
+    total = 0
+    values = {facet: {} for facet in VALUE_FACETS}
+    buckets = {facet: {} for facet in HISTOGRAM_FACETS}
+    for row in rows:
+        grouped = [facet for facet in dimensions if getattr(row, f'{facet}_grouping') == 0]
+        if not grouped:
+            total = row.total
+            continue
+        facet = grouped[0]
+        count = getattr(row, f'{facet}_count')
+        if not count:
+            continue
+        if facet in VALUE_FACETS:
+            values[facet][getattr(row, facet)] = count
+        else:
+            buckets[facet][int(getattr(row, facet))] = count
+    return facet_response(total, values, buckets, price_step, area_step)
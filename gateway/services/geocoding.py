@@ -0,0 +1,209 @@
+import asyncio
+import json
+import re
+import time
+from collections import OrderedDict
+
+import httpx
+
+from config.main import DADATA_KEY, GEOCODER_BACKEND, GEOCODER_STUB_FILE, GEOCODER_TIMEOUT, GEOCODER_CACHE_SIZE, \
+    GEOCODER_CACHE_TTL, GEOCODER_FAILURE_THRESHOLD, GEOCODER_RECOVERY_TIME
+from services.metrics import InstrumentedTransport
+
+EMPTY_RESULT = {
+    'lat': None,
+    'lon': None,
+    'country': None,
+}
+
+# Apartment/office numbers do not change the coordinates, so new units in an already known building share
+# the cache entry of the building.
+UNIT_PATTERN = re.compile(
+    r'[,\s]*\b(кв|квартира|оф|офис|пом|помещение|apt|apartment|flat|office|unit)\b\.?\s*[\w/-]+\s*$'
+)
+SEPARATORS_PATTERN = re.compile(r'[\s,.;]+')
+
+
+def normalize_address(address: str):
+    address = address.lower().replace('ё', 'е').strip()
+    address = UNIT_PATTERN.sub('', address)
+    return SEPARATORS_PATTERN.sub(' ', address).strip()
+
+
+class LRUCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+
+    def get(self, key):
+        if key not in self.items:
+            return None
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def set(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Stops calling the backend for recovery_time seconds after failure_threshold consecutive failures,
+    then lets a single trial call through to decide whether to close again."""
+
+    def __init__(self, failure_threshold, recovery_time):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at >= self.recovery_time:
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+class DadataBackend:
+    url = 'https://suggestions.dadata.ru/suggestions/api/4_1/rs/suggest/address'
+
+    def __init__(self, token, timeout):
+        self.client = httpx.AsyncClient(
+            headers={'Authorization': f'Token {token}', 'Accept': 'application/json'},
+            timeout=timeout,
+            transport=InstrumentedTransport(
+                'dadata', limits=httpx.Limits(max_connections=20, max_keepalive_connections=10)),
+        )
+
+    async def lookup(self, address):
+        response = await self.client.post(self.url, json={'query': address, 'count': 1})
+        response.raise_for_status()
+        suggestions = response.json()['suggestions']
+        if not suggestions or suggestions[0]['data']['geo_lat'] is None:
+            return EMPTY_RESULT
+        data = suggestions[0]['data']
+        return {
+            'lat': float(data['geo_lat']),
+            'lon': float(data['geo_lon']),
+            'country': data['country'],
+        }
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class StubBackend:
+    """Local backend for tests and benchmarks: answers from a JSON file mapping normalized addresses to
+    results, and with an empty result for anything else."""
+
+    def __init__(self, path=None):
+        self.results = {}
+        if path:
+            with open(path) as f:
+                self.results = {normalize_address(address): result for address, result in json.load(f).items()}
+
+    async def lookup(self, address):
+        return self.results.get(normalize_address(address), EMPTY_RESULT)
+
+    async def aclose(self):
+        pass
+
+
+BACKENDS = {
+    'dadata': lambda: DadataBackend(DADATA_KEY, GEOCODER_TIMEOUT),
+    'stub': lambda: StubBackend(GEOCODER_STUB_FILE),
+}
+
+
+class Geocoder:
+    def __init__(self, backend, redis=None):
+        self.backend = backend
+        self.redis = redis
+        self.cache = LRUCache(GEOCODER_CACHE_SIZE)
+        self.breaker = CircuitBreaker(GEOCODER_FAILURE_THRESHOLD, GEOCODER_RECOVERY_TIME)
+        self.in_flight = {}
+
+    async def geocode(self, address):
+        key = normalize_address(address)
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+        if key in self.in_flight:
+            return await asyncio.shield(self.in_flight[key])
+        task = asyncio.ensure_future(self.resolve(key, address))
+        self.in_flight[key] = task
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if task.done():
+                self.in_flight.pop(key, None)
+            else:
+                task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+
+    async def resolve(self, key, address):
+        redis_key = f"geo:{key}"
+        if self.redis is not None:
+            try:
+                cached = await self.redis.get(redis_key)
+            except Exception as e:
+                print(f"Geocoding cache is unavailable: {e}")
+                cached = None
+            if cached:
+                result = json.loads(cached)
+                self.cache.set(key, result)
+                return result
+        result = await self.lookup(address)
+        if result['lat'] is None:
+            # Misses and failures are not cached, so the address is retried on the next request
+            return result
+        self.cache.set(key, result)
+        if self.redis is not None:
+            try:
+                await self.redis.set(redis_key, json.dumps(result), ex=GEOCODER_CACHE_TTL)
+            except Exception as e:
+                print(f"Geocoding cache is unavailable: {e}")
+        return result
+
+    async def lookup(self, address):
+        if not self.breaker.allow():
+            raise CircuitOpen()
+        try:
+            result = await self.backend.lookup(address)
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return result
+
+    async def aclose(self):
+        await self.backend.aclose()
+
+
+geocoder = None
+
+
+def init_geocoder(redis=None):
+    global geocoder
+    geocoder = Geocoder(BACKENDS[GEOCODER_BACKEND](), redis)
+    return geocoder
+
+
+async def close_geocoder():
+    if geocoder is not None:
+        await geocoder.aclose()
@@ -0,0 +1,250 @@
+import argparse
+import asyncio
+import datetime
+
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.redis import RedisBackend
+from sqlalchemy import REAL, select, update, func, cast, or_, literal_column, tuple_
+
+from config.database import async_session_maker
+from config.main import GEOCODING_BATCH, GEOCODING_CONCURRENCY, GEOCODING_POLL_INTERVAL, GEOCODING_MAX_ATTEMPTS, \
+    GEOCODING_BACKOFF_BASE, GEOCODING_BACKOFF_MAX, GEOCODING_LEASE
+from models.offers import Offer
+from schemas.offers import GeoStatus
+from services import events, geocoding
+from services.clusters import invalidate_location, init_cluster_cache
+from services.geocoding import normalize_address, CircuitOpen
+from services.response_cache import invalidate_offer
+from services.search_index import offers_changed
+
+wake_event = asyncio.Event()
+
+
+def wake():
+    """Called after an offer is stored as pending so the worker picks it up without waiting for the next poll."""
+    wake_event.set()
+
+
+def backoff(attempts):
+    return datetime.timedelta(seconds=min(GEOCODING_BACKOFF_BASE * 2 ** (attempts - 1), GEOCODING_BACKOFF_MAX))
+
+
+async def geocode_all(addresses):
+    semaphore = asyncio.Semaphore(GEOCODING_CONCURRENCY)
+
+    async def geocode(address):
+        async with semaphore:
+            return await geocoding.geocoder.geocode(address)
+
+    return await asyncio.gather(*[geocode(address) for address in addresses], return_exceptions=True)
+
+
+def claimed_unchanged(rows):
+    """Matches the claimed rows that still carry the address they were claimed with: an offer edited while
+    its batch was at the geocoder has been queued again and must not get the old address' coordinates."""
+    return tuple_(Offer.id, Offer.address).in_([(row.id, row.address) for row in rows])
+
+
+async def claim_batch(now):
+    """Leases a batch of due offers in a short transaction of its own. SKIP LOCKED lets every uvicorn worker
+    run the queue, and the lease keeps the rows away from the others while the geocoder is called."""
+    due = (
+        select(Offer.id)
+        .where(Offer.geo_status == literal_column(f"'{GeoStatus.pending.value}'"),
+               or_(Offer.geo_next_attempt_at.is_(None), Offer.geo_next_attempt_at <= now))
+        .order_by(Offer.id).limit(GEOCODING_BATCH).with_for_update(skip_locked=True)
+    )
+    async with async_session_maker() as session:
+        rows = (await session.execute(
+            update(Offer).where(Offer.id.in_(due))
+            .values(geo_next_attempt_at=now + datetime.timedelta(seconds=GEOCODING_LEASE))
+            .returning(Offer.id, Offer.type, Offer.address, Offer.geo_attempts)
+            .execution_options(synchronize_session=False)
+        )).all()
+        await session.commit()
+    return sorted(rows, key=lambda row: row.id)
+
+
+async def process_batch():
+    """Resolves one batch of pending offers; offers sharing a building are looked up once per batch. No
+    transaction is open while the geocoder runs, so the rows are not locked against edits meanwhile."""
+    now = datetime.datetime.utcnow()
+    rows = await claim_batch(now)
+    if not rows:
+        return 0
+    groups = {}
+    for row in rows:
+        groups.setdefault(normalize_address(row.address), []).append(row)
+    results = await geocode_all([group[0].address for group in groups.values()])
+    resolved = []
+    processed = 0
+    async with async_session_maker() as session:
+        for group, result in zip(groups.values(), results):
+            if isinstance(result, CircuitOpen):
+                # The geocoder is down; release the lease instead of burning the rows' attempts
+                await session.execute(update(Offer).where(claimed_unchanged(group)).values(
+                    geo_next_attempt_at=None,
+                ).execution_options(synchronize_session=False))
+                continue
+            processed += len(group)
+            if not isinstance(result, BaseException) and result['lat'] is not None:
+                updated = (await session.execute(update(Offer).where(claimed_unchanged(group)).values(
+                    lat=result['lat'], lon=result['lon'], country=result['country'],
+                    geo_status=GeoStatus.resolved, geo_next_attempt_at=None,
+                ).returning(Offer.id).execution_options(synchronize_session=False))).scalars().all()
+                if updated:
+                    resolved.append((result['lat'], result['lon'], [row for row in group if row.id in updated]))
+                continue
+            if isinstance(result, BaseException):
+                print(f"Geocoding of {group[0].address!r} failed: {result!r}")
+            for attempts in {row.geo_attempts + 1 for row in group}:
+                failed = attempts >= GEOCODING_MAX_ATTEMPTS
+                await session.execute(update(Offer).where(
+                    claimed_unchanged([row for row in group if row.geo_attempts + 1 == attempts])
+                ).values(
+                    geo_attempts=attempts,
+                    geo_status=GeoStatus.failed if failed else GeoStatus.pending,
+                    geo_next_attempt_at=None if failed else now + backoff(attempts),
+                ).execution_options(synchronize_session=False))
+        await session.commit()
+    for lat, lon, group in resolved:
+        await invalidate_location(lat, lon)
+        for row in group:
+            await invalidate_offer(row.id, row.type)
+        await offers_changed(*[row.id for row in group])
+    return processed
+
+
+async def geocoding_worker():
+    while True:
+        try:
+            processed = await process_batch()
+        except Exception as e:
+            print(f"Geocoding queue failed: {e!r}")
+            processed = 0
+        if processed == GEOCODING_BATCH:
+            continue
+        wake_event.clear()
+        try:
+            await asyncio.wait_for(wake_event.wait(), GEOCODING_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def pending_count():
+    async with async_session_maker() as session:
+        return await session.scalar(select(func.count()).select_from(Offer).where(
+            Offer.geo_status == GeoStatus.pending))
+
+
+async def drain_queue():
+    """Processes the queue until no pending offer is left. Offers waiting for a retry, leased by a worker or
+    released while the circuit is open are still pending, so the loop waits for them instead of stopping."""
+    total = 0
+    while True:
+        processed = await process_batch()
+        if processed:
+            total += processed
+            print(f"{total} offers processed")
+            continue
+        remaining = await pending_count()
+        if not remaining:
+            return
+        print(f"{remaining} offers waiting to be geocoded")
+        await asyncio.sleep(GEOCODING_POLL_INTERVAL)
+
+
+async def refresh_resolved():
+    """Looks up the resolved offers again in id order. They stay resolved with their current coordinates until
+    the new ones are stored, so they never drop off the map; an offer whose lookup fails is left as it was."""
+    last_id = 0
+    total = 0
+    while True:
+        async with async_session_maker() as session:
+            rows = (await session.execute(
+                select(Offer.id, Offer.type, Offer.address, Offer.lat, Offer.lon)
+                .where(Offer.geo_status == GeoStatus.resolved, Offer.id > last_id)
+                .order_by(Offer.id).limit(GEOCODING_BATCH)
+            )).all()
+        if not rows:
+            return
+        groups = {}
+        for row in rows:
+            groups.setdefault(normalize_address(row.address), []).append(row)
+        results = await geocode_all([group[0].address for group in groups.values()])
+        if any(isinstance(result, CircuitOpen) for result in results):
+            print("Geocoder unavailable, retrying the batch")
+            await asyncio.sleep(GEOCODING_POLL_INTERVAL)
+            continue
+        moved = []
+        async with async_session_maker() as session:
+            for group, result in zip(groups.values(), results):
+                if isinstance(result, BaseException) or result['lat'] is None:
+                    print(f"Geocoding of {group[0].address!r} failed, keeping its coordinates: {result!r}")
+                    continue
+                # An offer edited meanwhile is pending again and gets its coordinates from the queue
+                updated = (await session.execute(update(Offer).where(
+                    claimed_unchanged(group), Offer.geo_status == GeoStatus.resolved,
+                    # In the column's precision, or every offer would count as moved
+                    or_(Offer.lat != cast(result['lat'], REAL), Offer.lon != cast(result['lon'], REAL))
+                ).values(
+                    lat=result['lat'], lon=result['lon'], country=result['country'],
+                ).returning(Offer.id).execution_options(synchronize_session=False))).scalars().all()
+                moved.extend((result['lat'], result['lon'], row) for row in group if row.id in updated)
+            await session.commit()
+        for lat, lon, row in moved:
+            await invalidate_location(row.lat, row.lon)
+            await invalidate_location(lat, lon)
+            await invalidate_offer(row.id, row.type)
+        await offers_changed(*[row.id for _, _, row in moved])
+        total += len(rows)
+        last_id = rows[-1].id
+        print(f"{total} resolved offers checked, {len(moved)} moved in this batch")
+
+
+async def regeocode(scope):
+    """Admin entry point for bulk imports: puts the selected offers back into the queue and drains it. With
+    'all' the resolved offers are looked up again in place rather than queued, so they stay on the map."""
+    conditions = {
+        'missing': [Offer.lat.is_(None)],
+        'failed': [Offer.geo_status == GeoStatus.failed],
+        'all': [Offer.geo_status != GeoStatus.resolved],
+    }[scope]
+    async with async_session_maker() as session:
+        result = await session.execute(update(Offer).where(*conditions).values(
+            geo_status=GeoStatus.pending, geo_attempts=0, geo_next_attempt_at=None,
+        ))
+        await session.commit()
+    print(f"{result.rowcount} offers queued for geocoding")
+    await drain_queue()
+    if scope == 'all':
+        await refresh_resolved()
+    async with async_session_maker() as session:
+        failed = await session.scalar(select(func.count()).select_from(Offer).where(
+            Offer.geo_status == GeoStatus.failed))
+    print(f"Done, {failed} offers could not be geocoded")
+
+
+async def main():
+    from redis import asyncio as aioredis
+    from config.main import REDIS_URL
+
+    parser = argparse.ArgumentParser(description='Re-geocode offers in bulk')
+    parser.add_argument('scope', choices=['missing', 'failed', 'all'])
+    args = parser.parse_args()
+    redis = aioredis.from_url(REDIS_URL, encoding="utf8", decode_responses=True)
+    # The same backends as the application, so the offers geocoded here are evicted from its caches and
+    # refreshed in its search index
+    FastAPICache.init(RedisBackend(redis), prefix="fastapi-cache")
+    events.init_events(redis)
+    geocoding.init_geocoder(redis)
+    init_cluster_cache(redis)
+    try:
+        await regeocode(args.scope)
+    finally:
+        await geocoding.close_geocoder()
+        await redis.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,225 @@
+import asyncio
+import datetime
+import os
+import time
+from collections import Counter
+
+import aiofiles.os
+from fastapi import HTTPException
+from sqlalchemy import select, delete, update, func, case
+from sqlalchemy.dialects.postgresql import insert
+
+from config.database import async_session_maker
+from config.main import IMAGES_DIR, UPLOADS_DIR, IMAGE_GC_INTERVAL, IMAGE_GC_GRACE, IMAGE_GC_BATCH, UPLOAD_EXPIRY
+from models.offers import ImageBlob
+from services.images import DERIVATIVE_SIZES, DERIVATIVE_FORMATS, UndecodableImage, derivative_path, decode_image, \
+    generate_derivatives
+
+MIME_TYPES = {
+    'jpg': 'image/jpeg',
+    'png': 'image/png',
+    'webp': 'image/webp',
+}
+
+
+def blob_name(image_path):
+    return os.path.basename(image_path)
+
+
+def staged_path(image_path):
+    """Where a finished upload waits until register_blobs moves it into IMAGES_DIR."""
+    return os.path.join(UPLOADS_DIR, blob_name(image_path))
+
+
+async def blob_rows(names, refs=None, directory=IMAGES_DIR):
+    rows = []
+    for name in names:
+        try:
+            size = (await aiofiles.os.stat(os.path.join(directory, name))).st_size
+        except FileNotFoundError:
+            size = None
+        rows.append({
+            'name': name,
+            'mime': MIME_TYPES.get(os.path.splitext(name)[1].lstrip('.')),
+            'size': size,
+            'refs': refs[name] if refs else 0,
+            'released_at': None if refs else datetime.datetime.utcnow(),
+        })
+    return rows
+
+
+async def place_blob(image_path):
+    """Moves a staged upload into the store and renders its derivatives. Returns whether the original was
+    placed by this call. The staged file is decoded before it is published, and an undecodable body is
+    rejected with 415 without leaving any of its files behind."""
+    staged = staged_path(image_path)
+    placed = False
+    try:
+        if await aiofiles.os.path.isfile(image_path):
+            await discard_file(staged)
+        else:
+            await decode_image(staged)
+            await aiofiles.os.replace(staged, image_path)
+            placed = True
+        await generate_derivatives(image_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=400, detail="image_not_found")
+    except BaseException as e:
+        await discard_file(staged)
+        if placed:
+            await remove_blob_files(blob_name(image_path))
+        if isinstance(e, UndecodableImage):
+            print(f"Rejected an undecodable image: {e}")
+            raise HTTPException(status_code=415, detail="unsupported_image_type")
+        raise
+    return placed
+
+
+async def register_blobs(session, image_paths):
+    """Records freshly uploaded blobs with no references yet; if no offer picks them up within the grace
+    period the garbage collector removes them again. The upsert waits for a collector holding the rows, and
+    the staged files are only moved into the store after it, so a collection can never delete the files of a
+    blob that was just registered again."""
+    image_paths = list(dict.fromkeys(image_paths))
+    if not image_paths:
+        return
+    statement = insert(ImageBlob).values(await blob_rows([blob_name(path) for path in image_paths],
+                                                         directory=UPLOADS_DIR))
+    await session.execute(statement.on_conflict_do_update(
+        index_elements=[ImageBlob.name],
+        set_={'released_at': case((ImageBlob.refs == 0, statement.excluded.released_at), else_=None)},
+    ))
+    placed = []
+    try:
+        for image_path in image_paths:
+            if await place_blob(image_path):
+                placed.append(image_path)
+    except BaseException:
+        # The rows roll back with the request, so nothing would ever collect the files placed before
+        for image_path in placed:
+            await remove_blob_files(blob_name(image_path))
+        for image_path in image_paths:
+            await discard_file(staged_path(image_path))
+        raise
+
+
+async def registered_blobs(session, names):
+    return set((await session.execute(select(ImageBlob.name).where(ImageBlob.name.in_(set(names))))).scalars())
+
+
+async def acquire_images(session, image_paths):
+    refs = Counter(blob_name(path) for path in image_paths if path)
+    if not refs:
+        return
+    statement = insert(ImageBlob).values(await blob_rows(refs, refs))
+    await session.execute(statement.on_conflict_do_update(
+        index_elements=[ImageBlob.name],
+        set_={'refs': ImageBlob.refs + statement.excluded.refs, 'released_at': None},
+    ))
+    # The row is locked now, but a collection that committed just before may have taken the files with it
+    for name in refs:
+        if not await aiofiles.os.path.isfile(os.path.join(IMAGES_DIR, name)):
+            raise HTTPException(status_code=400, detail="image_not_found")
+
+
+async def release_images(session, image_paths):
+    refs = Counter(blob_name(path) for path in image_paths if path)
+    for count, names in invert(refs).items():
+        await session.execute(
+            update(ImageBlob).where(ImageBlob.name.in_(names)).values(
+                refs=func.greatest(ImageBlob.refs - count, 0),
+                released_at=case((ImageBlob.refs <= count, func.timezone('utc', func.now())), else_=None),
+            ).execution_options(synchronize_session=False)
+        )
+
+
+async def swap_images(session, old_paths, new_paths):
+    old = Counter(blob_name(path) for path in old_paths if path)
+    new = Counter(blob_name(path) for path in new_paths if path)
+    await acquire_images(session, list((new - old).elements()))
+    await release_images(session, list((old - new).elements()))
+
+
+def invert(refs: Counter):
+    by_count = {}
+    for name, count in refs.items():
+        by_count.setdefault(count, []).append(name)
+    return by_count
+
+
+async def discard_file(path):
+    try:
+        await aiofiles.os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def remove_blob_files(name):
+    image_path = os.path.join(IMAGES_DIR, name)
+    paths = [image_path] + [derivative_path(image_path, size, fmt) for size in DERIVATIVE_SIZES
+                            for fmt in DERIVATIVE_FORMATS]
+    for path in paths:
+        await discard_file(path)
+
+
+async def collect_garbage():
+    """Deletes one batch of unreferenced blobs. Rows are locked with SKIP LOCKED so several workers can
+    collect at the same time. The files are removed before the deletion commits: until then an upload or offer
+    needing the same blob waits on the row lock, and afterwards it inserts a new row and checks the files."""
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=IMAGE_GC_GRACE)
+    async with async_session_maker() as session:
+        names = (await session.execute(
+            select(ImageBlob.name).where(ImageBlob.refs == 0, ImageBlob.released_at < cutoff)
+            .limit(IMAGE_GC_BATCH).with_for_update(skip_locked=True)
+        )).scalars().all()
+        if not names:
+            return 0
+        deleted = (await session.execute(
+            delete(ImageBlob).where(ImageBlob.name.in_(names), ImageBlob.refs == 0).returning(ImageBlob.name)
+        )).scalars().all()
+        for name in deleted:
+            await remove_blob_files(name)
+        await session.commit()
+    return len(names)
+
+
+def stale_uploads(cutoff):
+    """Files in UPLOADS_DIR are grouped by the name before the first dot, so the .part, .json and .lock of a
+    resumable upload expire together, once the newest of them is older than the cutoff."""
+    files = {}
+    newest = {}
+    try:
+        entries = list(os.scandir(UPLOADS_DIR))
+    except FileNotFoundError:
+        return []
+    for entry in entries:
+        try:
+            if not entry.is_file():
+                continue
+            modified = entry.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        stem = entry.name.split('.', 1)[0]
+        files.setdefault(stem, []).append(entry.path)
+        newest[stem] = max(newest.get(stem, modified), modified)
+    return [path for stem, paths in files.items() if newest[stem] < cutoff for path in paths]
+
+
+async def expire_uploads():
+    """Removes what abandoned uploads left behind: resumable uploads that were never finished, and the
+    files of requests that died before their image was registered."""
+    paths = await asyncio.to_thread(stale_uploads, time.time() - UPLOAD_EXPIRY)
+    for path in paths:
+        await discard_file(path)
+    return len(paths)
+
+
+async def image_gc_worker():
+    while True:
+        try:
+            while await collect_garbage() == IMAGE_GC_BATCH:
+                pass
+            await expire_uploads()
+        except Exception as e:
+            print(f"Image garbage collection failed: {e}")
+        await asyncio.sleep(IMAGE_GC_INTERVAL)
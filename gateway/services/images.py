@@ -0,0 +1,183 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from starlette.staticfiles import StaticFiles
+
+from config.main import IMAGES_DIR, IMAGES_URL, IMAGE_WORKERS
+
+# Stored image names are derived from their content and never rewritten, so clients may cache them forever.
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+class ImmutableStaticFiles(StaticFiles):
+    """StaticFiles already answers If-None-Match/If-Modified-Since with 304, sends ETag/Last-Modified and
+    serves Range requests through FileResponse (which hands the path to the server for sendfile when it
+    supports the pathsend extension). The only thing missing is a long-lived Cache-Control."""
+
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        return response
+
+
+def image_url(image_path):
+    if not image_path:
+        return None
+    return f"{IMAGES_URL.rstrip('/')}/{os.path.basename(image_path)}"
+
+
+# Longest side in pixels for every derivative; "thumb" is for list rows and map popups, "card" for offer cards
+# and galleries, "full" for the offer page.
+DERIVATIVE_SIZES = {
+    'thumb': 320,
+    'card': 800,
+    'full': 1920,
+}
+DERIVATIVE_QUALITY = {
+    'jpg': 82,
+    'webp': 80,
+    'avif': 60,
+}
+
+
+def _avif_supported():
+    try:
+        from PIL import features
+        return bool(features.check('avif'))
+    except Exception:
+        return False
+
+
+DERIVATIVE_FORMATS = ['jpg', 'webp'] + (['avif'] if _avif_supported() else [])
+
+_executor = None
+
+
+class UndecodableImage(Exception):
+    """The file has the signature of a supported format but Pillow cannot decode it."""
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def derivative_path(image_path, size, fmt):
+    stem = os.path.splitext(image_path)[0]
+    return f"{stem}_{size}.{fmt}"
+
+
+def load_image(image_path):
+    """Opens and fully decodes the file, so a corrupt body fails here rather than halfway through a resize."""
+    from PIL import Image
+
+    try:
+        image = Image.open(image_path)
+        image.load()
+    except FileNotFoundError:
+        raise
+    except (OSError, ValueError, SyntaxError, EOFError, Image.DecompressionBombError) as e:
+        # UnidentifiedImageError and truncated data are OSErrors; damaged headers surface as the others
+        raise UndecodableImage(f"{image_path}: {e!r}")
+    return image
+
+
+def check_image(image_path):
+    """Runs in a worker process; raises UndecodableImage for a file Pillow cannot decode."""
+    load_image(image_path).close()
+
+
+def render_derivatives(image_path):
+    """Runs in a worker process: decodes the original once and writes every size/format pair next to it.
+    Raises UndecodableImage when the original cannot be decoded; nothing is left behind on any failure."""
+    paths = [derivative_path(image_path, size, fmt) for size in DERIVATIVE_SIZES for fmt in DERIVATIVE_FORMATS]
+    if all(os.path.exists(path) for path in paths):
+        # Content-addressed originals are shared between offers, so the derivatives may already be there
+        return paths
+    try:
+        return write_derivatives(image_path)
+    except BaseException:
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        raise
+
+
+def write_derivatives(image_path):
+    from PIL import Image, ImageOps
+
+    paths = []
+    with load_image(image_path) as original:
+        original = ImageOps.exif_transpose(original)
+        if original.mode not in ('RGB', 'RGBA'):
+            original = original.convert('RGBA' if 'A' in original.getbands() else 'RGB')
+        for size, max_side in DERIVATIVE_SIZES.items():
+            resized = original.copy()
+            resized.thumbnail((max_side, max_side), Image.LANCZOS)
+            for fmt in DERIVATIVE_FORMATS:
+                path = derivative_path(image_path, size, fmt)
+                if fmt == 'jpg':
+                    resized.convert('RGB').save(path, 'JPEG', quality=DERIVATIVE_QUALITY[fmt], optimize=True,
+                                                progressive=True)
+                else:
+                    resized.save(path, fmt.upper(), quality=DERIVATIVE_QUALITY[fmt])
+                paths.append(path)
+    return paths
+
+
+async def decode_image(image_path):
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(get_executor(), check_image, image_path)
+
+
+async def generate_derivatives(image_path):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), render_derivatives, image_path)
+
+
+def image_variants(image_path):
+    if not image_path:
+        return None
+    variants = {}
+    for size in DERIVATIVE_SIZES:
+        urls = {fmt: image_url(derivative_path(image_path, size, fmt)) for fmt in DERIVATIVE_FORMATS}
+        variants[size] = {
+            'src': urls['jpg'],
+            'webp': urls.get('webp'),
+            'avif': urls.get('avif'),
+        }
+    return variants
+
+
+def backfill_derivatives():
+    """Generates derivatives for originals uploaded before the pipeline existed."""
+    suffixes = tuple(f"_{size}.{fmt}" for size in DERIVATIVE_SIZES for fmt in DERIVATIVE_FORMATS)
+    originals = [os.path.join(IMAGES_DIR, name) for name in os.listdir(IMAGES_DIR) if not name.endswith(suffixes)]
+    pending = [path for path in originals if os.path.isfile(path) and not os.path.exists(
+        derivative_path(path, 'thumb', 'jpg'))]
+    with ProcessPoolExecutor(max_workers=IMAGE_WORKERS) as executor:
+        futures = [(path, executor.submit(render_derivatives, path)) for path in pending]
+        for path, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                # One broken original must not stop the rest of the backfill
+                print(f"Derivatives failed for {path}: {e!r}")
+                continue
+            print(f"Derivatives generated for {path}")
+
+
+if __name__ == '__main__':
+    backfill_derivatives()
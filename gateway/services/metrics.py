@@ -0,0 +1,161 @@
+import contextvars
+import os
+import time
+
+import httpx
+from prometheus_client import Counter, Histogram, CollectorRegistry, start_http_server, multiprocess
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+from sqlalchemy import event
+
+from config.main import METRICS_PORT
+
+# Work done on behalf of the current request. The middleware puts a fresh dict here, and the SQLAlchemy, Redis
+# and httpx hooks add to it; background tasks run without one and are only counted in the global metrics.
+request_stats = contextvars.ContextVar('request_stats', default=None)
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 6, 8, 12, 16, 25, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+REQUEST_LATENCY = Histogram('gateway_request_duration_seconds', 'Request latency until the last body byte',
+                            ['method', 'route', 'status'], buckets=LATENCY_BUCKETS)
+RESPONSE_BYTES = Histogram('gateway_response_bytes', 'Response body size', ['method', 'route'],
+                           buckets=SIZE_BUCKETS)
+REQUEST_DB_STATEMENTS = Histogram('gateway_request_db_statements', 'SQL statements executed per request',
+                                  ['method', 'route'], buckets=COUNT_BUCKETS)
+REQUEST_DB_SECONDS = Histogram('gateway_request_db_seconds', 'Time spent in SQL statements per request',
+                               ['method', 'route'], buckets=LATENCY_BUCKETS)
+REQUEST_REDIS_CALLS = Histogram('gateway_request_redis_calls', 'Redis round trips per request',
+                                ['method', 'route'], buckets=COUNT_BUCKETS)
+REQUEST_EXTERNAL_CALLS = Histogram('gateway_request_external_calls', 'Calls to external services per request',
+                                   ['method', 'route'], buckets=COUNT_BUCKETS)
+DB_STATEMENTS = Counter('gateway_db_statements', 'SQL statements executed', ['pool'])
+REDIS_CALLS = Counter('gateway_redis_calls', 'Redis round trips')
+EXTERNAL_LATENCY = Histogram('gateway_external_duration_seconds', 'Latency of calls to external services',
+                             ['service', 'outcome'], buckets=LATENCY_BUCKETS)
+QUERY_BUDGET_EXCEEDED = Counter('gateway_query_budget_exceeded', 'Requests that ran more SQL statements than '
+                                'their handler allows', ['handler'])
+
+
+def new_request_stats():
+    return {'db_statements': 0, 'db_seconds': 0.0, 'redis_calls': 0, 'external_calls': 0}
+
+
+def add(key, value=1):
+    stats = request_stats.get()
+    if stats is not None:
+        stats[key] += value
+
+
+def observe_request(method, route, status, elapsed, size, stats):
+    REQUEST_LATENCY.labels(method, route, status).observe(elapsed)
+    RESPONSE_BYTES.labels(method, route).observe(size)
+    REQUEST_DB_STATEMENTS.labels(method, route).observe(stats['db_statements'])
+    REQUEST_DB_SECONDS.labels(method, route).observe(stats['db_seconds'])
+    REQUEST_REDIS_CALLS.labels(method, route).observe(stats['redis_calls'])
+    REQUEST_EXTERNAL_CALLS.labels(method, route).observe(stats['external_calls'])
+
+
+def observe_external(service, outcome, elapsed):
+    EXTERNAL_LATENCY.labels(service, outcome).observe(elapsed)
+    add('external_calls')
+
+
+def instrument_engine(engine):
+    pool = engine.sync_engine.pool.logging_name or 'default'
+
+    @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+    def start_statement(connection, cursor, statement, parameters, context, executemany):
+        connection.info['statement_started'] = time.perf_counter()
+
+    @event.listens_for(engine.sync_engine, 'after_cursor_execute')
+    def end_statement(connection, cursor, statement, parameters, context, executemany):
+        DB_STATEMENTS.labels(pool).inc()
+        add('db_statements')
+        add('db_seconds', time.perf_counter() - connection.info.pop('statement_started', time.perf_counter()))
+
+
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error=True):
+        # A pipeline is a single round trip however many commands it carries
+        REDIS_CALLS.inc()
+        add('redis_calls')
+        return await super().execute(raise_on_error)
+
+
+class InstrumentedRedis(Redis):
+    """Redis client that counts round trips; scripts and the FastAPICache backend go through it too."""
+
+    async def execute_command(self, *args, **options):
+        REDIS_CALLS.inc()
+        add('redis_calls')
+        return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class InstrumentedTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, service, **kwargs):
+        super().__init__(**kwargs)
+        self.service = service
+
+    async def handle_async_request(self, request):
+        started = time.perf_counter()
+        try:
+            response = await super().handle_async_request(request)
+        except httpx.HTTPError as e:
+            observe_external(self.service, type(e).__name__, time.perf_counter() - started)
+            raise
+        observe_external(self.service, str(response.status_code), time.perf_counter() - started)
+        return response
+
+
+def route_of(request):
+    route = request.scope.get('route')
+    return getattr(route, 'path', None) or 'unmatched'
+
+
+async def metrics_middleware(request, call_next):
+    stats = new_request_stats()
+    request_stats.set(stats)
+    started = time.perf_counter()
+    response = await call_next(request)
+    body_iterator = response.body_iterator
+
+    async def measured_body():
+        size = 0
+        try:
+            async for chunk in body_iterator:
+                size += len(chunk)
+                yield chunk
+        finally:
+            observe_request(request.method, route_of(request), str(response.status_code),
+                            time.perf_counter() - started, size, stats)
+
+    response.body_iterator = measured_body()
+    return response
+
+
+def start_exporter():
+    """Serves /metrics on METRICS_PORT. Under several workers only the first one to bind the port serves it,
+    and in multiprocess mode it reports the samples of every worker."""
+    if not METRICS_PORT:
+        return
+    registry = None
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    try:
+        if registry is None:
+            start_http_server(METRICS_PORT)
+        else:
+            start_http_server(METRICS_PORT, registry=registry)
+    except OSError:
+        pass
+
+
+def stop_exporter():
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(os.getpid())
@@ -0,0 +1,307 @@
+import asyncio
+import json
+import os
+import socket
+import time
+import uuid
+from email.message import EmailMessage
+
+import aiosmtplib
+import httpx
+from redis.exceptions import ResponseError
+
+from config.main import TELEGRAM_TOKEN, SMTP_SERVER, SMTP_PORT, SMTP_SSL, SMTP_LOGIN, SMTP_PASS, NOTIFY_BATCH, \
+    NOTIFY_MAX_ATTEMPTS, NOTIFY_BACKOFF_BASE, NOTIFY_BACKOFF_MAX, NOTIFY_CLAIM_IDLE, NOTIFY_RESULT_TTL, \
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_INTERVAL
+from services.metrics import InstrumentedTransport, observe_external
+
+# Handlers only append to the outbox stream; every uvicorn worker runs a consumer of one group, so each
+# message is delivered by exactly one of them. Failed messages wait in a sorted set scored by their due
+# time and are put back on the stream when it comes.
+STREAM = 'notifications:outbox'
+GROUP = 'notifiers'
+RETRY = 'notifications:retry'
+STATS = 'notifications:stats'
+CONSUMER = f"{socket.gethostname()}-{os.getpid()}"
+
+# Moves due retries back to the stream in one step, so a crash can neither lose nor duplicate them
+REQUEUE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, payload in ipairs(due) do
+    redis.call('ZREM', KEYS[1], payload)
+    local args = {KEYS[2], '*'}
+    for key, value in pairs(cjson.decode(payload)) do
+        table.insert(args, key)
+        table.insert(args, tostring(value))
+    end
+    redis.call('XADD', unpack(args))
+end
+return #due
+"""
+
+# KEYS: global counter of the current second, chat key; ARGV: global rate, chat interval in milliseconds.
+# Returns 0 when the message may go out now, the milliseconds until the chat may receive again, or -1 when
+# the global limit of this second is used up. The chat is checked first and nothing is counted for a
+# message that has to wait, so deferred messages do not eat into the global rate.
+TELEGRAM_SLOT_SCRIPT = """
+local chat_wait = redis.call('PTTL', KEYS[2])
+if chat_wait > 0 then
+    return chat_wait
+end
+if tonumber(redis.call('GET', KEYS[1]) or '0') >= tonumber(ARGV[1]) then
+    return -1
+end
+redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], 2)
+redis.call('SET', KEYS[2], 1, 'PX', ARGV[2])
+return 0
+"""
+
+redis = None
+requeue = None
+telegram_slot = None
+telegram = None
+mailer = None
+
+
+class DeliveryRejected(Exception):
+    """The recipient or the message was refused; retrying will not help."""
+
+
+class RetryLater(Exception):
+    def __init__(self, delay):
+        super().__init__(f"retry after {delay}s")
+        self.delay = delay
+
+
+class TelegramClient:
+    def __init__(self, token):
+        self.url = f'https://api.telegram.org/bot{token}/sendMessage'
+        self.client = httpx.AsyncClient(
+            timeout=10,
+            transport=InstrumentedTransport(
+                'telegram', limits=httpx.Limits(max_connections=20, max_keepalive_connections=10)),
+        )
+
+    async def send(self, chat_id, text):
+        response = await self.client.post(self.url, json={'chat_id': chat_id, 'text': text})
+        if response.status_code == 429:
+            raise RetryLater(response.json().get('parameters', {}).get('retry_after', 1))
+        if 400 <= response.status_code < 500:
+            raise DeliveryRejected(response.json().get('description', response.text))
+        response.raise_for_status()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class Mailer:
+    """One SMTP connection per worker, opened on first use and reopened when the server drops it."""
+
+    def __init__(self):
+        self.smtp = None
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        smtp = aiosmtplib.SMTP(hostname=SMTP_SERVER, port=SMTP_PORT, use_tls=SMTP_SSL,
+                               start_tls=not SMTP_SSL, timeout=30)
+        await smtp.connect()
+        await smtp.login(SMTP_LOGIN, SMTP_PASS)
+        self.smtp = smtp
+
+    async def send(self, recipient, subject, text):
+        message = EmailMessage()
+        message['From'] = SMTP_LOGIN
+        message['To'] = recipient
+        message['Subject'] = subject
+        message.set_content(text)
+        async with self.lock:
+            for attempt in range(2):
+                if self.smtp is None or not self.smtp.is_connected:
+                    await self.connect()
+                started = time.perf_counter()
+                try:
+                    await self.smtp.send_message(message)
+                    observe_external('smtp', 'sent', time.perf_counter() - started)
+                    return
+                except aiosmtplib.SMTPRecipientsRefused as e:
+                    observe_external('smtp', 'refused', time.perf_counter() - started)
+                    raise DeliveryRejected(str(e))
+                except aiosmtplib.SMTPServerDisconnected:
+                    observe_external('smtp', 'disconnected', time.perf_counter() - started)
+                    self.smtp = None
+                    if attempt:
+                        raise
+
+    async def aclose(self):
+        if self.smtp is not None and self.smtp.is_connected:
+            try:
+                await self.smtp.quit()
+            except aiosmtplib.SMTPException:
+                pass
+        self.smtp = None
+
+
+def init_notifications(redis_pool):
+    global redis, requeue, telegram_slot, telegram, mailer
+    redis = redis_pool
+    requeue = redis.register_script(REQUEUE_SCRIPT)
+    telegram_slot = redis.register_script(TELEGRAM_SLOT_SCRIPT)
+    telegram = TelegramClient(TELEGRAM_TOKEN)
+    mailer = Mailer()
+
+
+async def close_notifications():
+    if telegram is not None:
+        await telegram.aclose()
+    if mailer is not None:
+        await mailer.aclose()
+
+
+def result_key(notification_id):
+    return f"notifications:result:{notification_id}"
+
+
+def record(pipe, message, status, error=None):
+    pipe.hset(result_key(message['id']), mapping={
+        'status': status,
+        'channel': message['channel'],
+        'attempts': message['attempts'],
+        'error': error or '',
+        'updated_at': int(time.time()),
+    })
+    pipe.expire(result_key(message['id']), NOTIFY_RESULT_TTL)
+    pipe.hincrby(STATS, status)
+
+
+async def enqueue(channel, recipient, text, subject=None):
+    """Queues a message and returns its id; delivery results are kept under that id for NOTIFY_RESULT_TTL."""
+    message = {
+        'id': uuid.uuid4().hex,
+        'channel': channel,
+        'recipient': str(recipient),
+        'subject': subject or '',
+        'text': text,
+        'attempts': 0,
+    }
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.xadd(STREAM, message)
+        record(pipe, message, 'queued')
+        await pipe.execute()
+    return message['id']
+
+
+async def enqueue_telegram(chat_id, text):
+    return await enqueue('telegram', chat_id, text)
+
+
+async def enqueue_email(recipient, subject, text):
+    return await enqueue('email', recipient, text, subject)
+
+
+def backoff(attempts):
+    return min(NOTIFY_BACKOFF_BASE * 2 ** (attempts - 1), NOTIFY_BACKOFF_MAX)
+
+
+async def telegram_delay(chat_id):
+    """Seconds to wait before this chat may receive a message, 0 when it may go out now. The limits are
+    counted in Redis so they hold across all workers."""
+    second = int(time.time())
+    wait = await telegram_slot(keys=[f"notifications:tg:global:{second}", f"notifications:tg:chat:{chat_id}"],
+                               args=[TELEGRAM_GLOBAL_RATE, int(TELEGRAM_CHAT_INTERVAL * 1000)])
+    if wait < 0:
+        return second + 1 - time.time()
+    return wait / 1000
+
+
+async def deliver(message):
+    if message['channel'] == 'telegram':
+        delay = await telegram_delay(message['recipient'])
+        if delay:
+            raise RetryLater(delay)
+        await telegram.send(message['recipient'], message['text'])
+    elif message['channel'] == 'email':
+        await mailer.send(message['recipient'], message['subject'], message['text'])
+    else:
+        raise DeliveryRejected(f"unknown channel {message['channel']!r}")
+
+
+async def handle(message_id, fields):
+    message = dict(fields, attempts=int(fields['attempts']))
+    retry_at = None
+    try:
+        await deliver(message)
+        status, error = 'sent', None
+    except DeliveryRejected as e:
+        status, error = 'failed', str(e)
+    except RetryLater as e:
+        # Rate limits and Telegram's retry_after do not use up attempts
+        status, error, retry_at = 'deferred', str(e), time.time() + e.delay
+    except Exception as e:
+        message['attempts'] += 1
+        if message['attempts'] >= NOTIFY_MAX_ATTEMPTS:
+            status, error = 'failed', repr(e)
+        else:
+            status, error, retry_at = 'retrying', repr(e), time.time() + backoff(message['attempts'])
+    if status == 'failed':
+        print(f"Notification {message['id']} to {message['recipient']} failed: {error}")
+    async with redis.pipeline(transaction=True) as pipe:
+        if retry_at is not None:
+            pipe.zadd(RETRY, {json.dumps(message, sort_keys=True): retry_at})
+        pipe.xack(STREAM, GROUP, message_id)
+        pipe.xdel(STREAM, message_id)
+        record(pipe, message, status, error)
+        await pipe.execute()
+
+
+async def ensure_group():
+    try:
+        await redis.xgroup_create(STREAM, GROUP, id='0', mkstream=True)
+    except ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+async def notification_worker():
+    last_claim = 0
+    while True:
+        try:
+            await ensure_group()
+            while True:
+                await requeue(keys=[RETRY, STREAM], args=[time.time(), NOTIFY_BATCH])
+                messages = []
+                if time.monotonic() - last_claim > NOTIFY_CLAIM_IDLE:
+                    # Messages read by a worker that died before acknowledging them
+                    last_claim = time.monotonic()
+                    claimed = await redis.xautoclaim(STREAM, GROUP, CONSUMER, NOTIFY_CLAIM_IDLE * 1000,
+                                                     count=NOTIFY_BATCH)
+                    messages = [(message_id, fields) for message_id, fields in claimed[1] if fields]
+                if not messages:
+                    # Short block so due retries are picked up within a second
+                    response = await redis.xreadgroup(GROUP, CONSUMER, {STREAM: '>'}, count=NOTIFY_BATCH,
+                                                      block=1000)
+                    messages = response[0][1] if response else []
+                await asyncio.gather(*[handle(message_id, fields) for message_id, fields in messages])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Notification worker failed: {e!r}")
+            await asyncio.sleep(1)
+
+
+async def get_result(notification_id):
+    return await redis.hgetall(result_key(notification_id)) or None
+
+
+async def notification_stats():
+    stats = await redis.hgetall(STATS)
+    try:
+        pending = (await redis.xpending(STREAM, GROUP))['pending']
+    except ResponseError:
+        pending = 0
+    return {
+        'stream_length': await redis.xlen(STREAM),
+        'pending': pending,
+        'waiting_retry': await redis.zcard(RETRY),
+        **{status: int(count) for status, count in stats.items()},
+    }
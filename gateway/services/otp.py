@@ -0,0 +1,123 @@
+import math
+import secrets
+
+from fastapi import HTTPException
+
+from config.main import OTP_TTL, OTP_COOLDOWN, OTP_MAX_ATTEMPTS, OTP_SUBJECT_PER_HOUR, OTP_IP_PER_HOUR
+
+# Each step is one Lua script, so concurrent requests can neither both pass a limit nor both use one code.
+# The code itself stays a plain string under otp:{subject}, where it has always been.
+
+# KEYS: buckets; ARGV: capacity and refill per second for each bucket. Takes one token from every bucket
+# or none at all, and returns 0 or the milliseconds until the emptiest bucket has a token again.
+TAKE_TOKENS_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 2 - 1])
+    local rate = tonumber(ARGV[i * 2])
+    local bucket = redis.call('HMGET', key, 'tokens', 'updated_at')
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated_at = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + (now - updated_at) * rate)
+    levels[i] = tokens
+    if tokens < 1 then
+        wait = math.max(wait, (1 - tokens) / rate * 1000)
+    end
+end
+for i, key in ipairs(KEYS) do
+    local tokens = levels[i]
+    if wait == 0 then
+        tokens = tokens - 1
+    end
+    redis.call('HSET', key, 'tokens', tokens, 'updated_at', now)
+    redis.call('PEXPIRE', key, math.ceil(tonumber(ARGV[i * 2 - 1]) / tonumber(ARGV[i * 2]) * 1000))
+end
+return math.ceil(wait)
+"""
+
+# KEYS: code, attempts, cooldown; ARGV: code, ttl, cooldown. Returns 0, or the cooldown left in milliseconds.
+ISSUE_SCRIPT = """
+local cooldown = redis.call('PTTL', KEYS[3])
+if cooldown > 0 then
+    return cooldown
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('DEL', KEYS[2])
+redis.call('SET', KEYS[3], 1, 'EX', ARGV[3])
+return 0
+"""
+
+# KEYS: code, attempts; ARGV: code, max attempts. Returns 1 for a match (the code is consumed), 0 for a
+# wrong code, -1 when there is no code and -2 when this wrong guess used up the last attempt.
+VERIFY_SCRIPT = """
+local stored = redis.call('GET', KEYS[1])
+if not stored then
+    return -1
+end
+if stored == ARGV[1] then
+    redis.call('DEL', KEYS[1], KEYS[2])
+    return 1
+end
+local attempts = redis.call('INCR', KEYS[2])
+if attempts == 1 then
+    redis.call('PEXPIRE', KEYS[2], math.max(redis.call('PTTL', KEYS[1]), 1))
+end
+if attempts >= tonumber(ARGV[2]) then
+    redis.call('DEL', KEYS[1], KEYS[2])
+    return -2
+end
+return 0
+"""
+
+redis = None
+take_tokens = None
+issue_script = None
+verify_script = None
+
+
+def init_otp(redis_pool):
+    global redis, take_tokens, issue_script, verify_script
+    redis = redis_pool
+    take_tokens = redis.register_script(TAKE_TOKENS_SCRIPT)
+    issue_script = redis.register_script(ISSUE_SCRIPT)
+    verify_script = redis.register_script(VERIFY_SCRIPT)
+
+
+def too_many_requests(detail, wait_ms):
+    return HTTPException(status_code=429, detail=detail,
+                         headers={'Retry-After': str(max(math.ceil(wait_ms / 1000), 1))})
+
+
+async def throttle(action, subject, ip):
+    """Per-subject and per-IP token buckets; call before any database or network work."""
+    buckets = [(f"otp:bucket:{action}:subject:{subject}", OTP_SUBJECT_PER_HOUR),
+               (f"otp:bucket:{action}:ip:{ip}", OTP_IP_PER_HOUR)]
+    args = []
+    for _, per_hour in buckets:
+        args += [per_hour, per_hour / 3600]
+    wait = await take_tokens(keys=[key for key, _ in buckets], args=args)
+    if wait:
+        raise too_many_requests('too_many_requests', wait)
+
+
+async def issue(subject):
+    """Stores a new code for the subject unless one was issued less than OTP_COOLDOWN seconds ago."""
+    code = str(secrets.randbelow(90000) + 10000)
+    cooldown = await issue_script(keys=[f"otp:{subject}", f"otp:{subject}:attempts", f"otp:{subject}:cooldown"],
+                                  args=[code, OTP_TTL, OTP_COOLDOWN])
+    if cooldown:
+        raise too_many_requests('otp_cooldown', cooldown)
+    return code
+
+
+async def verify(subject, code):
+    """Checks and consumes the subject's code. Returns False for a wrong or missing code; after
+    OTP_MAX_ATTEMPTS wrong guesses the code is dropped and a new one has to be requested."""
+    result = await verify_script(keys=[f"otp:{subject}", f"otp:{subject}:attempts"],
+                                 args=[str(code), OTP_MAX_ATTEMPTS])
+    if result == -2:
+        raise HTTPException(status_code=429, detail='too_many_attempts')
+    return result == 1
@@ -0,0 +1,75 @@
+import base64
+import json
+
+from fastapi import HTTPException
+from sqlalchemy import tuple_, literal_column
+
+from models.offers import Offer
+from schemas.offers import Sorting
+
+# (sort expression, descending). Every key is paired with Offer.id as a tie-breaker so the order is total
+# and each one is backed by a matching (expression, id) btree index.
+SORT_KEYS = {
+    Sorting.newest: (None, True),
+    Sorting.price_asc: (Offer.price, False),
+    Sorting.price_desc: (Offer.price, True),
+    Sorting.area: (Offer.area, False),
+    Sorting.price_per_meter: (Offer.price / Offer.area, False),
+    # The relevance expression depends on the search query and is passed to paginate
+    Sorting.relevance: (None, True),
+}
+
+
+def encode_cursor(sort: Sorting, value, offer_id: int):
+    payload = json.dumps({'s': sort.value, 'v': value, 'id': offer_id}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, sort: Sorting):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        value, offer_id = payload['v'], int(payload['id'])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail='invalid_cursor')
+    if payload.get('s') != sort.value:
+        raise HTTPException(status_code=400, detail='cursor_sort_mismatch')
+    return value, offer_id
+
+
+def paginate(query, sort: Sorting, cursor: str = None, limit: int = 20, relevance=None):
+    """Applies keyset pagination: the next page starts strictly after the (key, id) pair of the last row,
+    so the cost of a page does not depend on how deep it is."""
+    expression, descending = SORT_KEYS[sort]
+    if sort == Sorting.relevance:
+        if relevance is None:
+            raise HTTPException(status_code=400, detail='relevance_requires_q')
+        expression = relevance
+    if sort == Sorting.price_per_meter:
+        # Inlined rather than bound so the planner can match the partial index predicate in generic plans too
+        query = query.where(Offer.area > literal_column('0'))
+    if expression is None:
+        order_by = [Offer.id.desc() if descending else Offer.id.asc()]
+    else:
+        query = query.add_columns(expression.label('sort_value'))
+        order_by = [expression.desc(), Offer.id.desc()] if descending else [expression.asc(), Offer.id.asc()]
+    if cursor:
+        value, offer_id = decode_cursor(cursor, sort)
+        if expression is None:
+            query = query.where(Offer.id < offer_id if descending else Offer.id > offer_id)
+        else:
+            key = tuple_(expression, Offer.id)
+            query = query.where(key < tuple_(value, offer_id) if descending else key > tuple_(value, offer_id))
+    return query.order_by(*order_by).limit(limit + 1)
+
+
+def split_page(rows, sort: Sorting, limit: int):
+    """Takes the limit + 1 rows fetched by paginate and returns the page with the cursor for the next one."""
+    rows = list(rows)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    offers = [row[0] for row in rows]
+    if not has_more:
+        return offers, None
+    last = rows[-1]
+    value = last._mapping.get('sort_value')
+    return offers, encode_cursor(sort, value, last[0].id)
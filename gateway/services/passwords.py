@@ -0,0 +1,55 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+from config.main import BCRYPT_ROUNDS, PASSWORD_WORKERS, PASSWORD_QUEUE_LIMIT
+
+# Hashes made with a different cost fall outside min/max rounds, so verify_and_update reports them for rehashing
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS,
+                           bcrypt__min_rounds=BCRYPT_ROUNDS, bcrypt__max_rounds=BCRYPT_ROUNDS)
+
+_executor = None
+_slots = None
+_pending = 0
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        # bcrypt releases the GIL while hashing, so threads are enough to keep it off the event loop
+        _executor = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix='bcrypt')
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def run_bcrypt(function, *args):
+    """Runs a hash or verify on the bcrypt pool. At most PASSWORD_WORKERS run at once and at most
+    PASSWORD_QUEUE_LIMIT wait; beyond that a login burst is turned away instead of holding the worker."""
+    global _slots, _pending
+    if _pending >= PASSWORD_QUEUE_LIMIT:
+        raise HTTPException(status_code=503, detail='too_many_password_checks')
+    if _slots is None:
+        _slots = asyncio.Semaphore(PASSWORD_WORKERS)
+    _pending += 1
+    try:
+        async with _slots:
+            return await asyncio.get_running_loop().run_in_executor(get_executor(), function, *args)
+    finally:
+        _pending -= 1
+
+
+async def hash_password(password):
+    return await run_bcrypt(pwd_context.hash, password)
+
+
+async def verify_password(password, password_hash):
+    """Returns (valid, new_hash); new_hash is set when the stored hash was made with another cost factor."""
+    return await run_bcrypt(pwd_context.verify_and_update, password, password_hash)
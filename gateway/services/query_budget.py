@@ -0,0 +1,92 @@
+import contextvars
+import functools
+import json
+import re
+from collections import Counter
+
+from sqlalchemy import event
+
+from config.main import QUERY_BUDGET_MODE
+from services.metrics import QUERY_BUDGET_EXCEEDED
+
+# SQL text of the statements run by the handler currently inside a query_budget; None everywhere else
+executed = contextvars.ContextVar('query_budget_statements', default=None)
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+PLACEHOLDER = re.compile(r"\$\d+|%\(\w+\)s|(?<!:):\w+|\?")
+VALUE_LIST = re.compile(r"\(\s*\?(?:::[\w\[\]]+)?(?:\s*,\s*\?(?:::[\w\[\]]+)?)*\s*\)")
+WHITESPACE = re.compile(r"\s+")
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def fingerprint(statement):
+    """The statement with its values taken out, so the same query with other ids or a longer IN list
+    reads the same: an N+1 shows up as one fingerprint with a high count."""
+    statement = STRING_LITERAL.sub('?', statement)
+    statement = PLACEHOLDER.sub('?', statement)
+    statement = NUMBER.sub('?', statement)
+    statement = VALUE_LIST.sub('(...)', statement)
+    return WHITESPACE.sub(' ', statement).strip()
+
+
+def record_statement(connection, cursor, statement, parameters, context, executemany):
+    statements = executed.get()
+    if statements is not None:
+        statements.append(statement)
+
+
+def watch_engine(engine):
+    # The app starting again in the same process (as under the tests) must not count every statement twice
+    if not event.contains(engine.sync_engine, 'after_cursor_execute', record_statement):
+        event.listen(engine.sync_engine, 'after_cursor_execute', record_statement)
+
+
+def over_budget(handler, limit, statements):
+    fingerprints = Counter(fingerprint(statement) for statement in statements)
+    report = {
+        'event': 'query_budget_exceeded',
+        'handler': handler,
+        'budget': limit,
+        'statements': len(statements),
+        'fingerprints': [{'fingerprint': text, 'count': count} for text, count in fingerprints.most_common()],
+    }
+    QUERY_BUDGET_EXCEEDED.labels(handler).inc()
+    if QUERY_BUDGET_MODE == 'raise':
+        raise QueryBudgetExceeded(json.dumps(report, ensure_ascii=False, indent=2))
+    print(json.dumps(report, ensure_ascii=False))
+
+
+def query_budget(limit):
+    """Declares how many SQL statements a request to the decorated handler may run, counting cache misses
+    and the profile lookups for owners. Goes between the route decorator and the handler:
+
+        @router.get("/all")
+        @query_budget(2)
+        async def all_offers(...):
+    """
+
+    def decorate(endpoint):
+        handler = f"{endpoint.__module__}.{endpoint.__name__}"
+
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            if QUERY_BUDGET_MODE == 'off':
+                return await endpoint(*args, **kwargs)
+            statements = []
+            token = executed.set(statements)
+            try:
+                response = await endpoint(*args, **kwargs)
+            finally:
+                executed.reset(token)
+            # Checked only when the handler returned, so an exception it raised reaches the client unchanged
+            if len(statements) > limit:
+                over_budget(handler, limit, statements)
+            return response
+
+        return wrapper
+
+    return decorate
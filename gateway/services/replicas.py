@@ -0,0 +1,129 @@
+import asyncio
+import random
+import time
+from typing import AsyncGenerator
+
+from fastapi import Depends, Request
+from fastapi_jwt_auth import AuthJWT
+from fastapi_jwt_auth.exceptions import AuthJWTException
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from config.database import async_session_maker, engines, make_engine
+from config.main import DB_USER, DB_PASS, DB_NAME, DB_PORT, DB_REPLICA_HOSTS, DB_REPLICA_MAX_LAG, \
+    DB_REPLICA_CHECK_INTERVAL, READ_YOUR_WRITES_WINDOW
+
+# Zero while the replica has replayed everything it received, so an idle primary does not look like lag
+LAG_QUERY = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+redis = None
+pending_tasks = set()
+
+
+class Replica:
+    def __init__(self, name, host):
+        if ':' not in host:
+            host = f"{host}:{DB_PORT}"
+        self.name = name
+        self.engine = make_engine(f"postgresql+asyncpg://{DB_USER}:{DB_PASS}@{host}/{DB_NAME}", name)
+        self.session_maker = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+        self.healthy = False
+        self.lag = None
+        self.latency = None
+
+    async def check(self):
+        started = time.perf_counter()
+        try:
+            async with self.engine.connect() as connection:
+                lag = (await connection.execute(LAG_QUERY)).scalar()
+        except Exception as e:
+            if self.healthy:
+                print(f"Replica {self.name} is unavailable: {e!r}")
+            self.healthy = False
+            return
+        elapsed = time.perf_counter() - started
+        # Exponential moving average, so one slow probe does not swing the weights
+        self.latency = elapsed if self.latency is None else self.latency * 0.8 + elapsed * 0.2
+        self.lag = float(lag)
+        self.healthy = True
+
+    def usable(self):
+        return self.healthy and self.lag <= DB_REPLICA_MAX_LAG
+
+    def stats(self):
+        return {'healthy': self.healthy, 'lag': self.lag, 'latency': self.latency, 'usable': self.usable(),
+                **self.engine.sync_engine.pool.stats_snapshot()}
+
+
+replicas = [Replica(f"replica-{number}", host) for number, host in enumerate(DB_REPLICA_HOSTS, 1)]
+engines.update((replica.name, replica.engine) for replica in replicas)
+
+
+def init_replicas(redis_pool):
+    global redis
+    redis = redis_pool
+
+
+def pick_replica():
+    """A usable replica, chosen with probability inverse to its latency; None sends the read to the primary."""
+    candidates = [replica for replica in replicas if replica.usable()]
+    if not candidates:
+        return None
+    return random.choices(candidates, weights=[1 / max(replica.latency, 0.001) for replica in candidates])[0]
+
+
+async def replica_monitor():
+    if not replicas:
+        return
+    while True:
+        await asyncio.gather(*[replica.check() for replica in replicas])
+        await asyncio.sleep(DB_REPLICA_CHECK_INTERVAL)
+
+
+def replica_stats():
+    return {replica.name: replica.stats() for replica in replicas}
+
+
+def recent_write_key(user_id):
+    return f"ryw:{user_id}"
+
+
+async def mark_write(user_id):
+    """Sends the user's reads to the primary for READ_YOUR_WRITES_WINDOW seconds after a change."""
+    if replicas and redis is not None and user_id is not None:
+        await redis.set(recent_write_key(user_id), 1, ex=READ_YOUR_WRITES_WINDOW)
+
+
+def repeat_after_lag(function, *args):
+    """Runs a cache invalidation once more when replicas have caught up: a read served by a lagging replica
+    between the write and the first invalidation may have refilled the cache with the old data."""
+    if not replicas:
+        return
+
+    def run():
+        task = asyncio.ensure_future(function(*args))
+        pending_tasks.add(task)
+        task.add_done_callback(pending_tasks.discard)
+
+    asyncio.get_running_loop().call_later(DB_REPLICA_MAX_LAG, run)
+
+
+async def get_read_db(request: Request, Authorize: AuthJWT = Depends()) -> AsyncGenerator[AsyncSession, None]:
+    """Session for read-only handlers. Uses a replica when one is healthy and within DB_REPLICA_MAX_LAG,
+    and the primary otherwise or when the user has written recently."""
+    replica = pick_replica()
+    if replica is not None:
+        try:
+            user_id = Authorize.get_jwt_subject()
+        except AuthJWTException:
+            user_id = None
+        if user_id is not None and redis is not None and await redis.exists(recent_write_key(user_id)):
+            replica = None
+    session_maker = replica.session_maker if replica is not None else async_session_maker
+    async with session_maker() as session:
+        session.info['route'] = f"{request.method} {request.url.path}"
+        yield session
@@ -0,0 +1,127 @@
+import enum
+import hashlib
+import json
+
+from fastapi.encoders import jsonable_encoder
+from fastapi_cache import FastAPICache
+from pydantic import BaseModel
+
+from config.main import RESPONSE_CACHE_TTL
+from services.replicas import repeat_after_lag
+
+# Cached search responses live in the FastAPICache Redis backend. Every entry is registered in the Redis sets
+# of its tags, and a write evicts only the tags it can affect:
+#   offer:<id>  - /one responses for that offer
+#   type:<type> - searches restricted to one offer type, type:any - searches over every type
+#   owner:<id>  - responses embedding that user's contact details
+#   offers      - every offer response, for changes that touch all of them (e.g. an appliance is deleted)
+ALL_OFFERS_TAG = 'offers'
+
+
+def offer_tag(offer_id):
+    return f"offer:{offer_id}"
+
+
+def type_tag(offer_type=None):
+    return f"type:{offer_type.value if isinstance(offer_type, enum.Enum) else offer_type or 'any'}"
+
+
+def owner_tag(user_id):
+    return f"owner:{user_id}"
+
+
+def get_redis():
+    try:
+        return FastAPICache.get_backend().redis
+    except AssertionError:
+        return None
+
+
+def prefixed(name):
+    return f"{FastAPICache.get_prefix()}:offers:{name}"
+
+
+def canonical(value):
+    """Normalizes request parameters so equivalent searches share one cache entry: lists are sorted,
+    floats rounded and models/enums reduced to plain values."""
+    if isinstance(value, BaseModel):
+        value = value.dict()
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, dict):
+        return {key: canonical(item) for key, item in sorted(value.items())}
+    if isinstance(value, (list, tuple, set)):
+        return sorted((canonical(item) for item in value), key=lambda item: json.dumps(item, sort_keys=True))
+    if isinstance(value, float):
+        return round(value, 6) if not value.is_integer() else int(value)
+    return value
+
+
+def cache_key(endpoint, params):
+    digest = hashlib.sha1(json.dumps(canonical(params), sort_keys=True).encode()).hexdigest()
+    return prefixed(f"{endpoint}:{digest}")
+
+
+def search_tags(filters):
+    return [ALL_OFFERS_TAG, type_tag(filters.type)]
+
+
+def response_tags(response):
+    """Owner tags for every offer contained in a response."""
+    offers = response['offers'] if 'offers' in response else [response]
+    return {owner_tag(offer['user_id']) for offer in offers if offer.get('user_id') is not None}
+
+
+async def cached_response(endpoint, params, tags, build):
+    redis = get_redis()
+    if redis is None:
+        return await build()
+    key = cache_key(endpoint, params)
+    value = await redis.get(key)
+    if value is not None:
+        await redis.hincrby(prefixed('stats'), 'hits', 1)
+        return json.loads(value)
+    await redis.hincrby(prefixed('stats'), 'misses', 1)
+    response = jsonable_encoder(await build())
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.set(key, json.dumps(response), ex=RESPONSE_CACHE_TTL)
+        for tag in {*tags, *response_tags(response)}:
+            pipe.sadd(prefixed(f"tag:{tag}"), key)
+            pipe.expire(prefixed(f"tag:{tag}"), RESPONSE_CACHE_TTL)
+        await pipe.execute()
+    return response
+
+
+async def invalidate_tags(*tags):
+    await evict_tags(*tags)
+    repeat_after_lag(evict_tags, *tags)
+
+
+async def evict_tags(*tags):
+    redis = get_redis()
+    if redis is None or not tags:
+        return
+    tag_keys = [prefixed(f"tag:{tag}") for tag in set(tags)]
+    async with redis.pipeline(transaction=False) as pipe:
+        for tag_key in tag_keys:
+            pipe.smembers(tag_key)
+        members = await pipe.execute()
+    keys = {key for group in members for key in group}
+    if keys:
+        evicted = await redis.delete(*keys)
+        await redis.hincrby(prefixed('stats'), 'evictions', evicted)
+    await redis.delete(*tag_keys)
+
+
+async def invalidate_offer(offer_id, *offer_types):
+    """Evicts what a created, edited or deleted offer can affect: its own page and the searches over its old
+    and new type, plus the searches over every type."""
+    await invalidate_tags(offer_tag(offer_id), type_tag(), *[type_tag(offer_type) for offer_type in offer_types])
+
+
+async def cache_stats():
+    redis = get_redis()
+    if redis is None:
+        return {}
+    stats = await redis.hgetall(prefixed('stats'))
+    return {name: int(stats.get(name, 0)) for name in ('hits', 'misses', 'evictions')}
@@ -0,0 +1,31 @@
+from sqlalchemy import func, or_, literal_column
+
+from models.offers import Offer
+
+# Listings are written in Russian and English, so queries are parsed with both configurations and matched
+# against a vector built with both (see the offer_search_vector trigger).
+TEXT_SEARCH_CONFIGS = ('russian', 'english')
+
+
+def text_query(q: str):
+    queries = [func.websearch_to_tsquery(literal_column(f"'{config}'::regconfig"), q) for config in TEXT_SEARCH_CONFIGS]
+    tsquery = queries[0]
+    for query in queries[1:]:
+        tsquery = tsquery.op('||')(query)
+    return tsquery
+
+
+def escape_like(q: str):
+    return q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def text_search_condition(q: str):
+    """Full-text match on title/description/address, or a partial address match served by the trigram index."""
+    return or_(
+        Offer.search_vector.op('@@')(text_query(q)),
+        Offer.address.ilike(f"%{escape_like(q)}%"),
+    )
+
+
+def text_rank(q: str):
+    return func.ts_rank_cd(Offer.search_vector, text_query(q)) + func.similarity(Offer.address, q)
@@ -0,0 +1,327 @@
+import asyncio
+
+from sqlalchemy import select
+
+from config.database import async_session_maker
+from config.main import SEARCH_ENGINE, SEARCH_INDEX_RECONCILE_INTERVAL
+from models.offers import Offer
+from schemas.offers import Types, Rooms, Renovation, GeoStatus, Sorting
+from services import events
+from services.pagination import decode_cursor, encode_cursor
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CHANGED_EVENT = 'offers.changed'
+
+TYPE_CODES = {item.value: code for code, item in enumerate(Types)}
+ROOMS_CODES = {item.value: code for code, item in enumerate(Rooms)}
+RENOVATION_CODES = {item.value: code for code, item in enumerate(Renovation)}
+
+INDEX_COLUMNS = (Offer.id, Offer.price, Offer.area, Offer.floor, Offer.lat, Offer.lon, Offer.type, Offer.rooms,
+                 Offer.renovation, Offer.geo_status, Offer.appliance_ids)
+
+NUMERIC_COLUMNS = {
+    'id': 'i8',
+    'price': 'f4',
+    'area': 'f4',
+    'floor': 'i4',
+    'lat': 'f4',
+    'lon': 'f4',
+    'type': 'i1',
+    'rooms': 'i1',
+    'renovation': 'i1',
+    'resolved': '?',
+    'alive': '?',
+}
+
+
+class OfferIndex:
+    """Columnar in-memory copy of the searchable offer fields. Filters are evaluated as vectorized masks
+    over NumPy arrays, and the database is only asked for the rows of the page being returned.
+
+    Prices, areas and coordinates are kept as float32 like the REAL columns, so sort keys and cursors match the SQL
+    path exactly and a cursor from one engine is valid for the other. Filter bounds are compared in float64,
+    as Postgres compares a REAL column with a double precision parameter."""
+
+    def __init__(self):
+        self.size = 0
+        self.position = {}
+        self.words = 1
+        self.columns = self.allocate(0)
+        self.ready = False
+
+    def allocate(self, capacity):
+        columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in NUMERIC_COLUMNS.items()}
+        columns['appliances'] = np.zeros((capacity, self.words), dtype=np.uint64)
+        return columns
+
+    def grow(self, capacity, words=1):
+        if capacity <= len(self.columns['id']) and words <= self.words:
+            return
+        capacity = max(capacity, len(self.columns['id']))
+        old, self.words = self.columns, max(words, self.words)
+        self.columns = self.allocate(capacity)
+        for name, column in old.items():
+            if name == 'appliances':
+                self.columns[name][:len(column), :column.shape[1]] = column
+            else:
+                self.columns[name][:len(column)] = column
+
+    @staticmethod
+    def words_for(appliance_ids):
+        return max(appliance_ids, default=0) // 64 + 1
+
+    def write(self, row_number, row):
+        columns = self.columns
+        columns['id'][row_number] = row.id
+        columns['price'][row_number] = row.price
+        columns['area'][row_number] = row.area
+        columns['floor'][row_number] = row.floor
+        columns['lat'][row_number] = row.lat if row.lat is not None else np.nan
+        columns['lon'][row_number] = row.lon if row.lon is not None else np.nan
+        columns['type'][row_number] = TYPE_CODES.get(row.type, -1)
+        columns['rooms'][row_number] = ROOMS_CODES.get(row.rooms, -1)
+        columns['renovation'][row_number] = RENOVATION_CODES.get(row.renovation, -1)
+        columns['resolved'][row_number] = row.geo_status == GeoStatus.resolved
+        columns['alive'][row_number] = True
+        columns['appliances'][row_number] = self.appliance_bits(row.appliance_ids or [])
+
+    def appliance_bits(self, appliance_ids):
+        bits = np.zeros(self.words, dtype=np.uint64)
+        for appliance_id in appliance_ids:
+            if appliance_id // 64 >= self.words:
+                # Unknown to this index; a required bit that can never be set makes the offer unmatchable
+                continue
+            bits[appliance_id // 64] |= np.uint64(1) << np.uint64(appliance_id % 64)
+        return bits
+
+    @classmethod
+    def from_rows(cls, rows):
+        index = cls()
+        index.words = max([cls.words_for(row.appliance_ids or []) for row in rows], default=1)
+        index.columns = index.allocate(len(rows))
+        for row_number, row in enumerate(rows):
+            index.write(row_number, row)
+            index.position[row.id] = row_number
+        index.size = len(rows)
+        index.ready = True
+        return index
+
+    def upsert(self, row):
+        self.grow(len(self.columns['id']), self.words_for(row.appliance_ids or []))
+        row_number = self.position.get(row.id)
+        if row_number is None:
+            if self.size == len(self.columns['id']):
+                self.grow(max(16, 2 * self.size))
+            row_number = self.size
+            self.size += 1
+            self.position[row.id] = row_number
+        self.write(row_number, row)
+
+    def remove(self, offer_id):
+        row_number = self.position.pop(offer_id, None)
+        if row_number is not None:
+            self.columns['alive'][row_number] = False
+
+    def field_masks(self, filters):
+        """One mask per filtered field, keyed like the SQL filter predicates so facets can drop their own."""
+        c = {name: column[:self.size] for name, column in self.columns.items()}
+        masks = {}
+
+        def restrict(field, condition):
+            masks[field] = masks[field] & condition if field in masks else condition
+
+        if filters.type:
+            restrict('type', c['type'] == TYPE_CODES[filters.type.value])
+        if filters.price_from is not None:
+            restrict('price', c['price'].astype(np.float64) >= filters.price_from)
+        if filters.price_to is not None:
+            restrict('price', c['price'].astype(np.float64) <= filters.price_to)
+        if filters.rooms:
+            restrict('rooms', np.isin(c['rooms'], [ROOMS_CODES[rooms.value] for rooms in filters.rooms]))
+        if filters.area_from is not None:
+            restrict('area', c['area'].astype(np.float64) >= filters.area_from)
+        if filters.area_to is not None:
+            restrict('area', c['area'].astype(np.float64) <= filters.area_to)
+        if filters.floor_from is not None:
+            restrict('floor', c['floor'] >= filters.floor_from)
+        if filters.floor_to is not None:
+            restrict('floor', c['floor'] <= filters.floor_to)
+        if filters.renovation:
+            restrict('renovation', np.isin(c['renovation'], [RENOVATION_CODES[renovation.value]
+                                                             for renovation in filters.renovation]))
+        if filters.appliance:
+            if max(filters.appliance) // 64 >= self.words:
+                restrict('appliance', np.zeros(self.size, dtype=bool))
+            else:
+                required = self.appliance_bits(filters.appliance)
+                restrict('appliance', ((c['appliances'] & required) == required).all(axis=1))
+        return masks
+
+    def mask(self, filters, map=None):
+        c = {name: column[:self.size] for name, column in self.columns.items()}
+        mask = c['alive'].copy()
+        for field_mask in self.field_masks(filters).values():
+            mask &= field_mask
+        if map is not None:
+            # float64, like the point(lon, lat) the SQL viewport is matched against
+            lat, lon = c['lat'].astype(np.float64), c['lon'].astype(np.float64)
+            mask &= c['resolved']
+            mask &= (lat >= map.coordinates_min.lat) & (lat <= map.coordinates_max.lat)
+            lon_min, lon_max = map.coordinates_min.lon, map.coordinates_max.lon
+            if lon_min > lon_max:
+                mask &= (lon >= lon_min) | (lon <= lon_max)
+            else:
+                mask &= (lon >= lon_min) & (lon <= lon_max)
+        return mask
+
+    def facets(self, filters, price_step, area_step):
+        """Same counts as services.facets.sql_facets: each facet is counted under every filter but its own."""
+        c = {name: column[:self.size] for name, column in self.columns.items()}
+        masks = self.field_masks(filters)
+
+        def excluding(facet):
+            mask = c['alive'].copy()
+            for field, field_mask in masks.items():
+                if field != facet:
+                    mask &= field_mask
+            return mask
+
+        values = {}
+        for facet, codes in (('type', TYPE_CODES), ('rooms', ROOMS_CODES), ('renovation', RENOVATION_CODES)):
+            column = c[facet][excluding(facet)]
+            counts = np.bincount(column[column >= 0], minlength=len(codes))
+            values[facet] = {value: int(counts[code]) for value, code in codes.items() if counts[code]}
+        buckets = {}
+        for facet, step in (('price', price_step), ('area', area_step)):
+            # float64 division, like the double precision arithmetic of the SQL bucket expression
+            bucket = np.floor(c[facet][excluding(facet)].astype(np.float64) / step).astype(np.int64)
+            found, counts = np.unique(bucket, return_counts=True)
+            buckets[facet] = dict(zip(found.tolist(), counts.tolist()))
+        return int(excluding(None).sum()), values, buckets
+
+    def sort_key(self, sort):
+        """Sort values as ascending keys: descending sorts are negated, together with the id tie-breaker."""
+        c = self.columns
+        if sort == Sorting.newest:
+            return None, -c['id'][:self.size].astype(np.float64), -1
+        if sort == Sorting.price_asc:
+            values = c['price'][:self.size]
+            return values, values.astype(np.float64), 1
+        if sort == Sorting.price_desc:
+            values = c['price'][:self.size]
+            return values, -values.astype(np.float64), -1
+        if sort == Sorting.area:
+            values = c['area'][:self.size]
+            return values, values.astype(np.float64), 1
+        if sort == Sorting.price_per_meter:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values = c['price'][:self.size] / c['area'][:self.size]
+            return values, values.astype(np.float64), 1
+        raise ValueError(sort)
+
+    def search(self, filters, sort, cursor=None, limit=20):
+        """Returns the ids of one page in sort order and the cursor of the next page."""
+        mask = self.mask(filters)
+        values, keys, direction = self.sort_key(sort)
+        ids = self.columns['id'][:self.size]
+        if sort == Sorting.price_per_meter:
+            mask &= self.columns['area'][:self.size] > 0
+        if cursor:
+            value, offer_id = decode_cursor(cursor, sort)
+            key = -offer_id if values is None else direction * float(np.float32(value))
+            tie = ids * direction > offer_id * direction
+            mask &= (keys > key) | ((keys == key) & tie)
+        rows = np.flatnonzero(mask)
+        if len(rows) > limit + 1:
+            # Top-k by key in linear time; rows tied with the k-th key are all kept so the id tie-break
+            # below stays exact
+            kth = np.partition(keys[rows], limit)[limit]
+            rows = rows[keys[rows] <= kth]
+        rows = rows[np.lexsort((ids[rows] * direction, keys[rows]))][:limit + 1]
+        page, has_more = rows[:limit], len(rows) > limit
+        next_cursor = None
+        if has_more:
+            last = page[-1]
+            next_cursor = encode_cursor(sort, None if values is None else float(values[last]), int(ids[last]))
+        return [int(offer_id) for offer_id in ids[page]], next_cursor
+
+    def viewport(self, filters, map):
+        return [int(offer_id) for offer_id in self.columns['id'][:self.size][self.mask(filters, map)]]
+
+
+index = OfferIndex()
+# Ids of offers changed while rebuild() is loading its snapshot, None when no rebuild is running
+changed_during_rebuild = None
+
+
+def enabled():
+    return SEARCH_ENGINE == 'memory' and np is not None and index.ready
+
+
+async def load_rows(session, ids=None):
+    query = select(*INDEX_COLUMNS)
+    if ids is not None:
+        query = query.where(Offer.id.in_(ids))
+    return (await session.execute(query)).all()
+
+
+async def refresh(target, ids):
+    async with async_session_maker() as session:
+        rows = await load_rows(session, ids)
+    for row in rows:
+        target.upsert(row)
+    for offer_id in set(ids) - {row.id for row in rows}:
+        target.remove(offer_id)
+
+
+async def rebuild():
+    """Full reconciliation with Postgres; the new index replaces the old one in a single assignment. Offers
+    changed while the snapshot was loading are refreshed in the new index right after the swap, since the
+    snapshot may predate their change."""
+    global index, changed_during_rebuild
+    changed_during_rebuild = set()
+    try:
+        async with async_session_maker() as session:
+            rows = await load_rows(session)
+        index = OfferIndex.from_rows(rows)
+        changed = changed_during_rebuild
+    finally:
+        changed_during_rebuild = None
+    if changed:
+        await refresh(index, changed)
+
+
+async def apply_changes(payload):
+    if changed_during_rebuild is not None:
+        changed_during_rebuild.update(payload['ids'])
+    # Bound before the query, so a change loaded before a swap lands in the index it was meant for
+    target = index
+    if target.ready:
+        await refresh(target, payload['ids'])
+
+
+async def offers_changed(*offer_ids):
+    """Called after offers were created, edited, deleted or geocoded; every worker refreshes those rows."""
+    if SEARCH_ENGINE == 'memory' and offer_ids:
+        await events.publish(CHANGED_EVENT, {'ids': list(offer_ids)})
+
+
+async def search_index_worker():
+    if SEARCH_ENGINE != 'memory':
+        return
+    if np is None:
+        print("SEARCH_ENGINE=memory requires numpy, falling back to SQL search")
+        return
+    while True:
+        try:
+            await rebuild()
+        except Exception as e:
+            print(f"Search index rebuild failed: {e!r}")
+        await asyncio.sleep(SEARCH_INDEX_RECONCILE_INTERVAL)
+
+
+events.subscribe(CHANGED_EVENT, apply_changes)
@@ -0,0 +1,212 @@
+import asyncio
+import base64
+import binascii
+import hashlib
+import json
+import os
+import re
+import uuid
+
+import aiofiles
+import aiofiles.os
+from fastapi import HTTPException
+
+from config.main import IMAGES_DIR, UPLOADS_DIR, MAX_IMAGE_SIZE, UPLOAD_CHUNK_SIZE
+from services.image_store import staged_path
+
+# Leading bytes of every accepted format; the first chunk of an upload is checked against these before
+# anything else is written, so a non-image is rejected after at most one chunk.
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'RIFF', 'webp'),
+)
+SNIFF_LENGTH = 12
+# Originals in the store are named by the sha256 of their bytes; derivatives add a _size suffix to the stem
+BLOB_NAME = re.compile(r"[0-9a-f]{64}\.(?:%s)" % '|'.join(ext for _, ext in IMAGE_SIGNATURES))
+
+
+def sniff_image_type(head: bytes):
+    for signature, ext in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            if ext == 'webp' and head[8:12] != b'WEBP':
+                return None
+            return ext
+    return None
+
+
+def check_declared_size(length):
+    if length is not None and int(length) > MAX_IMAGE_SIZE:
+        raise HTTPException(status_code=413, detail="image_too_large")
+
+
+async def discard(path):
+    try:
+        await aiofiles.os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def write_chunks(path, chunks, mode='wb', written=0, limit=MAX_IMAGE_SIZE, head=b''):
+    """Appends the stream to path as it arrives, so memory is bounded by the size of a single chunk.
+    Returns the total number of bytes in the file and the leading bytes used to sniff its type."""
+    async with aiofiles.open(path, mode) as f:
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            written += len(chunk)
+            if written > limit:
+                raise HTTPException(status_code=413, detail="image_too_large")
+            if len(head) < SNIFF_LENGTH:
+                head += chunk[:SNIFF_LENGTH - len(head)]
+                if len(head) >= SNIFF_LENGTH and not sniff_image_type(head):
+                    raise HTTPException(status_code=415, detail="unsupported_image_type")
+            await f.write(chunk)
+    return written, head
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def store(tmp_path, head):
+    """Names a finished upload by the sha256 of its bytes, so the same photo uploaded for several offers is
+    kept on disk once. The file is staged next to the uploads until register_blobs moves it into the store."""
+    ext = sniff_image_type(head)
+    if not ext:
+        await discard(tmp_path)
+        raise HTTPException(status_code=415, detail="unsupported_image_type")
+    digest = await asyncio.to_thread(file_digest, tmp_path)
+    image_path = os.path.join(IMAGES_DIR, f"{digest}.{ext}")
+    await aiofiles.os.replace(tmp_path, staged_path(image_path))
+    return image_path
+
+
+async def save_image_stream(chunks, content_length=None):
+    check_declared_size(content_length)
+    await aiofiles.os.makedirs(UPLOADS_DIR, exist_ok=True)
+    tmp_path = os.path.join(UPLOADS_DIR, f"{uuid.uuid4().hex}.tmp")
+    try:
+        _, head = await write_chunks(tmp_path, chunks)
+    except BaseException:
+        await discard(tmp_path)
+        raise
+    return await store(tmp_path, head)
+
+
+async def save_image_data_url(data_url: str):
+    """Legacy path for clients that still send base64 data URLs inside the JSON body."""
+    try:
+        encoded = data_url.split(",", 1)[1]
+    except IndexError:
+        raise HTTPException(status_code=400, detail="invalid_image")
+    check_declared_size(len(encoded) * 3 // 4)
+
+    async def chunks():
+        step = UPLOAD_CHUNK_SIZE - UPLOAD_CHUNK_SIZE % 4
+        for start in range(0, len(encoded), step):
+            try:
+                yield base64.b64decode(encoded[start:start + step])
+            except (binascii.Error, ValueError):
+                raise HTTPException(status_code=400, detail="invalid_image")
+
+    return await save_image_stream(chunks())
+
+
+async def resolve_image(value: str):
+    """Offer images are either a legacy data URL or the name of an image returned by the upload endpoints.
+    Names are only checked for their shape here; the caller checks that they are registered blobs."""
+    if value.startswith('data:'):
+        return await save_image_data_url(value), True
+    name = os.path.basename(value)
+    if not BLOB_NAME.fullmatch(name):
+        raise HTTPException(status_code=400, detail="image_not_found")
+    return os.path.join(IMAGES_DIR, name), False
+
+
+def upload_paths(upload_id: str):
+    try:
+        upload_id = uuid.UUID(upload_id).hex
+    except ValueError:
+        raise HTTPException(status_code=404, detail="upload_not_found")
+    base = os.path.join(UPLOADS_DIR, upload_id)
+    return f"{base}.part", f"{base}.json", f"{base}.lock"
+
+
+def lock_upload(lock_path):
+    """Takes the append lock of an upload by creating its marker file, which fails if the file already
+    exists, so concurrent PATCHes are serialised across every worker process and not only within one. A lock
+    left by a worker that died mid-append expires with the rest of the upload."""
+    try:
+        os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        raise HTTPException(status_code=409, detail="upload_in_progress")
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="upload_not_found")
+
+
+async def create_upload(length: int, user_id):
+    check_declared_size(length)
+    if length <= 0:
+        raise HTTPException(status_code=400, detail="invalid_upload_length")
+    await aiofiles.os.makedirs(UPLOADS_DIR, exist_ok=True)
+    upload_id = uuid.uuid4().hex
+    part_path, meta_path, _ = upload_paths(upload_id)
+    async with aiofiles.open(meta_path, 'w') as f:
+        await f.write(json.dumps({'length': length, 'user_id': user_id}))
+    async with aiofiles.open(part_path, 'wb'):
+        pass
+    return {'upload_id': upload_id, 'offset': 0, 'length': length}
+
+
+async def get_upload(upload_id: str, user_id):
+    part_path, meta_path, _ = upload_paths(upload_id)
+    try:
+        async with aiofiles.open(meta_path) as f:
+            meta = json.loads(await f.read())
+        offset = (await aiofiles.os.stat(part_path)).st_size
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="upload_not_found")
+    if meta['user_id'] != user_id:
+        raise HTTPException(status_code=404, detail="upload_not_found")
+    return {'upload_id': upload_id, 'offset': offset, 'length': meta['length']}
+
+
+async def append_upload(upload_id: str, user_id, offset: int, chunks):
+    """Resumable mode: each request carries the offset it starts at, and a client on a flaky link asks
+    get_upload for the current offset and continues from there after a dropped connection. A PATCH arriving
+    while another one is still writing the same upload gets 409 rather than interleaving its bytes."""
+    _, _, lock_path = upload_paths(upload_id)
+    lock_upload(lock_path)
+    try:
+        return await write_upload(upload_id, user_id, offset, chunks)
+    finally:
+        await discard(lock_path)
+
+
+async def write_upload(upload_id: str, user_id, offset: int, chunks):
+    # The offset is read under the lock, so two requests starting at the same offset cannot both pass
+    upload = await get_upload(upload_id, user_id)
+    if offset != upload['offset']:
+        raise HTTPException(status_code=409, detail="offset_mismatch")
+    part_path, meta_path, _ = upload_paths(upload_id)
+    head = b''
+    if offset:
+        async with aiofiles.open(part_path, 'rb') as f:
+            head = await f.read(SNIFF_LENGTH)
+    try:
+        written, head = await write_chunks(part_path, chunks, mode='ab', written=offset, limit=upload['length'],
+                                           head=head)
+    except HTTPException:
+        await discard(part_path)
+        await discard(meta_path)
+        raise
+    upload['offset'] = written
+    if written == upload['length']:
+        upload['image'] = await store(part_path, head)
+        await discard(meta_path)
+    return upload
@@ -0,0 +1,148 @@
+import json
+import time
+from collections import OrderedDict
+
+from sqlalchemy import select
+
+from config.main import USER_CACHE_TTL, USER_CACHE_LOCAL_TTL, USER_CACHE_SIZE
+from models.auth import User
+from services import events
+from services.replicas import repeat_after_lag
+from services.response_cache import invalidate_tags, owner_tag
+
+CHANGED_EVENT = 'users.changed'
+
+redis = None
+
+
+def init_user_cache(redis_pool):
+    global redis
+    redis = redis_pool
+
+
+class TTLCache:
+    """LRU whose entries also expire, so a worker that missed an invalidation serves stale data for a
+    bounded time only."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict()
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self.items[key]
+            return None
+        self.items.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.items[key] = (time.monotonic() + self.ttl, value)
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def pop(self, key):
+        self.items.pop(key, None)
+
+
+local = TTLCache(USER_CACHE_SIZE, USER_CACHE_LOCAL_TTL)
+
+
+def user_key(user_id):
+    return f"user:{user_id}"
+
+
+def profile_of(user: User):
+    return {
+        'id': user.id,
+        'role': user.role,
+        'phone': user.phone,
+        'username': user.tg_username,
+        'tg_id': user.tg_id,
+        'name': user.name,
+        'email': user.email,
+        'status': user.status,
+    }
+
+
+def owner_of(profile):
+    """The public part of a profile shown with the user's offers."""
+    return {
+        'name': profile['name'],
+        'tg_username': profile['username'],
+        'phone': profile['phone'],
+        'email': profile['email'],
+    }
+
+
+async def store_profiles(profiles):
+    for profile in profiles:
+        local.set(profile['id'], profile)
+    if redis is not None and profiles:
+        async with redis.pipeline(transaction=False) as pipe:
+            for profile in profiles:
+                pipe.set(user_key(profile['id']), json.dumps(profile), ex=USER_CACHE_TTL)
+            await pipe.execute()
+
+
+async def get_profiles(session, user_ids):
+    """Profiles by user id, looked up in this worker's cache, then Redis, then one query for the rest."""
+    user_ids = {int(user_id) for user_id in user_ids}
+    profiles = {}
+    for user_id in user_ids:
+        profile = local.get(user_id)
+        if profile is not None:
+            profiles[user_id] = profile
+    missing = sorted(user_ids - profiles.keys())
+    if missing and redis is not None:
+        for user_id, value in zip(missing, await redis.mget([user_key(user_id) for user_id in missing])):
+            if value is not None:
+                profiles[user_id] = json.loads(value)
+                local.set(user_id, profiles[user_id])
+        missing = [user_id for user_id in missing if user_id not in profiles]
+    if missing:
+        users = (await session.execute(select(User).where(User.id.in_(missing)))).scalars().all()
+        loaded = [profile_of(user) for user in users]
+        await store_profiles(loaded)
+        profiles.update((profile['id'], profile) for profile in loaded)
+    return profiles
+
+
+async def get_profile(session, user_id):
+    return (await get_profiles(session, [user_id])).get(int(user_id))
+
+
+async def get_owners(session, user_ids):
+    return {user_id: owner_of(profile) for user_id, profile in (await get_profiles(session, user_ids)).items()}
+
+
+async def cache_user(user: User):
+    await store_profiles([profile_of(user)])
+
+
+async def drop_local(payload):
+    local.pop(payload['id'])
+
+
+async def invalidate_user(user_id):
+    """Called after a user row changed: forgets the profile everywhere and evicts the cached offer
+    responses that embed it as the owner."""
+    user_id = int(user_id)
+    await forget_profile(user_id)
+    repeat_after_lag(forget_profile, user_id)
+    await invalidate_tags(owner_tag(user_id))
+
+
+async def forget_profile(user_id):
+    local.pop(user_id)
+    if redis is not None:
+        await redis.delete(user_key(user_id))
+    await events.publish(CHANGED_EVENT, {'id': user_id})
+
+
+events.subscribe(CHANGED_EVENT, drop_local)
@@ -0,0 +1,113 @@
+import asyncio
+import contextlib
+import os
+import tempfile
+
+import pytest
+
+# Tests run against their own database on the configured server, created and migrated on first use, and
+# never against DB_NAME itself. Redis is flushed by the tests, so it gets a database of its own as well.
+os.environ['DB_NAME'] = os.environ.get('TEST_DB_NAME', 'realty_test')
+os.environ['REDIS_URL'] = os.environ.get('TEST_REDIS_URL', 'redis://127.0.0.1:6379/15')
+STORAGE_DIR = tempfile.mkdtemp(prefix='realty-test-')
+os.environ['IMAGES_DIR'] = os.path.join(STORAGE_DIR, 'images')
+os.environ['UPLOADS_DIR'] = os.path.join(STORAGE_DIR, 'uploads')
+for directory in ('images', 'uploads'):
+    os.makedirs(os.path.join(STORAGE_DIR, directory))
+for name, value in {'DB_HOST': 'localhost', 'DB_PORT': '5432', 'DB_USER': 'postgres', 'DB_PASS': 'postgres',
+                    'SMTP_PORT': '587', 'SECRET_AUTH': 'test-secret', 'METRICS_PORT': '0',
+                    'SEARCH_ENGINE': 'sql', 'QUERY_BUDGET_MODE': 'raise', 'GEOCODER_BACKEND': 'stub',
+                    'BCRYPT_ROUNDS': '4'}.items():
+    os.environ.setdefault(name, value)
+
+import asyncpg  # noqa: E402
+import redis  # noqa: E402
+from alembic import command  # noqa: E402
+from alembic.config import Config  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from fastapi_cache import FastAPICache  # noqa: E402
+from fastapi_jwt_auth import AuthJWT  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+
+import models.auth  # noqa: E402,F401
+from config.database import engines  # noqa: E402
+from config.main import DB_HOST, DB_PORT, DB_USER, DB_PASS, DB_NAME, REDIS_URL  # noqa: E402
+
+GATEWAY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TABLES = ('appliances_map', 'image_blob', 'offer', 'appliance', 'customer')
+
+
+def run(coroutine):
+    """Runs a coroutine on a fresh event loop. Pooled connections belong to the loop that opened them, so the
+    application's pools are swapped for empty ones afterwards."""
+    try:
+        return asyncio.run(coroutine)
+    finally:
+        for engine in engines.values():
+            engine.sync_engine.dispose(close=False)
+
+
+async def create_database():
+    try:
+        connection = await asyncpg.connect(host=DB_HOST, port=DB_PORT, user=DB_USER, password=DB_PASS,
+                                           database='postgres', timeout=5)
+    except (OSError, asyncpg.PostgresError) as e:
+        pytest.skip(f"PostgreSQL is not available: {e!r}")
+    try:
+        if not await connection.fetchval("SELECT 1 FROM pg_database WHERE datname = $1", DB_NAME):
+            await connection.execute(f'CREATE DATABASE "{DB_NAME}"')
+    finally:
+        await connection.close()
+
+
+@pytest.fixture(scope='session')
+def database():
+    run(create_database())
+    config = Config(os.path.join(GATEWAY_DIR, 'alembic.ini'))
+    config.set_main_option('script_location', os.path.join(GATEWAY_DIR, 'migrations'))
+    command.upgrade(config, 'head')
+    return engines['primary']
+
+
+async def truncate(engine):
+    async with engine.begin() as connection:
+        await connection.execute(text(f"TRUNCATE {', '.join(TABLES)} RESTART IDENTITY CASCADE"))
+
+
+@pytest.fixture
+def empty_database(database):
+    run(truncate(database))
+    return database
+
+
+def flush_redis():
+    store = redis.Redis.from_url(REDIS_URL)
+    try:
+        store.flushdb()
+    except redis.ConnectionError as e:
+        pytest.skip(f"Redis is not available: {e!r}")
+    finally:
+        store.close()
+
+
+@contextlib.contextmanager
+def app_client():
+    """The application with its startup and shutdown, on an empty Redis database and cold in-process caches."""
+    import api
+    from services import users
+
+    flush_redis()
+    users.local.items.clear()
+    try:
+        with TestClient(api.app) as client:
+            yield client
+    finally:
+        # The pools and the Redis client belong to the client's event loop, which is closed by now, and
+        # FastAPICache.init keeps the first backend it was given
+        for engine in engines.values():
+            engine.sync_engine.dispose(close=False)
+        FastAPICache.reset()
+
+
+def auth(user_id=1):
+    return {'Authorization': f"Bearer {AuthJWT().create_access_token(subject=user_id)}"}
@@ -0,0 +1,30 @@
+"""Deleting an appliance changes what the appliance filters match, so the cached cluster tiles of the offers
+that had it are evicted."""
+import redis
+
+from config.main import REDIS_URL
+from tests.conftest import run, app_client, auth
+from tests.test_query_budget import MAP, seed
+
+APPLIANCE_FILTERS = {'rooms': [], 'appliance': [1], 'renovation': []}
+
+
+def cluster_keys():
+    store = redis.Redis.from_url(REDIS_URL)
+    try:
+        return store.keys('clusters:*')
+    finally:
+        store.close()
+
+
+def test_deleting_an_appliance_evicts_the_tiles(database):
+    run(seed(database))
+    with app_client() as client:
+        request = {'params': {'zoom': 10}, 'json': {'map': MAP, 'filters': APPLIANCE_FILTERS}, 'headers': auth()}
+        before = client.request('GET', '/v1/offer/map/clusters', **request).json()
+        cached = cluster_keys()
+        assert client.delete('/v1/offer/appliance/1').status_code == 200
+        after = client.request('GET', '/v1/offer/map/clusters', **request).json()
+    assert cached
+    assert before['clusters'] or before['points']
+    assert not after['clusters'] and not after['points']
@@ -0,0 +1,81 @@
+"""The bulk re-geocoding command: it drains the queue even while the geocoder is unavailable, and re-geocoding
+'all' never takes a resolved offer off the map."""
+import pytest
+from sqlalchemy import text
+
+from services import clusters, events, geocoding, geocoding_queue
+from services.geocoding import CircuitOpen, normalize_address
+from tests.conftest import run, truncate
+
+RESULTS = {'Moscow, Tverskaya 1': {'lat': 55.757, 'lon': 37.611, 'country': 'Russia'},
+           'Saint Petersburg, Nevsky 1': {'lat': 59.936, 'lon': 30.315, 'country': 'Russia'}}
+
+
+class Geocoder:
+    """Answers from RESULTS once the circuit has closed again, and records the offers on the map meanwhile."""
+
+    def __init__(self, engine, open_for=0):
+        self.engine = engine
+        self.open_for = open_for
+        self.mapped = []
+
+    async def geocode(self, address):
+        async with self.engine.connect() as connection:
+            self.mapped.append(set((await connection.execute(text(
+                "SELECT id FROM offer WHERE geo_status = 'resolved' AND lat IS NOT NULL"))).scalars()))
+        if self.open_for:
+            self.open_for -= 1
+            raise CircuitOpen()
+        return {normalize_address(key): value for key, value in RESULTS.items()}[normalize_address(address)]
+
+
+async def seed(engine):
+    await truncate(engine)
+    async with engine.begin() as connection:
+        await connection.execute(text(
+            "INSERT INTO customer (id, role, name, tg_id, tg_username, status) "
+            "VALUES (1, 'client', 'Owner', '1001', 'owner', 0)"))
+        await connection.execute(text(
+            """INSERT INTO offer (id, user_id, img1, img2, img3, address, title, description, type, rooms, price, area,
+                                  floor, renovation, lat, lon, country, geo_status, geo_attempts, appliance_ids)
+               VALUES (1, 1, 'a.jpg', 'b.jpg', 'c.jpg', 'Moscow, Tverskaya 1', 'Offer 1', 'Seeded offer', 'Apartment',
+                       '2', 5000000, 40, 1, 'Euro renovation', 55.751, 37.617, 'Russia', 'resolved', 0, '{}'),
+                      (2, 1, 'a.jpg', 'b.jpg', 'c.jpg', 'Saint Petersburg, Nevsky 1', 'Offer 2', 'Seeded offer',
+                       'Apartment', '2', 5000000, 40, 1, 'Euro renovation', NULL, NULL, NULL, 'failed', 8, '{}')"""))
+
+
+async def offers(engine):
+    """The coordinates are stored as REAL, so they are compared at the precision of the results."""
+    async with engine.connect() as connection:
+        return {row.id: (row.geo_status, row.lat, row.lon) for row in await connection.execute(text(
+            "SELECT id, geo_status, round(lat::numeric, 3)::float AS lat, round(lon::numeric, 3)::float AS lon "
+            "FROM offer"))}
+
+
+@pytest.fixture
+def geocoder(empty_database, monkeypatch):
+    monkeypatch.setattr(geocoding_queue, 'GEOCODING_POLL_INTERVAL', 0)
+    # Without Redis, like the command before main sets it up; an app started by an earlier test leaves
+    # clients bound to its closed event loop
+    monkeypatch.setattr(clusters, 'redis', None)
+    monkeypatch.setattr(events, 'redis', None)
+
+    def install(**options):
+        monkeypatch.setattr(geocoding, 'geocoder', Geocoder(empty_database, **options))
+        return geocoding.geocoder
+
+    run(seed(empty_database))
+    return install
+
+
+def test_regeocode_waits_for_the_circuit_to_close(geocoder, empty_database):
+    geocoder(open_for=3)
+    run(geocoding_queue.regeocode('failed'))
+    assert run(offers(empty_database))[2] == ('resolved', 59.936, 30.315)
+
+
+def test_regeocode_all_keeps_resolved_offers_on_the_map(geocoder, empty_database):
+    fake = geocoder(open_for=1)
+    run(geocoding_queue.regeocode('all'))
+    assert run(offers(empty_database)) == {1: ('resolved', 55.757, 37.611), 2: ('resolved', 59.936, 30.315)}
+    assert all(1 in mapped for mapped in fake.mapped)
@@ -0,0 +1,104 @@
+"""A body with the signature of a supported format that Pillow cannot decode is refused before it reaches the
+store, and nothing of it is left on disk or in image_blob. Resumable uploads take one PATCH at a time, and the
+ones abandoned are expired by the image collector."""
+import base64
+import io
+import os
+import time
+
+from PIL import Image
+from sqlalchemy import text
+
+from config.main import IMAGES_DIR, UPLOADS_DIR, UPLOAD_EXPIRY
+from services.image_store import expire_uploads
+from tests.conftest import run, app_client, auth
+
+
+def jpeg(size=(64, 48)):
+    image = io.BytesIO()
+    Image.new('RGB', size, 'red').save(image, 'JPEG')
+    return image.getvalue()
+
+
+def truncated_jpeg():
+    data = jpeg((640, 480))
+    return data[:len(data) // 2]
+
+
+def stored_files():
+    return set(os.listdir(IMAGES_DIR)) | set(os.listdir(UPLOADS_DIR))
+
+
+async def blob_names(engine):
+    async with engine.connect() as connection:
+        return set((await connection.execute(text("SELECT name FROM image_blob"))).scalars())
+
+
+def test_upload_is_stored_with_derivatives(empty_database):
+    with app_client() as client:
+        response = client.put('/v1/offer/image', content=jpeg(), headers=auth())
+    assert response.status_code == 200, response.text
+    name = response.json()['image']
+    assert run(blob_names(empty_database)) == {name}
+    assert os.path.isfile(os.path.join(IMAGES_DIR, name))
+    assert os.path.isfile(os.path.join(IMAGES_DIR, name.replace('.jpg', '_thumb.jpg')))
+
+
+def test_corrupt_upload_is_rejected(empty_database):
+    before = stored_files()
+    with app_client() as client:
+        response = client.put('/v1/offer/image', content=truncated_jpeg(), headers=auth())
+    assert response.status_code == 415, response.text
+    assert response.json()['detail'] == 'unsupported_image_type'
+    assert stored_files() == before
+    assert run(blob_names(empty_database)) == set()
+
+
+def test_corrupt_inline_image_leaves_nothing_behind(empty_database):
+    """The valid image before the corrupt one was already placed in the store; it goes again."""
+    before = stored_files()
+    images = [f"data:image/jpeg;base64,{base64.b64encode(data).decode()}" for data in (jpeg((32, 32)),
+                                                                                      truncated_jpeg())]
+    with app_client() as client:
+        response = client.post('/v1/offer/', headers=auth(), json={
+            'img1': images[0], 'img2': images[1], 'address': 'Moscow', 'title': 'Flat', 'description': 'Flat',
+            'type': 'Apartment', 'rooms': '1', 'price': 5000000, 'area': 30, 'floor': 2, 'renovation': 'Any',
+            'appliances': []})
+    assert response.status_code == 415, response.text
+    assert stored_files() == before
+    assert run(blob_names(empty_database)) == set()
+
+
+def test_concurrent_append_is_refused(empty_database):
+    data = jpeg()
+    with app_client() as client:
+        upload = client.post('/v1/offer/uploads', headers={**auth(), 'Upload-Length': str(len(data))}).json()
+        lock_path = os.path.join(UPLOADS_DIR, f"{upload['upload_id']}.lock")
+        # Another request is still writing this upload
+        open(lock_path, 'w').close()
+        busy = client.patch(f"/v1/offer/uploads/{upload['upload_id']}", content=data[:100],
+                            headers={**auth(), 'Upload-Offset': '0'})
+        os.remove(lock_path)
+        done = client.patch(f"/v1/offer/uploads/{upload['upload_id']}", content=data,
+                            headers={**auth(), 'Upload-Offset': '0'})
+    assert busy.status_code == 409
+    assert busy.json()['detail'] == 'upload_in_progress'
+    assert done.status_code == 200, done.text
+    assert done.json()['offset'] == len(data)
+    assert not os.path.exists(lock_path)
+
+
+def test_abandoned_uploads_expire():
+    stale = time.time() - UPLOAD_EXPIRY - 60
+    paths = {name: os.path.join(UPLOADS_DIR, name)
+             for name in ('abandoned.part', 'abandoned.json', 'resumed.part', 'resumed.json', 'crashed.tmp')}
+    for path in paths.values():
+        open(path, 'wb').close()
+        os.utime(path, (stale, stale))
+    # The upload was created long ago but a chunk arrived since
+    os.utime(paths['resumed.part'])
+    run(expire_uploads())
+    assert {name for name, path in paths.items() if os.path.exists(path)} == {'resumed.part', 'resumed.json'}
+    for path in paths.values():
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,112 @@
+"""Every index of the offer filter migration (c4a7e2f9d816) is checked against the plan Postgres picks for the
+query it was added for, on a seeded table large enough that a sequential scan is never the cheap option."""
+import json
+
+import pytest
+from sqlalchemy import select, delete, and_, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+
+from models.offers import Offer, AppliancesMap
+from routes.offers import filter_conditions_for
+from schemas.offers import Filters, Sorting, Types, Rooms, Renovation
+from services.pagination import paginate
+from tests.conftest import run, truncate
+
+OFFERS = 60000
+USERS = 500
+APPLIANCES = 20
+
+SEED = [
+    "SELECT setseed(0.11)",
+    f"""INSERT INTO customer (id, role, name, tg_id, tg_username)
+        SELECT n, 'user', 'User ' || n, n::text, 'user' || n FROM generate_series(1, {USERS}) n""",
+    f"INSERT INTO appliance (id, name) SELECT n, 'Appliance ' || n FROM generate_series(1, {APPLIANCES}) n",
+    f"""INSERT INTO offer (user_id, img1, address, title, description, type, rooms, price, area, floor, renovation,
+                          geo_status)
+        SELECT 1 + floor(random() * {USERS}), 'seed.jpg', 'Address ' || n, 'Offer ' || n, 'Seeded offer',
+               (ARRAY['Apartment', 'Room', 'House'])[1 + floor(random() * 3)],
+               (ARRAY['Studio', '1', '2', '3', '4', '5', '6+'])[1 + floor(random() * 7)],
+               round((1000000 + random() * 19000000)::numeric, -3), round((15 + random() * 285)::numeric, 1),
+               1 + floor(random() * 30),
+               (ARRAY['Any', 'Without renovation', 'Cosmetic renovation', 'Euro renovation',
+                      'Designer renovation'])[1 + floor(random() * 5)],
+               'resolved'
+        FROM generate_series(1, {OFFERS}) n""",
+    f"""INSERT INTO appliances_map (offer_id, appliance_id)
+        SELECT DISTINCT offer.id, 1 + floor(random() * {APPLIANCES})
+        FROM offer, generate_series(1, 3)""",
+    "ANALYZE",
+]
+
+
+async def seed(engine):
+    await truncate(engine)
+    async with engine.begin() as connection:
+        for statement in SEED:
+            await connection.execute(text(statement))
+
+
+@pytest.fixture(scope='module')
+def seeded(database):
+    run(seed(database))
+    yield database
+    run(truncate(database))
+
+
+def indexes_used(plan):
+    found = set()
+    if 'Index Name' in plan:
+        found.add(plan['Index Name'])
+    for child in plan.get('Plans', []):
+        found |= indexes_used(child)
+    return found
+
+
+async def explain(engine, statement):
+    sql = statement.compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True})
+    async with engine.connect() as connection:
+        rows = (await connection.execute(text(f"EXPLAIN (FORMAT JSON) {sql}"))).scalar()
+    plan = rows if isinstance(rows, list) else json.loads(rows)
+    return indexes_used(plan[0]['Plan'])
+
+
+def search(**filters):
+    """The statement /all runs on the SQL path for the first page of the default sort."""
+    filters = Filters(**{'rooms': [], 'appliance': [], 'renovation': [], **filters})
+    return paginate(select(Offer).where(and_(*filter_conditions_for(filters))), Sorting.newest, None, 20)
+
+
+@pytest.mark.parametrize('statement, index', [
+    # The default search screen: type, a set of rooms and a price range
+    (search(type=Types.apartment, rooms=[Rooms.three], price_from=5000000, price_to=5200000),
+     'ix_offer_type_rooms_price'),
+    # Floor and renovation are applied on top of the same index rather than having their own
+    (search(type=Types.apartment, rooms=[Rooms.three, Rooms.four], price_from=5000000, price_to=5200000,
+            floor_from=2, renovation=[Renovation.euro]),
+     'ix_offer_type_rooms_price'),
+    # The same search without a type
+    (search(rooms=[Rooms.two], price_from=5000000, price_to=5100000), 'ix_offer_rooms_price'),
+    # Area range searches
+    (search(type=Types.house, area_from=100, area_to=101), 'ix_offer_type_area'),
+    # /my
+    (select(Offer).where(Offer.user_id == 7), 'ix_offer_user_id'),
+    # Detaching an appliance, and the appliance foreign key
+    (delete(AppliancesMap).where(AppliancesMap.appliance_id == 3), 'ix_appliances_map_appliance_id'),
+    # Replacing the appliances of an offer, served by the leading column of the unique constraint
+    (delete(AppliancesMap).where(AppliancesMap.offer_id == 42), 'uq_appliances_map_offer_appliance'),
+], ids=['type-rooms-price', 'type-rooms-price-floor-renovation', 'rooms-price', 'type-area', 'user',
+        'appliance', 'offer-appliances'])
+def test_filter_uses_index(seeded, statement, index):
+    assert index in run(explain(seeded, statement))
+
+
+def test_offer_appliance_pairs_are_unique(seeded):
+    async def insert_twice():
+        async with seeded.begin() as connection:
+            await connection.execute(text("DELETE FROM appliances_map WHERE offer_id = 1"))
+            await connection.execute(text("INSERT INTO appliances_map (offer_id, appliance_id) VALUES (1, 1)"))
+            await connection.execute(text("INSERT INTO appliances_map (offer_id, appliance_id) VALUES (1, 1)"))
+
+    with pytest.raises(IntegrityError):
+        run(insert_twice())
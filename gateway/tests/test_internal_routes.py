@@ -0,0 +1,38 @@
+"""The /internal routes describe the deployment and are only served to admins."""
+import pytest
+from sqlalchemy import text
+
+from tests.conftest import run, truncate, app_client, auth
+
+ADMIN, CLIENT = 1, 2
+ROUTES = ['/internal/cache', '/internal/notifications', '/internal/db-pool', '/internal/replicas']
+
+
+async def seed(engine):
+    await truncate(engine)
+    async with engine.begin() as connection:
+        await connection.execute(text(
+            """INSERT INTO customer (id, role, name, tg_id, tg_username, status)
+               VALUES (1, 'admin', 'Admin', '1001', 'admin', 0), (2, 'client', 'Client', '1002', 'client', 0)"""))
+
+
+@pytest.fixture
+def client(database):
+    run(seed(database))
+    with app_client() as client:
+        yield client
+
+
+@pytest.mark.parametrize('route', ROUTES)
+def test_internal_route_requires_admin(client, route):
+    assert client.get(route).status_code == 401
+    response = client.get(route, headers=auth(CLIENT))
+    assert response.status_code == 403
+    assert response.json()['detail'] == 'user_not_allowed'
+    assert client.get(route, headers=auth(ADMIN)).status_code == 200
+
+
+def test_notification_result_requires_admin(client):
+    route = '/internal/notifications/unknown'
+    assert client.get(route, headers=auth(CLIENT)).status_code == 403
+    assert client.get(route, headers=auth(ADMIN)).status_code == 404
@@ -0,0 +1,145 @@
+"""Every route with a query_budget is called on a cold start: the response cache, the profile caches and the
+cluster tiles are empty and the request takes the longest path it has, so the statements it runs are the most
+it can ever run. QUERY_BUDGET_MODE is 'raise' under the tests, so a route over its budget fails the request
+with the report of the statements it ran."""
+import asyncio
+import base64
+import io
+import os
+
+import pytest
+import redis
+from fastapi import HTTPException
+from PIL import Image
+from sqlalchemy import text
+
+from config.main import IMAGES_DIR, REDIS_URL
+from services import query_budget as budgets
+from services.passwords import pwd_context
+from tests.conftest import run, truncate, app_client, auth
+
+OWNER, OTHER = 1, 2
+PASSWORD = 'correct horse'
+IMAGES = [f"{digit * 64}.jpg" for digit in 'abcdef']
+# Offers 1 to 4 are close enough to share a cluster cell. Every offer has the same image in two slots, so
+# releasing its images takes one statement per reference count.
+OFFERS = [(OWNER, 55.751, 37.617), (OWNER, 55.752, 37.618), (OTHER, 55.753, 37.619), (OTHER, 55.754, 37.616),
+          (OTHER, 59.939, 30.315)]
+
+SEED = [
+    f"""INSERT INTO customer (role, name, tg_id, tg_username, phone, email, password, status)
+        VALUES ('client', 'Owner', '1001', 'owner', '79990000001', 'owner@example.com', '{pwd_context.hash(PASSWORD)}',
+                0),
+               ('client', 'Other', '1002', 'other', '79990000002', 'other@example.com', NULL, 0)""",
+    "INSERT INTO appliance (name) VALUES ('Fridge'), ('Washer'), ('Oven')",
+    "INSERT INTO image_blob (name, refs, released_at) VALUES "
+    + ', '.join(f"('{name}', 0, timezone('utc', now()))" for name in IMAGES),
+    *[f"""INSERT INTO offer (user_id, img1, img2, img3, address, title, description, type, rooms, price, area, floor,
+                             renovation, lat, lon, country, geo_status, appliance_ids)
+          VALUES ({user_id}, '{IMAGES_DIR}/{IMAGES[0]}', '{IMAGES_DIR}/{IMAGES[1]}', '{IMAGES_DIR}/{IMAGES[0]}',
+                  'Address {n}', 'Offer {n}', 'Seeded offer', 'Apartment', '2', {5000000 + n * 100000}, {40 + n}, {n},
+                  'Euro renovation', {lat}, {lon}, 'Russia', 'resolved', '{{1,2}}')"""
+      for n, (user_id, lat, lon) in enumerate(OFFERS, 1)],
+    "INSERT INTO appliances_map (offer_id, appliance_id) SELECT id, unnest(appliance_ids) FROM offer",
+    f"UPDATE image_blob SET refs = {2 * len(OFFERS)}, released_at = NULL WHERE name = '{IMAGES[0]}'",
+    f"UPDATE image_blob SET refs = {len(OFFERS)}, released_at = NULL WHERE name = '{IMAGES[1]}'",
+]
+
+FILTERS = {'type': 'Apartment', 'price_from': 1000000, 'price_to': 9000000, 'rooms': ['2', '3'], 'area_from': 10,
+           'area_to': 100, 'floor_from': 1, 'floor_to': 10, 'appliance': [1], 'renovation': ['Euro renovation']}
+MAP = {'coordinates_min': {'lat': 55.7, 'lon': 37.5}, 'coordinates_max': {'lat': 55.8, 'lon': 37.7}}
+
+
+def data_url(color):
+    image = io.BytesIO()
+    Image.new('RGB', (64, 48), color).save(image, 'PNG')
+    return f"data:image/png;base64,{base64.b64encode(image.getvalue()).decode()}"
+
+
+def offer_body(**values):
+    """Two images sent inline and one uploaded before, so both ways of passing an image are checked."""
+    return {'img1': data_url('red'), 'img2': data_url('green'), 'img3': IMAGES[2],
+            'address': 'Moscow, Tverskaya 1', 'title': 'Flat', 'description': 'Bright flat', 'type': 'Apartment',
+            'rooms': '3', 'price': 7500000, 'area': 64, 'floor': 4, 'renovation': 'Euro renovation',
+            'appliances': [1, 2, 3], **values}
+
+
+async def seed(engine):
+    await truncate(engine)
+    async with engine.begin() as connection:
+        for statement in SEED:
+            await connection.execute(text(statement))
+
+
+@pytest.fixture
+def client(database):
+    for name in IMAGES:
+        with open(os.path.join(IMAGES_DIR, name), 'wb') as f:
+            f.write(b'\xff\xd8\xff')
+    run(seed(database))
+    with app_client() as client:
+        yield client
+
+
+def set_code(username, code):
+    store = redis.Redis.from_url(REDIS_URL)
+    try:
+        store.set(f"otp:{username}", str(code))
+    finally:
+        store.close()
+
+
+CASES = {
+    'create_offer': lambda: ('POST', '/v1/offer/', {'json': offer_body(), 'headers': auth()}),
+    # New images in every slot, a new address and other appliances
+    'update_offer': lambda: ('PUT', '/v1/offer/1', {'json': offer_body(img3=IMAGES[3]), 'headers': auth()}),
+    'delete_offer': lambda: ('DELETE', '/v1/offer/1', {'headers': auth()}),
+    'offer': lambda: ('GET', '/v1/offer/one/1', {'headers': auth()}),
+    'all_offers': lambda: ('GET', '/v1/offer/all', {'params': {'q': 'offer', 'sort': 'relevance'},
+                                                    'json': {'rooms': [], 'appliance': [], 'renovation': []},
+                                                    'headers': auth()}),
+    'all_offers_filtered': lambda: ('GET', '/v1/offer/all', {'json': FILTERS, 'headers': auth()}),
+    'offer_facets': lambda: ('GET', '/v1/offer/facets', {'json': FILTERS, 'headers': auth()}),
+    'my_offers': lambda: ('GET', '/v1/offer/my', {'headers': auth()}),
+    'map_offers': lambda: ('GET', '/v1/offer/map', {'json': {'map': MAP, 'filters': FILTERS}, 'headers': auth()}),
+    'map_clusters': lambda: ('GET', '/v1/offer/map/clusters', {
+        'params': {'zoom': 10}, 'json': {'map': MAP, 'filters': {'rooms': [], 'appliance': [], 'renovation': []}},
+        'headers': auth()}),
+    'send_otp': lambda: ('GET', '/v1/send-otp', {'params': {'tg_id': '1001'}}),
+    'auth': lambda: ('POST', '/v1/auth', {'json': {'tg_id': '1001'}}),
+    'signin': lambda: ('POST', '/v1/signin', {'json': {'username': 'owner', 'password': PASSWORD}}),
+    'signup': lambda: ('POST', '/v1/signup', {'json': {'role': 'client', 'name': 'New', 'tg_id': '1003',
+                                                       'tg_username': 'new'}}),
+    'profile': lambda: ('GET', '/v1/profile', {'headers': auth()}),
+    'edit_data': lambda: ('PUT', '/v1/edit-data', {'json': {'name': 'Owner', 'phone': '79990000009',
+                                                            'email': 'new@example.com', 'username': 'owner'},
+                                                   'headers': auth()}),
+    'set_password': lambda: ('PUT', '/v1/set-password', {'json': {'new_password': 'new password',
+                                                                  'confirm_password': 'new password'},
+                                                         'headers': auth()}),
+    'send_reset_otp': lambda: ('GET', '/v1/send-reset-otp', {'params': {'username': 'owner'}}),
+    'reset_password': lambda: ('POST', '/v1/reset-password', {'json': {'username': 'owner', 'code': 12345,
+                                                                       'new_password': 'new password',
+                                                                       'confirm_password': 'new password'}}),
+}
+
+
+@pytest.mark.parametrize('case', CASES)
+def test_route_stays_within_budget(client, case):
+    if case == 'reset_password':
+        set_code('owner', 12345)
+    method, url, options = CASES[case]()
+    response = client.request(method, url, **options)
+    assert response.status_code == 200, response.text
+
+
+def test_handler_error_is_not_replaced(monkeypatch):
+    monkeypatch.setattr(budgets, 'QUERY_BUDGET_MODE', 'raise')
+
+    @budgets.query_budget(1)
+    async def handler():
+        budgets.executed.get().extend(['SELECT 1', 'SELECT 2'])
+        raise HTTPException(status_code=404, detail='offer_not_found')
+
+    with pytest.raises(HTTPException):
+        asyncio.run(handler())
@@ -0,0 +1,145 @@
+"""The in-memory index answers exactly like the SQL path: every filter, sort, cursor, viewport and facet is run
+through both on the same seeded table, and the results must be identical. Prices, areas and coordinates carry
+more digits than a REAL holds, so the bounds fall between float32 neighbours and any comparison made in the
+wrong precision shows up."""
+import pytest
+from sqlalchemy import select, and_, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models.offers import Offer
+from routes.offers import filter_conditions_for, filter_predicates, viewport_condition
+from schemas.offers import Filters, Map, Sorting, GeoStatus
+from services.facets import facet_response, sql_facets
+from services.pagination import paginate, split_page
+from services.search_index import OfferIndex, load_rows
+from tests.conftest import run, truncate
+
+pytest.importorskip('numpy')
+
+OFFERS = 1500
+PAGE = 40
+
+SEED = [
+    "SELECT setseed(0.37)",
+    "INSERT INTO customer (id, role, name, tg_id, tg_username) VALUES (1, 'client', 'Owner', '1001', 'owner')",
+    "INSERT INTO appliance (id, name) SELECT n, 'Appliance ' || n FROM generate_series(1, 5) n",
+    # Prices and areas repeat often enough for the id tie-breaker to matter, a few areas are zero, and the
+    # longitudes span the antimeridian
+    f"""INSERT INTO offer (user_id, img1, address, title, description, type, rooms, price, area, floor, renovation,
+                          lat, lon, geo_status, appliance_ids)
+        SELECT 1, 'seed.jpg', 'Address ' || n, 'Offer ' || n, 'Seeded offer',
+               (ARRAY['Apartment', 'Room', 'House'])[1 + floor(random() * 3)],
+               (ARRAY['Studio', '1', '2', '3', '4', '5', '6+'])[1 + floor(random() * 7)],
+               CASE WHEN random() < 0.3 THEN 1000000 * (1 + floor(random() * 10))
+                    ELSE round((1000000 + random() * 9000000)::numeric, 1) END,
+               CASE WHEN random() < 0.02 THEN 0 ELSE round((15 + random() * 85)::numeric, 3) END,
+               1 + floor(random() * 20),
+               (ARRAY['Any', 'Without renovation', 'Cosmetic renovation', 'Euro renovation',
+                      'Designer renovation'])[1 + floor(random() * 5)],
+               55 + random(), CASE WHEN random() < 0.2 THEN 179.5 + random() ELSE 37 + random() END,
+               (ARRAY['resolved', 'resolved', 'resolved', 'pending', 'failed'])[1 + floor(random() * 5)],
+               ARRAY(SELECT a FROM generate_series(1, 5) a WHERE random() < 0.4 AND n > 0)
+        FROM generate_series(1, {OFFERS}) n""",
+    "UPDATE offer SET lon = lon - 360 WHERE lon > 180",
+    "UPDATE offer SET lat = NULL, lon = NULL WHERE geo_status <> 'resolved' AND id % 2 = 0",
+    "INSERT INTO appliances_map (offer_id, appliance_id) SELECT id, unnest(appliance_ids) FROM offer",
+]
+
+EMPTY = {'rooms': [], 'appliance': [], 'renovation': []}
+FILTERS = [
+    Filters(**EMPTY),
+    Filters(**{**EMPTY, 'type': 'Apartment', 'rooms': ['2', '3', 'Studio']}),
+    Filters(**{**EMPTY, 'price_from': 2500000.05, 'price_to': 7000000.05, 'area_from': 40.0005,
+               'area_to': 80.0005}),
+    Filters(**{**EMPTY, 'floor_from': 3, 'floor_to': 12, 'appliance': [1, 3],
+               'renovation': ['Euro renovation', 'Any']}),
+    Filters(**{**EMPTY, 'appliance': [70]}),
+]
+
+
+async def seed(engine):
+    await truncate(engine)
+    async with engine.begin() as connection:
+        for statement in SEED:
+            await connection.execute(text(statement))
+
+
+async def build_index(engine):
+    async with engine.connect() as connection:
+        return OfferIndex.from_rows(await load_rows(connection))
+
+
+@pytest.fixture(scope='module')
+def seeded(database):
+    run(seed(database))
+    yield database, run(build_index(database))
+    run(truncate(database))
+
+
+def viewports(engine):
+    """Fixed viewports, one across the antimeridian, and viewports whose edges sit just beside stored
+    coordinates, where a float32 comparison rounds the bound onto the coordinate."""
+    async def coordinates():
+        async with engine.connect() as connection:
+            return (await connection.execute(
+                select(Offer.lat, Offer.lon).where(Offer.geo_status == GeoStatus.resolved).order_by(Offer.id)
+                .limit(3))).all()
+
+    boxes = [(55.2, 37.1, 55.8, 37.9), (55, 179.8, 56, -179.6), (54, -180, 57, 180)]
+    for lat, lon in run(coordinates()):
+        boxes.append((lat + 1e-7, lon - 0.5, lat + 0.5, lon + 0.5))
+        boxes.append((lat - 0.5, lon + 1e-7, lat + 0.5, lon + 0.5))
+        boxes.append((lat - 0.5, lon - 0.5, lat - 1e-7, lon - 1e-7))
+    return [Map(coordinates_min={'lat': lat_min, 'lon': lon_min},
+                coordinates_max={'lat': lat_max, 'lon': lon_max}) for lat_min, lon_min, lat_max, lon_max in boxes]
+
+
+async def sql_page(engine, filters, sort, cursor):
+    async with AsyncSession(engine) as session:
+        query = select(Offer).where(and_(*filter_conditions_for(filters)))
+        rows = (await session.execute(paginate(query, sort, cursor, PAGE))).all()
+    offers, next_cursor = split_page(rows, sort, PAGE)
+    return [offer.id for offer in offers], next_cursor
+
+
+async def sql_viewport(engine, filters, map):
+    async with engine.connect() as connection:
+        return set((await connection.execute(
+            select(Offer.id).where(Offer.geo_status == GeoStatus.resolved, viewport_condition(map),
+                                   *filter_conditions_for(filters)))).scalars())
+
+
+async def sql_facet_counts(engine, filters, price_step, area_step):
+    async with engine.connect() as connection:
+        return await sql_facets(connection, filter_predicates(filters), price_step, area_step)
+
+
+@pytest.mark.parametrize('sort', [sort for sort in Sorting if sort != Sorting.relevance])
+@pytest.mark.parametrize('filters', FILTERS)
+def test_pages_and_cursors_match(seeded, filters, sort):
+    engine, index = seeded
+    cursor, pages = None, 0
+    while True:
+        expected = run(sql_page(engine, filters, sort, cursor))
+        assert index.search(filters, sort, cursor, PAGE) == expected
+        pages += 1
+        cursor = expected[1]
+        if cursor is None:
+            break
+    assert pages > 1 or filters.appliance == [70]
+
+
+@pytest.mark.parametrize('filters', FILTERS)
+def test_viewports_match(seeded, filters):
+    engine, index = seeded
+    for map in viewports(engine):
+        assert set(index.viewport(filters, map)) == run(sql_viewport(engine, filters, map)), map
+
+
+@pytest.mark.parametrize('steps', [(1000000, 10), (333333.3, 7.5)])
+@pytest.mark.parametrize('filters', FILTERS)
+def test_facets_match(seeded, filters, steps):
+    engine, index = seeded
+    price_step, area_step = steps
+    counts = facet_response(*index.facets(filters, price_step, area_step), price_step, area_step)
+    assert counts == run(sql_facet_counts(engine, filters, price_step, area_step))